@@ -164,16 +164,29 @@ XDI_record = {'xafs_linx'                        : (True,  'BMM.sample_x_positio
               'monotc_downstream_temperature'    : (False, 'BMM.mono_tc_downstream'),
               'monotc_upstream_low_temperature'  : (False, 'BMM.mono_tc_upstream_low'),
               }
+run_report('\t'+'run cache')
+from BMM.runcache import BMMRunCache
+runcache = BMMRunCache()
+
 run_report('\t'+'XDI')
 from BMM.xdi import write_XDI
 
 run_report('\t'+'machine learning and data evaluation')
-from BMM.ml import BMMDataEvaluation
+from BMM.ml import BMMDataEvaluation, EarlyQualityCheck
 clf = BMMDataEvaluation()
+earlycheck = EarlyQualityCheck()
+
+run_report('\t'+'mono rewind planner')
+from BMM.rewind import BMMRewindPlanner
+rewinder = BMMRewindPlanner()
 
 run_report('\t'+'xafs')
 from BMM.xafs import howlong, xafs, db2xdi
 
+run_report('\t'+'fly scans')
+from BMM.flyscan import fly_xafs, check_fly
+from BMM.rebin import rebin, check_rebin
+
 run_report('\t'+'mono calibration')
 from BMM.mono_calibration import calibrate, calibrate_high_end, calibrate_low_end, calibrate_mono
 
@@ -195,8 +208,11 @@ run_report('\t'+'Demeter')
 from BMM.demeter import athena, hephaestus, toprj
 
 run_report('\t'+'telemetry')
-from BMM.telemetry import BMMTelementry
+from BMM.telemetry import BMMTelementry, TelemetryUpdater, PointTimer
 tele = BMMTelementry()
+RE.subscribe(TelemetryUpdater(tele))
+pointtimer = PointTimer()
+RE.subscribe(pointtimer)
 
 run_report('\t'+'user interaction')
 from BMM.wdywtd import WDYWTD
@@ -0,0 +1,166 @@
+import math
+import numpy, pandas
+
+from bluesky.plan_stubs import mv, trigger_and_read, stage, unstage
+from bluesky.preprocessors import stage_decorator, run_decorator, finalize_wrapper
+
+from BMM.functions import whisper
+from BMM.runcache  import CachedRun
+from BMM.xdi       import xdi_columns
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+def coarse_grid(energy_grid, time_grid, factor=2):
+    '''Thin an energy grid to every factor-th point, always keeping
+    both ends, to make the starting grid of an adaptive scan.'''
+    keep = numpy.zeros(len(energy_grid), dtype=bool)
+    keep[::factor] = True
+    keep[-1] = True
+    return numpy.asarray(energy_grid)[keep], numpy.asarray(time_grid)[keep]
+
+
+def refine_grid(energy, mu, npoints, min_step=0.1):
+    '''Choose up to npoints new energies where mu(E) is changing the
+    most, to be measured next.
+
+    Each interval between neighboring measured points is scored by
+    how much mu changes across it plus how badly a straight line
+    between its ends misses the curvature of mu, that is
+
+        score = |delta mu| + |curvature| * width**2 / 8
+
+    The midpoints of the highest scoring intervals are returned, at
+    most one per interval.  Intervals narrower than 2*min_step are not
+    split.
+
+    Parameters
+    ----------
+    energy, mu : arrays
+        the points measured so far, in any order
+    npoints : int
+        the most new points to return
+    min_step : float
+        smallest energy step to be made by splitting an interval
+
+    Returns a sorted array of new energies.
+    '''
+    order  = numpy.argsort(energy)
+    e, m   = numpy.asarray(energy, dtype=float)[order], numpy.asarray(mu, dtype=float)[order]
+    finite = numpy.isfinite(m)
+    e, m   = e[finite], m[finite]
+    if len(e) < 3 or npoints < 1:
+        return numpy.array([])
+    width  = numpy.diff(e)
+    slope  = numpy.diff(m) / width
+    ## second derivative at interior points, from the neighboring slopes
+    curve  = numpy.zeros(len(e))
+    curve[1:-1] = 2 * numpy.diff(slope) / (width[1:] + width[:-1])
+    curvature = numpy.maximum(numpy.abs(curve[1:]), numpy.abs(curve[:-1]))
+    score = numpy.abs(numpy.diff(m)) + curvature * width**2 / 8
+    score[width < 2*min_step] = -1
+    candidates = numpy.flatnonzero(score > 0)
+    if len(candidates) > npoints:
+        candidates = candidates[numpy.argpartition(score[candidates], -npoints)[-npoints:]]
+    return numpy.sort((e[candidates] + e[candidates+1]) / 2)
+
+
+def adaptive_scan(detectors, energy_grid, time_grid, mode, max_points, passes=3, min_step=0.25, xspress3=None, stopping=None, md=None):
+    '''Measure an XAFS scan which begins on a coarse grid and adds
+    points where mu(E) is changing fastest, as a single run.
+
+    The coarse grid is measured first.  After each pass, mu(E) is
+    computed from the data in hand (as for the XDI file) and up to an
+    equal share of the remaining point budget is placed by refine_grid,
+    then measured in increasing energy.  The dwell time of each new
+    point is interpolated from time_grid.  The events of the run are
+    therefore not in energy order, see sorted_run.
+
+    The Xspress3 must be told how many points it will measure before it
+    is staged, but the number of points added by each pass is not known
+    until the previous pass is done.  So the Xspress3, if used, is
+    staged separately for each pass with total_points set to the number
+    of points in that pass.
+
+    If stopping is given, it is called before each point and between
+    passes.  When it returns True, no more points are measured and the
+    run ends.
+
+    Parameters
+    ----------
+    detectors : list
+        detectors to trigger and read, as for scan_nd
+    energy_grid, time_grid : arrays
+        the starting grid and its dwell times
+    mode : str
+        measurement mode, used to compute mu(E)
+    max_points : int
+        total number of points to measure
+    passes : int
+        number of refinement passes
+    min_step : float
+        smallest energy step made by refinement
+    xspress3 : Xspress3 detector
+        the Xspress3, if it is one of the detectors
+    stopping : callable
+        returns True when the scan should end early
+    md : dict
+        metadata for the start document
+    '''
+    dcm, dwell_time, BMMuser = user_ns['dcm'], user_ns['dwell_time'], user_ns['BMMuser']
+    motors = [dcm.energy, dwell_time]
+    _md = {'plan_name'  : 'adaptive_scan',
+           'detectors'  : [d.name for d in detectors],
+           'motors'     : [m.name for m in motors],
+           'num_points' : int(max_points),
+           'plan_args'  : {'max_points': max_points, 'passes': passes, 'min_step': min_step},
+           'hints'      : {'dimensions': [([dcm.energy.name], 'primary')]},}
+    _md.update(md or {})
+    rows = []
+    stopping = stopping or (lambda: False)
+
+    def measure(energies, times):
+        def points():
+            for e, t in zip(energies, times):
+                if stopping():
+                    return
+                yield from mv(dcm.energy, e, dwell_time, t)
+                reading = yield from trigger_and_read(list(detectors) + motors)
+                rows.append({k: v['value'] for k, v in reading.items()})
+        if xspress3 is None:
+            return (yield from points())
+        yield from mv(xspress3.total_points, len(energies))
+        yield from stage(xspress3)
+        return (yield from finalize_wrapper(points(), unstage(xspress3)))
+
+    @stage_decorator([d for d in detectors if d is not xspress3] + motors)
+    @run_decorator(md=_md)
+    def inner():
+        yield from measure(energy_grid, time_grid)
+        for n in range(passes):
+            remaining = max_points - len(rows)
+            if remaining <= 0 or stopping():
+                break
+            table = pandas.DataFrame(rows)
+            xdi_columns(table, mode, 'xafs')
+            new = refine_grid(table['dcm_energy'].to_numpy(), table['xmu'].to_numpy(),
+                              math.ceil(remaining / (passes-n)), min_step)
+            if len(new) == 0:
+                break
+            print(whisper(f'  adaptive pass {n+1}: adding {len(new)} points between {new[0]:.1f} and {new[-1]:.1f} eV'))
+            ## rewind below the new points at the slow acceleration, as for a rewind between scans
+            yield from mv(user_ns['dcm_bragg'].acceleration, BMMuser.acc_slow)
+            yield from mv(dcm.energy, new[0]-5)
+            yield from mv(user_ns['dcm_bragg'].acceleration, BMMuser.acc_fast)
+            yield from measure(new, numpy.interp(new, energy_grid, time_grid))
+
+    return (yield from inner())
+
+
+def sorted_run(run):
+    '''Return a copy of a CachedRun with its primary table sorted by
+    energy, for writing the XDI file of an adaptive scan.'''
+    table = run.table().sort_values('dcm_energy', kind='stable')
+    table.index = pandas.RangeIndex(1, len(table)+1, name='seq_num')
+    return CachedRun(run.start, run.stop, run.descriptors, dict(run.tables, primary=table))
@@ -4,6 +4,7 @@ from ophyd.pseudopos import (pseudo_position_argument,
 
 from bluesky.plan_stubs import abs_set, sleep, mv, mvr, null
 
+import numpy
 from numpy import pi, sin, cos, arcsin
 
 from BMM.motors         import FMBOEpicsMotor, VacuumEpicsMotor
@@ -16,6 +17,28 @@ from IPython import get_ipython
 user_ns = get_ipython().user_ns
 
 
+def dcm_angles(energy, twod, offset):
+    '''Convert energy to Bragg angle and to the positions of the
+    parallel and perpendicular motions of the second crystal.  This
+    works equally well for a scalar energy or for an array of
+    energies.  Energies beyond the reach of the crystal return nan.
+
+    Parameters
+    ----------
+    energy : float or array
+        photon energy in eV
+    twod : float
+        2d spacing of the mono crystal in Angstroms
+    offset : float
+        fixed exit offset of the mono in mm
+
+    Returns bragg (in degrees), para, and perp
+    '''
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        angle = arcsin(2*pi*HBARC / (twod * numpy.asarray(energy, dtype=float)))
+        return 180 * angle / pi, offset / (2*sin(angle)), offset / (2*cos(angle))
+
+
 # PV for clearing encoder signal loss
 # XF:06BMA-OP{Mono:DCM1-Ax:Bragg}Mtr_ENC_LSS_CLR_CMD.PROC
 
@@ -181,27 +204,85 @@ class DCM(PseudoPositioner):
         return self._twod * sin(val*pi/180)
 
     def motor_positions(self, energy):
-        wavelength = 2*pi*HBARC / energy
-        angle = arcsin(wavelength / self._twod)
-        bragg = 180 * arcsin(wavelength/self._twod) / pi
-        para  = self.offset / (2*sin(angle))
-        perp  = self.offset / (2*cos(angle))
+        bragg, para, perp = dcm_angles(energy, self._twod, self.offset)
         print(f'for {energy} ev: bragg={bragg:.4f}  para={para:.4f}  perp={perp:.4f}')
-    
+
+    def forward_many(self, energies):
+        '''Batch version of forward.  Convert an entire energy grid to
+        Bragg, para, and perp arrays in one go.  In channel cut mode,
+        para and perp are read once and repeated for every point.
+
+        Returns a dict of numpy arrays with keys energy, bragg, para, perp
+        '''
+        energy = numpy.atleast_1d(numpy.asarray(energies, dtype=float))
+        bragg, para, perp = dcm_angles(energy, self._twod, self.offset)
+        if self._pseudo_channel_cut:
+            para = numpy.full_like(energy, self.para.user_readback.get())
+            perp = numpy.full_like(energy, self.perp.user_readback.get())
+        return {'energy': energy, 'bragg': bragg, 'para': para, 'perp': perp}
+
+    def inverse_many(self, bragg):
+        '''Batch version of inverse.  Convert an array of Bragg angles (in
+        degrees) to an array of energies.'''
+        bragg = numpy.atleast_1d(numpy.asarray(bragg, dtype=float))
+        with numpy.errstate(divide='ignore'):
+            return 2*pi*HBARC/(self._twod*sin(bragg*pi/180))
+
+    def check_trajectory(self, energies, channelcut=None):
+        '''Validate an energy trajectory before any motor moves.  The
+        whole trajectory is computed with forward_many, then checked
+        against the limits of the energy pseudo axis, the reach of the
+        current crystal, and the soft limits of the real motors.  In
+        channel cut mode, para and perp do not move, so are not checked.
+
+        Parameters
+        ----------
+        energies : list or array
+            every energy the scan will visit, including any rewind positions
+        channelcut : bool
+            check as for channel cut mode (True) or fixed exit mode (False)
+            rather than the current mode of the mono
+
+        Returns a list of strings describing the problems found, which
+        is empty if the trajectory is good.
+
+        >>> problems = dcm.check_trajectory(energy_grid)
+        '''
+        traj = self.forward_many(energies)
+        energy, problems = traj['energy'], []
+        if len(energy) == 0:
+            return problems
+        low, high = self.energy.limits
+        if low < high and (energy.min() < low or energy.max() > high):
+            problems.append(f'the trajectory ({energy.min():.1f} to {energy.max():.1f} eV) exceeds the energy limits ({low:.1f} to {high:.1f} eV)')
+        if numpy.isnan(traj['bragg']).any():
+            problems.append(f'{energy[numpy.isnan(traj["bragg"])].min():.1f} eV is below the reach of the Si({self._crystal}) mono')
+        if channelcut is None:
+            channelcut = self._pseudo_channel_cut
+        motors = ('bragg',) if channelcut else ('bragg', 'para', 'perp')
+        for m in motors:
+            low, high = getattr(self, m).limits
+            if low >= high:     # (0,0) means that soft limits are not set
+                continue
+            values = traj[m][~numpy.isnan(traj[m])]
+            bad = (values < low) | (values > high)
+            if bad.any():
+                problems.append(f'{bad.sum()} points put dcm_{m} outside of its limits ({low:.4f} to {high:.4f}), spanning {values.min():.4f} to {values.max():.4f}')
+        return problems
+
 
     @pseudo_position_argument
     def forward(self, pseudo_pos):
         '''Run a forward (pseudo -> real) calculation'''
-        wavelength = 2*pi*HBARC / pseudo_pos.energy
-        angle = arcsin(wavelength / self._twod)
+        bragg, para, perp = dcm_angles(pseudo_pos.energy, self._twod, self.offset)
         if self._pseudo_channel_cut:
-            return self.RealPosition(bragg = 180 * arcsin(wavelength/self._twod) / pi,
+            return self.RealPosition(bragg = float(bragg),
                                      para  = self.para.user_readback.get(),
                                      perp  = self.perp.user_readback.get())
         else:
-            return self.RealPosition(bragg = 180 * arcsin(wavelength/self._twod) / pi,
-                                     para  = self.offset / (2*sin(angle)),
-                                     perp  = self.offset / (2*cos(angle))
+            return self.RealPosition(bragg = float(bragg),
+                                     para  = float(para),
+                                     perp  = float(perp)
                                     )
 
     @real_position_argument
@@ -0,0 +1,100 @@
+import os, copy, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from BMM.functions import error_msg, bold_msg, whisper
+from BMM.runcache  import CachedRun
+from BMM.struck    import dtcorrect_table
+from BMM.xdi       import prepare_XDI, write_XDI_block
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+def recorrected_run(run, dt):
+    '''Return a copy of a CachedRun with its dead time corrected columns
+    recomputed for a dead time of dt nanoseconds, or None if the run
+    has no Struck fluorescence columns.'''
+    table = run.table()
+    corrected = dtcorrect_table(table, dt=dt)
+    if len(corrected) == 0:
+        return None
+    for key, column in corrected.items():
+        table[key] = column
+    start = copy.deepcopy(run.start)
+    try:
+        start['XDI']['Detector']['deadtime_correction'] = f"{start['XDI']['Detector'].get('deadtime_correction', '')} (recorrected, dead time = {dt} ns)".strip()
+    except (KeyError, TypeError):
+        pass
+    return CachedRun(start, run.stop, run.descriptors, dict(run.tables, primary=table))
+
+
+def recorrect_deadtime(uids, dt, folder=None, workers=4):
+    '''Reprocess archived fluorescence runs with a new dead time for the
+    Struck/Vortex dead time correction, writing a new XDI file for each.
+
+    Runs are read concurrently through the run cache, the dead time
+    correction is recomputed with dtcorrect_array over whole columns,
+    and the XDI files are formatted and written by a pool of worker
+    threads.  The header of each new file is made from the run's own
+    start document, not from the current state of the beamline.  The
+    new files are named like the originals, with the dead time
+    appended, e.g. Fe-foil.001 --> Fe-foil_dt300.001
+
+    Parameters
+    ----------
+    uids : list of str
+        uids of the runs to reprocess
+    dt : float
+        dead time in nanoseconds
+    folder : str
+        output folder (default: the recorrected folder in the user's data folder)
+    workers : int
+        number of worker threads for reading and for writing
+
+    Returns the list of files written.
+
+    >>> recorrect_deadtime([uid1, uid2, ...], 300)
+    '''
+    BMMuser, runcache = user_ns['BMMuser'], user_ns['runcache']
+    if folder is None:
+        folder = os.path.join(BMMuser.DATA, 'recorrected')
+    os.makedirs(folder, exist_ok=True)
+
+    start = time.time()
+    written, futures = [], []
+    ## formatting and writing is done in threads, forking the IPython session is not safe
+    ## while the RunEngine, ophyd, and the databroker have threads of their own
+    with ThreadPoolExecutor(max_workers=workers) as readers, \
+         ThreadPoolExecutor(max_workers=workers) as writers:
+        reads = [(u, readers.submit(lambda u: runcache[u], u)) for u in uids]
+        for uid, r in reads:
+            ## a run which cannot be read or recorrected is reported and skipped, the rest continue
+            try:
+                run = r.result()
+                try:
+                    fname = run.start['XDI']['_filename']
+                except (KeyError, TypeError):
+                    fname = run.uid[:8] + '.xdi'
+                base, ext = os.path.splitext(os.path.basename(fname))
+                datafile = os.path.join(folder, f'{base}_dt{dt:g}{ext}')
+                if os.path.isfile(datafile):
+                    print(error_msg('%s already exists!  Skipping....' % datafile))
+                    continue
+                new = recorrected_run(run, dt)
+            except Exception as E:
+                print(error_msg('could not recorrect %s: %s' % (uid, E)))
+                continue
+            if new is None:
+                print(error_msg('%s is not a fluorescence scan with the Struck.  Skipping....' % run.uid))
+                continue
+            futures.append(writers.submit(lambda f, r: write_XDI_block(f, *prepare_XDI(r, archived=True)), datafile, new))
+        for f in as_completed(futures):
+            try:
+                written.append(f.result())
+                print(bold_msg('wrote %s' % written[-1]))
+            except Exception as E:
+                print(error_msg('failed to write a recorrected file: %s' % E))
+
+    elapsed = time.time() - start
+    print(whisper(f"recorrected {len(written)} of {len(uids)} runs in {elapsed:.1f} s, {len(written)/max(elapsed, 1e-6):.2f} runs/sec"))
+    return written
@@ -5,7 +5,7 @@ from cycler import cycler
 import numpy as np
 import warnings
 from numpy import log
-import threading
+import threading, time
 
 #from bluesky.callbacks import CallbackBase
 from bluesky.callbacks.mpl_plotting import QtAwareCallback, initialize_qt_teleporter
@@ -71,7 +71,7 @@ def close_all_plots():
 initialize_qt_teleporter()
 #class DerivedPlot(CallbackBase):
 class DerivedPlot(QtAwareCallback):
-    def __init__(self, func, ax=None, xlabel=None, ylabel=None, title=None, legend_keys=None, stream_name='primary', **kwargs):
+    def __init__(self, func, ax=None, xlabel=None, ylabel=None, title=None, legend_keys=None, stream_name='primary', fps=None, **kwargs):
         """
         func expects an Event document which looks like this:
         {'time': <UNIX epoch>,
@@ -81,12 +81,23 @@ class DerivedPlot(QtAwareCallback):
          'filled': {}  # only important if you have big array data
         }
         and should return (x, y)
+
+        fps sets the rendering mode.  If None (the default), the plot
+        is rescaled and redrawn at every event.  Otherwise, points are
+        collected into a growing numpy buffer and redraws are coalesced
+        to at most fps frames per second.  When a new point falls within
+        the current axes limits, only the line is redrawn by blitting,
+        otherwise the axes are rescaled and the whole canvas is redrawn.
+        When rescaling, the x axis is extended ahead of the data by
+        headroom (a fraction of its span) in the direction x is moving,
+        so that the points which follow, as in a time scan, still fall
+        within the limits and are blitted.
         """
         super().__init__()
         self.__setup_lock = threading.Lock()
         self.__setup_event = threading.Event()
         def setup():
-            nonlocal func, ax, xlabel, ylabel, title, legend_keys, stream_name, kwargs
+            nonlocal func, ax, xlabel, ylabel, title, legend_keys, stream_name, fps, kwargs
             BMMuser = user_ns['BMMuser']    
             with self.__setup_lock:
                 if self.__setup_event.is_set():
@@ -123,17 +134,37 @@ class DerivedPlot(QtAwareCallback):
             self.legend_title = " :: ".join([name for name in self.legend_keys])
             self.stream_name = stream_name
             self.descriptors = {}
+            self.fps = fps
+            self.background = None
+            self.current_line = None
+            self.headroom = 0.25
+            self.timer = None
+            if fps is not None:
+                self.ax.figure.canvas.mpl_connect('draw_event', self.__grab_background)
+                self.timer = self.ax.figure.canvas.new_timer(interval=int(1000/fps))
+                self.timer.single_shot = True
+                self.timer.add_callback(self.render)
         self.__setup = setup
 
+    def __grab_background(self, ev):
+        '''After every full draw, save the axes without the current line for blitting.'''
+        if self.current_line is None:
+            return
+        self.background = self.ax.figure.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.current_line)
+        self.ax.figure.canvas.blit(self.ax.bbox)
+
     def start(self, doc):
         self.__setup()
         # The doc is not used; we just use the signal that a new run began.
         self.x_data, self.y_data = [], []
+        self.buffer, self.npoints, self.drawn, self.last_draw = np.empty((256, 2)), 0, 0, 0
+        self.timer_active = False
         self.descriptors.clear()
         label = " :: ".join(
             [str(doc.get(name, name)) for name in self.legend_keys])
         kwargs = ChainMap(self.kwargs, {'label': label})
-        self.current_line, = self.ax.plot([], [], **kwargs)
+        self.current_line, = self.ax.plot([], [], animated=self.fps is not None, **kwargs)
         self.lines.append(self.current_line)
         self.legend = self.ax.legend(
             loc=0, title=self.legend_title).set_draggable(True)
@@ -148,13 +179,103 @@ class DerivedPlot(QtAwareCallback):
             # This is from some other event stream and we should ignore it.
             return
         x, y = self.func(doc)
-        self.y_data.append(y)
-        self.x_data.append(x)
-        self.current_line.set_data(self.x_data, self.y_data)
-        # Rescale and redraw.
-        self.ax.relim(visible_only=True)
-        self.ax.autoscale_view(tight=True)
-        self.ax.figure.canvas.draw_idle()
+        if self.fps is None:
+            self.y_data.append(y)
+            self.x_data.append(x)
+            self.current_line.set_data(self.x_data, self.y_data)
+            # Rescale and redraw.
+            self.ax.relim(visible_only=True)
+            self.ax.autoscale_view(tight=True)
+            self.ax.figure.canvas.draw_idle()
+            return
+
+        if self.npoints == len(self.buffer):
+            self.buffer = np.concatenate((self.buffer, np.empty_like(self.buffer)))
+        self.buffer[self.npoints] = (x, y)
+        self.npoints += 1
+        if time.monotonic() - self.last_draw >= 1.0/self.fps:
+            self.render()
+        elif not self.timer_active:
+            ## make sure the trailing points get drawn if no more events arrive soon
+            self.timer_active = True
+            self.timer.start()
+
+    def render(self):
+        '''Draw all buffered points, blitting if the new points fit within the current axes limits.'''
+        self.timer_active = False
+        self.last_draw = time.monotonic()
+        if self.npoints == self.drawn:
+            return
+        data = self.buffer[:self.npoints]
+        new = self.buffer[self.drawn:self.npoints]
+        self.current_line.set_data(data[:,0], data[:,1])
+        (x0, x1), (y0, y1) = sorted(self.ax.get_xlim()), sorted(self.ax.get_ylim())
+        inside = (self.drawn > 1 and
+                  np.all((new[:,0] >= x0) & (new[:,0] <= x1) & (new[:,1] >= y0) & (new[:,1] <= y1)))
+        self.drawn = self.npoints
+        canvas = self.ax.figure.canvas
+        if inside and self.background is not None:
+            canvas.restore_region(self.background)
+            self.ax.draw_artist(self.current_line)
+            canvas.blit(self.ax.bbox)
+        else:
+            self.ax.relim(visible_only=True)
+            self.ax.autoscale_view(tight=True)
+            self.__headroom(data)
+            canvas.draw_idle()
+
+    def __headroom(self, data):
+        '''Extend the x axis beyond the newest point in the direction x is moving.'''
+        if len(data) < 2 or not self.headroom:
+            return
+        x0, x1 = sorted(self.ax.get_xlim())
+        pad = self.headroom * (x1 - x0)
+        ## auto=None leaves autoscaling on, so the axes are still rescaled when a point falls outside
+        if data[-1,0] > data[-2,0]:
+            self.ax.set_xlim(x0, x1 + pad, auto=None)
+        elif data[-1,0] < data[-2,0]:
+            self.ax.set_xlim(x0 - pad, x1, auto=None)
 
     def stop(self, doc):
+        if self.fps is not None:
+            if self.timer is not None:
+                self.timer.stop()
+            self.render()
+            ## leave a normal, non-animated line in the plot when the scan is done
+            self.current_line.set_animated(False)
+            self.ax.figure.canvas.draw_idle()
         super().stop(doc)
+
+
+def benchmark_derivedplot(npoints=2000, fps=10):
+    '''Measure how many event documents per second can be sustained by
+    a DerivedPlot, compared to no plot at all.
+
+    Synthetic documents are pushed through the callback as fast as
+    possible, first with no plot, then with the legacy redraw-every-
+    event mode, then with the batched mode at the given frame rate.
+    '''
+    func = lambda doc: (doc['data']['x'], doc['data']['y'])
+    start = {'uid': 'benchmark', 'time': time.time(), 'scan_id': 0}
+    descriptor = {'uid': 'benchmark-primary', 'name': 'primary', 'run_start': 'benchmark', 'data_keys': {}}
+    events = [{'descriptor': 'benchmark-primary', 'seq_num': i+1, 'time': time.time(),
+               'data': {'x': float(i), 'y': np.sin(i/50.)}, 'timestamps': {}}
+              for i in range(npoints)]
+
+    t0 = time.monotonic()
+    for ev in events:
+        func(ev)
+    bare = npoints / max(time.monotonic() - t0, 1e-9)
+    print(f'no plot         : {bare:12.0f} events/sec')
+
+    for label, rate in (('every event', None), (f'{fps} frames/sec', fps)):
+        plot = DerivedPlot(func, xlabel='x', ylabel='y', title=f'benchmark: {label}', fps=rate)
+        plot('start', start)
+        plot('descriptor', descriptor)
+        t0 = time.monotonic()
+        for ev in events:
+            plot('event', ev)
+            plot.ax.figure.canvas.flush_events()   # let any pending redraw happen, as the GUI would
+        elapsed = time.monotonic() - t0
+        plot('stop', {'uid': 'benchmark-stop', 'run_start': 'benchmark', 'time': time.time(), 'exit_status': 'success'})
+        print(f'{label:16s}: {npoints/elapsed:12.0f} events/sec')
@@ -1,22 +1,70 @@
+import time
 from ophyd import PVPositionerPC, EpicsSignal, EpicsSignalRO, PseudoPositioner, PseudoSingle
 from ophyd import Component as Cpt
+from ophyd.status import MoveStatus
 from ophyd.pseudopos import (pseudo_position_argument,
                              real_position_argument)
 from BMM.metadata import bmm_metadata
 
-class QuadEMDwellTime(PVPositionerPC):
+class DwellTimePositioner(PVPositionerPC):
+    '''A dwell time PV which is not written when it already holds the
+    requested value.  In a step scan, the dwell time is usually the same
+    from point to point, so most moves return a finished status at
+    once, saving a put-with-callback per detector per point.
+
+    Attributes
+    ----------
+    tolerance : float
+        setpoints closer than this to the requested value are left alone
+    moves : int
+        number of moves actually made
+    skipped : int
+        number of moves skipped because the value was unchanged
+    elapsed : float
+        total time spent in the moves actually made
+    '''
+    tolerance = 1e-6
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.moves, self.skipped, self.elapsed = 0, 0, 0.0
+
+    def move(self, position, wait=True, timeout=None, moved_cb=None):
+        try:
+            unchanged = abs(self.setpoint.get() - position) <= self.tolerance
+        except TypeError:
+            unchanged = False
+        if unchanged:
+            self.skipped += 1
+            status = MoveStatus(self, position)
+            status.set_finished()
+            if moved_cb is not None:
+                moved_cb(obj=self)
+            return status
+        t0 = time.time()
+        status = super().move(position, wait=wait, timeout=timeout, moved_cb=moved_cb)
+        def count(status):
+            self.moves += 1
+            self.elapsed += time.time() - t0
+        status.add_callback(count)
+        return status
+
+class QuadEMDwellTime(DwellTimePositioner):
     setpoint = Cpt(EpicsSignal,   'AveragingTime')
     readback = Cpt(EpicsSignalRO, 'AveragingTime_RBV')
 
-class StruckDwellTime(PVPositionerPC):
+class StruckDwellTime(DwellTimePositioner):
     setpoint = Cpt(EpicsSignal,   'TP')
     readback = Cpt(EpicsSignalRO, 'TP')
 
-class DualEMDwellTime(PVPositionerPC):
+class DualEMDwellTime(DwellTimePositioner):
     setpoint = Cpt(EpicsSignal,   'AveragingTime')
     readback = Cpt(EpicsSignalRO, 'AveragingTime_RBV')
     
-class Xspress3DwellTime(PVPositionerPC):
+class Xspress3DwellTime(DwellTimePositioner):
     setpoint = Cpt(EpicsSignal,   'AcquireTime')
     readback = Cpt(EpicsSignalRO, 'AcquireTime_RBV')
     
@@ -50,7 +98,12 @@ def test_dwelltimes(dt, md=None):
 
 
 class LockedDwellTimes(PseudoPositioner):
-    "Sync QuadEM, Struck, DualEM, and Xspress3 dwell times to one pseudo-axis dwell time."
+    """Sync QuadEM, Struck, DualEM, and Xspress3 dwell times to one pseudo-axis dwell time.
+
+    The real dwell times are moved concurrently, under a single status,
+    and only those whose value changes are actually written.  Use
+    stats() to see how many writes were saved.
+    """
     dwell_time = Cpt(PseudoSingle, kind='hinted')
     if user_ns['with_quadem'] is True:
         quadem_dwell_time = Cpt(QuadEMDwellTime, 'XF:06BM-BI{EM:1}EM180:', egu='seconds') # main ion chambers
@@ -60,52 +113,31 @@ class LockedDwellTimes(PseudoPositioner):
         dualem_dwell_time = Cpt(DualEMDwellTime, 'XF:06BM-BI{EM:3}EM180:', egu='seconds') # new I0 chamber
     if user_ns['with_xspress3'] is True:
         xspress3_dwell_time = Cpt(Xspress3DwellTime, 'XF:06BM-ES{Xsp:1}:', egu='seconds') # Xspress3
-    
+
+    def __init__(self, *args, concurrent=True, **kwargs):
+        super().__init__(*args, concurrent=concurrent, **kwargs)
+
     @property
     def settle_time(self):
         return self.quadem_dwell_time.settle_time
 
     @settle_time.setter
     def settle_time(self, val):
-        if 'quadem_dwell_time' in self.read_attrs:
-            self.quadem_dwell_time.settle_time = val
-        if 'struck_dwell_time' in self.read_attrs:
-            self.struck_dwell_time.settle_time = val
-        if 'dualem_dwell_time' in self.read_attrs:
-            self.dualem_dwell_time.settle_time = val
-        if 'xspress3_dwell_time' in self.read_attrs:
-            self.xspress3_dwell_time.settle_time = val
+        for real in self._real:
+            real.settle_time = val
+
+    def stats(self):
+        """Return a dict of moves made, moves skipped, and time spent moving
+        for each real dwell time."""
+        return {real.attr_name: {'moves': real.moves, 'skipped': real.skipped, 'elapsed': real.elapsed} for real in self._real}
+
+    def reset_stats(self):
+        for real in self._real:
+            real.reset_stats()
 
     @pseudo_position_argument
     def forward(self, pseudo_pos):
-        #pseudo_pos = self.PseudoPosition(*pseudo_pos)
-        #print('forward %s'% pseudo_pos)
-            
-        if 'xspress3_dwell_time' in self.read_attrs and 'dualem_dwell_time' in self.read_attrs:
-            return self.RealPosition(
-                quadem_dwell_time=pseudo_pos.dwell_time,
-                struck_dwell_time=pseudo_pos.dwell_time,
-                dualem_dwell_time=pseudo_pos.dwell_time,
-                xspress3_dwell_time=pseudo_pos.dwell_time,
-            )
-        elif 'xspress3_dwell_time' in self.read_attrs:
-            return self.RealPosition(
-                quadem_dwell_time=pseudo_pos.dwell_time,
-                struck_dwell_time=pseudo_pos.dwell_time,
-                xspress3_dwell_time=pseudo_pos.dwell_time,
-            )
-        elif 'dualem_dwell_time' in self.read_attrs:
-            return self.RealPosition(
-                quadem_dwell_time=pseudo_pos.dwell_time,
-                struck_dwell_time=pseudo_pos.dwell_time,
-                dualem_dwell_time=pseudo_pos.dwell_time,
-            )
-        else:
-            return self.RealPosition(
-                quadem_dwell_time=pseudo_pos.dwell_time,
-                struck_dwell_time=pseudo_pos.dwell_time,
-            )
-            
+        return self.RealPosition(**{real.attr_name: pseudo_pos.dwell_time for real in self._real})
 
     @real_position_argument
     def inverse(self, real_pos):
@@ -0,0 +1,460 @@
+import threading, time
+import numpy
+
+from ophyd import Signal
+from ophyd.status import DeviceStatus, Status
+
+from bluesky.plans import fly
+from bluesky.plan_stubs import mv, null
+from bluesky.preprocessors import finalize_wrapper
+
+from BMM.dcm           import dcm_angles
+from BMM.functions     import HBARC, countdown, plotting_mode
+from BMM.functions     import error_msg, info_msg, whisper
+from BMM.logging       import BMM_log_info, report
+from BMM.metadata      import bmm_metadata, metadata_at_this_moment
+from BMM.periodictable import edge_energy
+from BMM.suspenders    import BMM_clear_to_start
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+class SignalBuffer():
+    '''Accumulate the time-stamped updates of a signal while it is
+    subscribed.  Storage is preallocated and doubled as needed, as in
+    RunBuffer.
+
+    >>> buffer = SignalBuffer(quadem1.I0, 'I0')
+    >>> buffer.start()
+    >>> ...
+    >>> buffer.stop()
+    >>> times, values = buffer.arrays()
+
+    Attributes
+    ----------
+    signal : ophyd Signal
+        the signal to monitor
+    name : str
+        data key for the buffered values
+    '''
+    def __init__(self, signal, name=None, size=4096):
+        self.signal  = signal
+        self.name    = name or signal.name
+        self.count   = 0
+        self.__times  = numpy.zeros(size, dtype=numpy.float64)
+        self.__values = numpy.zeros(size, dtype=numpy.float64)
+        self.__lock   = threading.Lock()
+        self.__token  = None
+
+    def _update(self, value=None, timestamp=None, **kwargs):
+        with self.__lock:
+            i = self.count
+            if i == len(self.__times):
+                self.__times  = numpy.resize(self.__times,  2*i)
+                self.__values = numpy.resize(self.__values, 2*i)
+            self.__times[i]  = timestamp if timestamp is not None else time.time()
+            self.__values[i] = value
+            self.count = i + 1
+
+    def start(self):
+        with self.__lock:
+            self.count = 0
+        self.__token = self.signal.subscribe(self._update, run=False)
+
+    def stop(self):
+        if self.__token is not None:
+            self.signal.unsubscribe(self.__token)
+            self.__token = None
+
+    def arrays(self):
+        '''Return copies of the buffered time stamps and values.'''
+        with self.__lock:
+            return self.__times[:self.count].copy(), self.__values[:self.count].copy()
+
+
+class BMMEnergyFlyer():
+    '''An ophyd flyer for a continuous energy scan.  The Bragg axis is
+    moved at constant angular velocity while the updates of the
+    detector signals, and of the Bragg readback itself, are buffered
+    with their time stamps.
+
+    Each buffered signal becomes its own event stream, named
+    <key>_monitor, with a single data key.  The Bragg readback is in
+    the stream dcm_bragg_monitor.  The streams are put onto a common
+    energy grid after the scan, see BMM.rebin.  collect_pages hands the
+    RunEngine each stream as event pages of up to page_size points,
+    collect yields single events for a RunEngine which does not ask for
+    pages.
+
+    If an electrometer is given, its averaging time is set to the frame
+    time for the duration of the scan.  If an Xspress3 is given, it is
+    set to acquire frames of the frame time, internally triggered, for
+    the duration of the scan, so that its ROI values update once per
+    frame.  Both are put back as they were when the scan completes.
+
+    >>> flyer = BMMEnergyFlyer(dcm_bragg, {'I0': quadem1.I0, 'It': quadem1.It}, quadem=quadem1)
+    >>> flyer.configure(start, end, velocity, frame_time=0.05)
+    >>> uid = yield from fly([flyer])
+
+    Attributes
+    ----------
+    bragg : motor
+        the Bragg motor, or a simulated stand-in
+    signals : dict
+        data key -> signal for each detector signal to buffer
+    start, end : float
+        Bragg angles, in degrees, at the beginning and end of the slew
+    velocity : float
+        angular velocity of the slew in degrees per second
+    frame_time : float
+        averaging time of the electrometer and frame time of the Xspress3
+    page_size : int
+        largest number of points in an event page from collect_pages
+    '''
+    def __init__(self, bragg, signals, quadem=None, xspress3=None, name='dcm_flyer', page_size=1024):
+        self.name       = name
+        self.parent     = None
+        self.bragg      = bragg
+        self.signals    = signals
+        self.quadem     = quadem
+        self.xspress3   = xspress3
+        self.start      = None
+        self.end        = None
+        self.velocity   = None
+        self.frame_time = 0.05
+        self.page_size  = page_size
+        self.buffers    = []
+        self.__saved    = dict()
+        self.__status   = None
+
+    def configure(self, start, end, velocity, frame_time=0.05):
+        self.start, self.end, self.velocity, self.frame_time = start, end, velocity, frame_time
+
+    def read_configuration(self):
+        return {}
+
+    def describe_configuration(self):
+        return {}
+
+    def _arm(self):
+        self.__saved = {self.bragg.velocity: self.bragg.velocity.get()}
+        if self.quadem is not None:
+            self.__saved[self.quadem.averaging_time] = self.quadem.averaging_time.get()
+            self.quadem.averaging_time.put(self.frame_time)
+        if self.xspress3 is not None:
+            s = self.xspress3.settings
+            for sig in (s.acquire_time, s.num_images, s.trigger_mode):
+                self.__saved[sig] = sig.get()
+            nframes = int(abs(self.end - self.start) / self.velocity / self.frame_time) + 10
+            s.acquire_time.put(self.frame_time)
+            s.num_images.put(nframes)
+            s.trigger_mode.put(1)    # internal
+        self.bragg.velocity.put(self.velocity)
+
+    def _disarm(self):
+        if self.xspress3 is not None:
+            self.xspress3.settings.acquire.put(0)
+        for sig, value in self.__saved.items():
+            sig.put(value)
+        self.__saved = dict()
+
+    def kickoff(self):
+        '''Begin buffering, then begin the slew.'''
+        if self.start is None:
+            raise RuntimeError('BMMEnergyFlyer must be configured before kickoff')
+        self._arm()
+        self.buffers = [SignalBuffer(self.bragg.user_readback, 'dcm_bragg')]
+        self.buffers.extend(SignalBuffer(sig, key) for key, sig in self.signals.items())
+        for b in self.buffers:
+            b.start()
+        if self.xspress3 is not None:
+            self.xspress3.settings.acquire.put(1)
+        self.__status = self.bragg.set(self.end)
+        kickoff_status = DeviceStatus(self)
+        kickoff_status.set_finished()
+        return kickoff_status
+
+    def complete(self):
+        '''Return a status which finishes when the slew is done and the
+        detectors have been put back.'''
+        status = DeviceStatus(self)
+        def finish(move_status):
+            self.stop()
+            if move_status.success:
+                status.set_finished()
+            else:
+                status.set_exception(RuntimeError('the Bragg slew did not complete'))
+        self.__status.add_callback(finish)
+        return status
+
+    def stop(self, success=False):
+        '''Stop the slew if it is still moving, stop buffering, then put
+        the velocity and the detectors back as they were.'''
+        if self.__status is not None and not self.__status.done:
+            self.bragg.stop()
+        for b in self.buffers:
+            b.stop()
+        if self.__saved:
+            self._disarm()
+
+    def describe_collect(self):
+        return {f'{b.name}_monitor': {b.name: {'source': getattr(b.signal, 'pvname', b.signal.name),
+                                               'dtype': 'number', 'shape': []}}
+                for b in self.buffers}
+
+    def collect(self):
+        for b in self.buffers:
+            times, values = b.arrays()
+            for t, v in zip(times, values):
+                yield {'time': t, 'data': {b.name: v}, 'timestamps': {b.name: t}}
+
+    def collect_pages(self):
+        for b in self.buffers:
+            times, values = b.arrays()
+            for i in range(0, len(times), self.page_size):
+                t = times[i:i+self.page_size]
+                yield {'time': t, 'data': {b.name: values[i:i+self.page_size]}, 'timestamps': {b.name: t}}
+
+    def collect_tables(self):
+        '''Return the buffers as a dict of (times, values) keyed by data
+        key, the same content as the streams made by collect.'''
+        return {b.name: b.arrays() for b in self.buffers}
+
+
+def fly_grid(e0, bounds, duration, twod, acceleration=0.5, margin=5):
+    '''Compute the Bragg angles and angular velocity for a slew from
+    e0+bounds[0] to e0+bounds[1] taking duration seconds.  The slew
+    begins and ends margin eV beyond the range, plus enough for the
+    Bragg axis to reach full speed, so that the whole range is measured
+    at constant velocity.
+
+    Returns (start, end, velocity), with the angles in degrees.
+    '''
+    low, high = e0 + bounds[0] - margin, e0 + bounds[1] + margin
+    theta_low, theta_high = (float(a) for a in dcm_angles(numpy.array([low, high]), twod, 30)[0])
+    velocity = abs(theta_low - theta_high) / duration
+    runup    = velocity * acceleration
+    ## Bragg angle decreases as energy increases
+    return theta_low + runup, theta_high - runup, velocity
+
+
+def fly_xafs(element=None, edge='K', bounds=(-30, 80), duration=20, mode='transmission', frame_time=0.05,
+             sample='', prep='', comment='', force=False, md={}):
+    '''Measure a continuous energy scan, with the Bragg axis moving at
+    constant angular velocity while the electrometer and the Xspress3
+    buffer time-stamped data.  The mono is put in pseudo channel cut
+    mode, so only the Bragg axis moves.
+
+    Parameters
+    ----------
+    element : str
+        absorber element (default: BMMuser.element)
+    edge : str
+        absorption edge
+    bounds : tuple
+        beginning and end of the scan relative to the edge energy, in eV
+    duration : float
+        time in seconds to slew through the range
+    mode : str
+        transmission, reference, or xs (fluorescence with the
+        Struck/Vortex is not possible, its channels are not buffered)
+    frame_time : float
+        averaging time of the electrometer and frame time of the Xspress3
+    force : bool
+        flag for forcing a scan even if not clear to start
+
+    Use rebin() from BMM.rebin to put the measurement on a conventional
+    energy grid and write an XDI file.
+
+    >>> RE(fly_xafs('Fe', bounds=(-30, 80), duration=20))
+    '''
+    BMMuser, dcm, dcm_bragg, quadem1 = user_ns['BMMuser'], user_ns['dcm'], user_ns['dcm_bragg'], user_ns['quadem1']
+    if element is None:
+        element = BMMuser.element
+
+    ######################################################################
+    # this is a tool for verifying a macro.  this replaces an xafs scan  #
+    # with a sleep, allowing the user to easily map out motor motions in #
+    # a macro                                                            #
+    if BMMuser.macro_dryrun:
+        print(info_msg('\nBMMuser.macro_dryrun is True.  Sleeping for %.1f seconds rather than running a fly scan.\n' %
+                       BMMuser.macro_sleep))
+        countdown(BMMuser.macro_sleep)
+        return(yield from null())
+    ######################################################################
+
+    (ok, text) = BMM_clear_to_start()
+    if force is False and ok is False:
+        print(error_msg(text))
+        return(yield from null())
+
+    thismode = plotting_mode(mode)
+    if thismode == 'fluo':
+        print(error_msg('Fly scans cannot be measured in fluorescence with the Struck/Vortex, use the Xspress3 or transmission'))
+        return(yield from null())
+
+    e0 = edge_energy(element, edge)
+    start, end, velocity = fly_grid(e0, bounds, duration, dcm._twod, acceleration=BMMuser.acc_fast)
+    ## the move to the middle of the range is made in fixed exit mode, the
+    ## slew in channel cut mode, where only the Bragg axis moves
+    problems = dcm.check_trajectory([e0 + (bounds[0]+bounds[1])/2], channelcut=False) + \
+        dcm.check_trajectory(dcm.inverse_many([start, end]), channelcut=True)
+    if len(problems) > 0:
+        for problem in problems:
+            print(error_msg(f'The DCM trajectory for this fly scan is not possible: {problem}'))
+        return(yield from null())
+
+    signals = {'I0': quadem1.I0, 'It': quadem1.It, 'Ir': quadem1.Ir}
+    xs = None
+    if thismode == 'xs':
+        xs = user_ns['xs']
+        for n in range(1, 5):
+            if getattr(BMMuser, f'xschannel{n}', None) is not None:
+                signals[getattr(BMMuser, f'xs{n}')] = getattr(BMMuser, f'xschannel{n}')
+    flyer = BMMEnergyFlyer(dcm_bragg, signals, quadem=quadem1, xspress3=xs)
+    flyer.configure(start, end, velocity, frame_time=frame_time)
+
+    def main_plan():
+        ## move to the middle of the range in fixed exit mode, then hold para and perp
+        dcm.mode = 'fixed'
+        yield from mv(dcm.energy, e0 + (bounds[0]+bounds[1])/2)
+        dcm.mode = 'channelcut'
+        yield from mv(dcm_bragg, start)
+
+        xdi = bmm_metadata(measurement   = mode,
+                           experimenters = BMMuser.experimenters,
+                           edge          = edge,
+                           element       = element,
+                           edge_energy   = e0,
+                           direction     = 1,
+                           scantype      = 'slew',
+                           channelcut    = True,
+                           mono          = 'Si(%s)' % dcm._crystal,
+                           sample        = sample,
+                           prep          = prep,
+                           mode          = mode,
+                           comment       = comment,)
+        rightnow = metadata_at_this_moment()
+        for family in rightnow.keys():
+            if type(rightnow[family]) is dict:
+                if family not in xdi:
+                    xdi[family] = dict()
+                for k in rightnow[family].keys():
+                    xdi[family][k] = rightnow[family][k]
+        xdi['_kind'] = 'fly'
+        fly_md = {'XDI': xdi, 'plan_name': 'fly_xafs', 'e0': e0, 'bounds': list(bounds), 'duration': duration,
+                  'velocity': velocity, 'frame_time': frame_time, **md}
+
+        report(f'fly scan of {element} {edge}, {bounds[0]} to {bounds[1]} eV in {duration} seconds', level='bold', slack=True)
+        BMM_log_info(f'fly scan: Bragg {start:.4f} to {end:.4f} at {velocity:.5f} deg/sec, frame time {frame_time} sec')
+        uid = yield from fly([flyer], md=fly_md)
+        return uid
+
+    def cleanup_plan():
+        flyer.stop()
+        dcm.mode = 'fixed'
+        yield from null()
+
+    return (yield from finalize_wrapper(main_plan(), cleanup_plan()))
+
+
+## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+## simulated devices for exercising BMMEnergyFlyer without a beamline
+
+class SimulatedBragg():
+    '''A stand-in for dcm_bragg which moves at its velocity signal,
+    updating its readback signal at rate Hz from a thread.'''
+    def __init__(self, position=20.0, velocity=0.5, rate=50):
+        self.name          = 'dcm_bragg'
+        self.rate          = rate
+        self.user_readback = Signal(name='dcm_bragg', value=position)
+        self.velocity      = Signal(name='dcm_bragg_velocity', value=velocity)
+        self.acceleration  = Signal(name='dcm_bragg_acceleration', value=0.25)
+        self.__stopping    = threading.Event()
+
+    def position(self):
+        return self.user_readback.get()
+
+    def set(self, target):
+        status = Status()
+        self.__stopping.clear()
+        def move():
+            here = self.user_readback.get()
+            t0, duration = time.time(), abs(target - here) / self.velocity.get()
+            while True:
+                elapsed = time.time() - t0
+                if elapsed >= duration:
+                    break
+                if self.__stopping.is_set():
+                    status.set_exception(RuntimeError('dcm_bragg was stopped'))
+                    return
+                self.user_readback.put(here + (target-here)*elapsed/duration, timestamp=time.time())
+                time.sleep(1/self.rate)
+            self.user_readback.put(target, timestamp=time.time())
+            status.set_finished()
+        threading.Thread(target=move, daemon=True).start()
+        return status
+
+    def stop(self, success=False):
+        self.__stopping.set()
+
+
+class SimulatedDetector():
+    '''A free-running stand-in for a detector signal, updated every
+    period seconds with func(energy) at the energy of the simulated
+    Bragg axis.'''
+    def __init__(self, name, func, bragg, twod, period=0.05):
+        self.signal  = Signal(name=name, value=0.0)
+        self.func    = func
+        self.bragg   = bragg
+        self.twod    = twod
+        self.period  = period
+        self.running = True
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def __run(self):
+        while self.running:
+            energy = 2*numpy.pi*HBARC / (self.twod*numpy.sin(numpy.radians(self.bragg.position())))
+            self.signal.put(float(self.func(energy)), timestamp=time.time())
+            time.sleep(self.period)
+
+    def stop(self):
+        self.running = False
+
+
+def check_fly(e0=7112, bounds=(-30, 80), duration=5, frame_time=0.02, twod=6.2712):
+    '''Run BMMEnergyFlyer against simulated devices, without a
+    RunEngine, and check the buffered data.  The simulated sample is an
+    arctangent edge at e0.
+
+    Returns a dict with the buffered (times, values) for each stream,
+    the measured energy range, and the number of detector frames.
+    '''
+    start, end, velocity = fly_grid(e0, bounds, duration, twod, acceleration=0.25)
+    bragg = SimulatedBragg(position=start)
+    mu    = lambda e: 1.5 + numpy.arctan((e-e0)/2)/numpy.pi
+    i0    = SimulatedDetector('I0', lambda e: 100.0,                  bragg, twod, frame_time)
+    it    = SimulatedDetector('It', lambda e: 100.0*numpy.exp(-mu(e)), bragg, twod, frame_time)
+    flyer = BMMEnergyFlyer(bragg, {'I0': i0.signal, 'It': it.signal})
+    flyer.configure(start, end, velocity, frame_time=frame_time)
+
+    t0 = time.time()
+    flyer.kickoff().wait()
+    flyer.complete().wait(timeout=2*duration + 10)
+    elapsed = time.time() - t0
+    for d in (i0, it):
+        d.stop()
+
+    tables = flyer.collect_tables()
+    assert set(flyer.describe_collect()) == {'dcm_bragg_monitor', 'I0_monitor', 'It_monitor'}
+    assert sum(1 for _ in flyer.collect()) == sum(len(t) for t, v in tables.values())
+    assert sum(len(p['time']) for p in flyer.collect_pages()) == sum(len(t) for t, v in tables.values())
+    times, bragg_values = tables['dcm_bragg']
+    assert numpy.all(numpy.diff(times) >= 0), 'Bragg time stamps are not monotonic'
+    assert numpy.all(numpy.diff(bragg_values) <= 0), 'Bragg angle did not decrease monotonically'
+    energy = 2*numpy.pi*HBARC / (twod*numpy.sin(numpy.radians(bragg_values)))
+    assert energy[0] <= e0+bounds[0] and energy[-1] >= e0+bounds[1], 'the slew did not cover the range'
+    assert bragg.velocity.get() == 0.5, 'the Bragg velocity was not restored'
+    print(whisper(f'simulated fly scan: {len(tables["I0"][0])} frames, {energy[0]:.1f} to {energy[-1]:.1f} eV in {elapsed:.1f} s'))
+    return {'tables': tables, 'energy': (energy[0], energy[-1]), 'frames': len(tables['I0'][0]), 'elapsed': elapsed}
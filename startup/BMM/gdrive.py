@@ -32,10 +32,8 @@ def synch_gdrive_folder(prefix=''):
     BMMuser = user_ns['BMMuser']
     print(f'{prefix}updating {gdrive_folder}')
     user_gdrive_folder = os.path.join(gdrive_folder, 'Data', BMMuser.name, BMMuser.date)
-    here = os.getcwd()
-    os.chdir(user_gdrive_folder)
-    subprocess.run(['/home/xf06bm/gopath/bin/drive', 'push', '-quiet', '.']) 
-    os.chdir(here)
+    ## use cwd rather than os.chdir, this may be called from a worker thread (see BMM/postprocess.py)
+    subprocess.run(['/home/xf06bm/gopath/bin/drive', 'push', '-quiet', '.'], cwd=user_gdrive_folder)
     return()
 
 def make_gdrive_folder(prefix='', update=True):
@@ -16,20 +16,187 @@
 ##                           Ovid, Metamorphosis
 ##                           Book II:531-565
 
-import numpy, os
+import numpy, os, json, hashlib, threading, time
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import larch
 from larch import (Group, Parameter, isParameter, param_value, isNamedClass, Interpreter) 
 from larch.xafs import (find_e0, pre_edge, autobk, xftf, xftr)
 from larch.io import create_athena
+from larch.io.athena_project import make_athena_args
 import larch.utils.show as lus
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 
 from BMM.functions import etok, ktoe
+from BMM.larchprep import prep_group, group_attributes, process_xmu, interpreter, LARCH_LOCK
 
 from IPython import get_ipython
 user_ns = get_ipython().user_ns
 
-LARCH = Interpreter()
+LARCH = interpreter()
+
+
+class LarchCache():
+    '''An on-disk cache of processed Larch groups, so that plotting or
+    merging the same data again costs a file read rather than another
+    round of find_e0, pre_edge, autobk, and xftf.
+
+    Entries are addressed by a hash of the uid, the measurement mode,
+    the pre-edge, background, and Fourier transform parameters as
+    supplied by the user, and the version of Larch.  Each entry is an
+    npz file containing the array attributes of the group and of its
+    *_details subgroups, with the scalar attributes and the parameters
+    stored as JSON.  The most recently used entries are also kept in
+    memory.
+
+    Entries not used in max_age days are removed from disk, as are the
+    least recently used entries whenever the files on disk come to more
+    than max_size bytes.  This is checked at startup and after every
+    100 new entries.
+
+    Attributes
+    ----------
+    folder : str
+        location of the cache files
+    size : int
+        number of entries kept in memory
+    max_size : int
+        largest number of bytes kept on disk
+    max_age : float
+        number of days an unused entry is kept on disk
+    hits, misses : int
+        cache statistics
+    '''
+    def __init__(self, folder=None, size=64, max_size=2**30, max_age=90):
+        if folder is None:
+            folder = os.path.join(os.getenv('HOME'), '.cache', 'BMM', 'larch')
+        self.folder   = folder
+        self.size     = size
+        self.max_size = max_size
+        self.max_age  = max_age
+        self.hits     = 0
+        self.misses   = 0
+        self.__memory = OrderedDict()
+        self.__lock   = threading.Lock()
+        self.__puts   = 0
+        self.prune()
+
+    def key(self, uid, mode, pre, bkg, fft):
+        text = json.dumps({'uid': uid, 'mode': mode, 'pre': pre, 'bkg': bkg, 'fft': fft, 'larch': larch.__version__},
+                          sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.folder, key[:2], key + '.npz')
+
+    def get(self, key):
+        '''Return (attributes, parameters) for a cache entry or None.'''
+        with self.__lock:
+            if key in self.__memory:
+                self.__memory.move_to_end(key)
+                self.hits += 1
+                return self.__memory[key]
+        fname = self.filename(key)
+        if not os.path.isfile(fname):
+            self.misses += 1
+            return None
+        try:
+            with numpy.load(fname, allow_pickle=False) as npz:
+                attributes = {k: npz[k] for k in npz.files if k != '__meta__'}
+                meta = json.loads(str(npz['__meta__']))
+            os.utime(fname)     # mark it as recently used, see prune
+        except Exception:
+            self.misses += 1
+            return None
+        attributes.update(meta['scalars'])
+        entry = (attributes, meta['parameters'])
+        self.__remember(key, entry)
+        self.hits += 1
+        return entry
+
+    @staticmethod
+    def attributes(group):
+        '''Return a dict of the array and scalar attributes of a group and
+        of its *_details subgroups, see BMM/larchprep.py.'''
+        return group_attributes(group)
+
+    def put(self, key, group, parameters):
+        '''Store the arrays and scalars of a processed group.'''
+        self.put_attributes(key, self.attributes(group), parameters)
+
+    def put_attributes(self, key, attributes, parameters):
+        '''Store attributes as returned by the attributes method.'''
+        arrays  = {k: v for k, v in attributes.items() if isinstance(v, numpy.ndarray)}
+        scalars = {k: v for k, v in attributes.items() if not isinstance(v, numpy.ndarray)}
+        meta = json.dumps({'scalars': scalars, 'parameters': parameters}, default=str)
+        fname = self.filename(key)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open(fname + '.part', 'wb') as f:
+            numpy.savez(f, __meta__=numpy.array(meta), **arrays)
+        os.replace(fname + '.part', fname)
+        self.__remember(key, (attributes, parameters))
+        with self.__lock:
+            self.__puts += 1
+            check = self.__puts % 100 == 0
+        if check:
+            self.prune()
+
+    def prune(self):
+        '''Remove entries from disk which have not been used in max_age
+        days, then the least recently used entries until the files come
+        to no more than max_size bytes.'''
+        entries = []
+        for path, dirs, files in os.walk(self.folder):
+            for f in files:
+                fname = os.path.join(path, f)
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fname))
+        entries.sort()
+        oldest = time.time() - self.max_age*86400
+        total  = sum(e[1] for e in entries)
+        for mtime, size, fname in entries:
+            if mtime >= oldest and total <= self.max_size:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                continue
+            total -= size
+
+    def __remember(self, key, entry):
+        with self.__lock:
+            self.__memory[key] = entry
+            self.__memory.move_to_end(key)
+            while len(self.__memory) > self.size:
+                self.__memory.popitem(last=False)
+
+    def make_group(self, attributes, name):
+        '''Build a Larch group from the attributes of a cache entry.'''
+        group = Group(__name__=name)
+        for k, v in attributes.items():
+            if '.' in k:
+                parent, child = k.split('.', 1)
+                if not hasattr(group, parent):
+                    setattr(group, parent, Group(__name__=parent))
+                setattr(getattr(group, parent), child, v)
+            else:
+                setattr(group, k, v)
+        return group
+
+    def clear(self):
+        '''Empty the in-memory cache.  The files on disk are left alone.'''
+        with self.__lock:
+            self.__memory.clear()
+
+    def __repr__(self):
+        return f'LarchCache at {self.folder}: {len(self.__memory)} in memory, {self.hits} hits, {self.misses} misses'
+
+LARCHCACHE = LarchCache()
 
 
 class Pandrosus():
@@ -114,8 +281,8 @@ class Pandrosus():
 
         ## flow control parameters
         
-    def make_xmu(self, uid, mode):
-        '''Load energy and mu(E) arrays into Larch and into this wrapper object.
+    def xmu_arrays(self, uid, mode):
+        '''Return a dict of the energy, mu(E), i0, and signal arrays for a data set.
         
         ***************************************************************
         This should be the only part of this startup script that needs
@@ -133,16 +300,17 @@ class Pandrosus():
             'transmission', 'fluorescence', or 'reference'
 
         '''
-        db, BMMuser = user_ns['db'], user_ns['BMMuser']
-        header = db[uid]
-        table  = header.table()
-        self.group.energy = numpy.array(table['dcm_energy'])
-        self.group.i0 = numpy.array(table['I0'])
+        BMMuser = user_ns['BMMuser']
+        header = user_ns['runcache'][uid]
+        table  = header.tables['primary']
+        xmu    = dict()
+        xmu['energy'] = numpy.array(table['dcm_energy'])
+        xmu['i0'] = numpy.array(table['I0'])
         if mode == 'flourescence': mode = 'fluorescence'
         if mode == 'reference':
-            self.group.mu = numpy.array(numpy.log(table['It']/table['Ir']))
-            self.group.i0 = numpy.array(table['It'])
-            self.group.signal = numpy.array(table['Ir'])
+            xmu['mu'] = numpy.array(numpy.log(table['It']/table['Ir']))
+            xmu['i0'] = numpy.array(table['It'])
+            xmu['signal'] = numpy.array(table['Ir'])
 
         #######################################################################################
         # CAUTION!!  This only works when BMMuser is correctly set.  This is unlikely to work #
@@ -150,43 +318,71 @@ class Pandrosus():
         #######################################################################################
         elif any(md in mode for md in ('fluo', 'flou', 'both')):
             columns = header.start['XDI']['_dtc']
-            self.group.mu = numpy.array((table[columns[0]]+table[columns[1]]+table[columns[2]]+table[columns[3]])/table['I0'])
-            self.group.i0 = numpy.array(table['I0'])
-            self.group.signal = numpy.array(table[columns[0]]+table[columns[1]]+table[columns[2]]+table[columns[3]])
+            xmu['mu'] = numpy.array((table[columns[0]]+table[columns[1]]+table[columns[2]]+table[columns[3]])/table['I0'])
+            xmu['i0'] = numpy.array(table['I0'])
+            xmu['signal'] = numpy.array(table[columns[0]]+table[columns[1]]+table[columns[2]]+table[columns[3]])
 
         elif mode == 'xs':
             columns = header.start['XDI']['_dtc']
-            self.group.mu = numpy.array((table[columns[0]]+table[columns[1]]+table[columns[2]]+table[columns[3]])/table['I0'])
-            self.group.i0 = numpy.array(table['I0'])
-            self.group.signal = numpy.array(table[columns[0]]+table[columns[1]]+table[columns[2]]+table[columns[3]])
+            xmu['mu'] = numpy.array((table[columns[0]]+table[columns[1]]+table[columns[2]]+table[columns[3]])/table['I0'])
+            xmu['i0'] = numpy.array(table['I0'])
+            xmu['signal'] = numpy.array(table[columns[0]]+table[columns[1]]+table[columns[2]]+table[columns[3]])
 
         elif mode == 'ref':
-            self.group.mu = numpy.array(numpy.log(table['It']/table['Ir']))
-            self.group.i0 = numpy.array(table['It'])
-            self.group.signal = numpy.array(table['Ir'])
+            xmu['mu'] = numpy.array(numpy.log(table['It']/table['Ir']))
+            xmu['i0'] = numpy.array(table['It'])
+            xmu['signal'] = numpy.array(table['Ir'])
 
         else:
-            self.group.mu = numpy.array(numpy.log(table['I0']/table['It']))
-            self.group.i0 = numpy.array(table['I0'])
-            self.group.signal = numpy.array(table['It'])
-            
+            xmu['mu'] = numpy.array(numpy.log(table['I0']/table['It']))
+            xmu['i0'] = numpy.array(table['I0'])
+            xmu['signal'] = numpy.array(table['It'])
+        return xmu
+
+    def make_xmu(self, uid, mode):
+        '''Load energy and mu(E) arrays into Larch and into this wrapper
+        object.  See xmu_arrays.'''
+        for k, v in self.xmu_arrays(uid, mode).items():
+            setattr(self.group, k, v)
+
     def fetch(self, uid, name=None, mode='transmission'):
-        db, BMMuser = user_ns['db'], user_ns['BMMuser']
+        '''Get a data set and process it, or take the processed data from
+        LARCHCACHE if this uid has already been processed in this mode
+        with the same parameters.'''
+        key = self.begin_fetch(uid, name, mode)
+        if key is not None:
+            self.group = Group(__name__=self.name)
+            self.make_xmu(uid, mode=mode)
+            self.prep()
+            LARCHCACHE.put(key, self.group, {'pre': self.pre, 'bkg': self.bkg, 'fft': self.fft})
+        self.end_fetch()
+
+    def begin_fetch(self, uid, name, mode):
+        '''Set the name and title and look for the data in LARCHCACHE.
+        Returns None if the cached group was used, otherwise returns the
+        cache key under which the processed group should be stored.'''
+        run = user_ns['runcache'][uid]
         self.uid = uid
         if name is not None:
             self.name = name
         else:
             self.name = uid[-6:]
-        self.group = Group(__name__=self.name)
-        self.title = db.v2[uid].metadata['start']['XDI']['Sample']['name']
-        self.make_xmu(uid, mode=mode)
-        self.prep()
-        toss = create_athena(os.path.join(BMMuser.folder, 'prj', 'toss.prj'))
-        toss.add_group(self.group)
-        toss.save()
-        os.remove(os.path.join(BMMuser.folder, 'prj', 'toss.prj'))
-        toss = None
-        self.group.args['label'] = db.v2[uid].metadata['start']['XDI']['_filename']
+        self.title = run.start['XDI']['Sample']['name']
+        key = LARCHCACHE.key(uid, mode, self.pre, self.bkg, self.fft)
+        cached = LARCHCACHE.get(key)
+        if cached is None:
+            return key
+        self.set_processed(*cached)
+        return None
+
+    def set_processed(self, attributes, parameters):
+        '''Make the group from the attributes of a processed group.'''
+        self.group = LARCHCACHE.make_group(attributes, self.name)
+        self.pre, self.bkg, self.fft = dict(parameters['pre']), dict(parameters['bkg']), dict(parameters['fft'])
+
+    def end_fetch(self):
+        self.group.args = make_athena_args(self.group)
+        self.group.args['label'] = user_ns['runcache'][self.uid].start['XDI']['_filename']
 
     def put(self, energy, mu, name):
         self.name = name
@@ -196,48 +392,15 @@ class Pandrosus():
         self.prep()
         
     def prep(self):
-        ## the next several lines seem necessary because the version
-        ## of Larch currently at BMM is not correctly resolving
-        ## pre1=pre2=None or norm1=norm2=None.  The following
-        ## approximates Larch's defaults
-        if self.pre['e0'] is None:
-            find_e0(self.group.energy, mu=self.group.mu, group=self.group, _larch=LARCH)
-            ezero = self.group.e0
-        else:
-            ezero = self.pre['e0']
-        if self.pre['norm2'] is None:
-            self.pre['norm2'] = self.group.energy.max() - ezero
-        if self.pre['norm1'] is None:
-            self.pre['norm1'] = self.pre['norm2'] / 5
-        if self.pre['pre1'] is None:
-            self.pre['pre1'] = self.group.energy.min() - ezero
-        if self.pre['pre2'] is None:
-            self.pre['pre2'] = self.pre['pre1'] / 3
-        pre_edge(self.group.energy, mu=self.group.mu, group=self.group,
-                 e0    = ezero,
-                 step  = None,
-                 pre1  = self.pre['pre1'],
-                 pre2  = self.pre['pre2'],
-                 norm1 = self.pre['norm1'],
-                 norm2 = self.pre['norm2'],
-                 nnorm = self.pre['nnorm'],
-                 nvict = self.pre['nvict'],
-                 _larch=LARCH)
-        autobk(self.group.energy, mu=self.group.mu, group=self.group,
-               rbkg    = self.bkg['rbkg'],
-               e0      = self.bkg['e0'],
-               kmin    = self.bkg['kmin'],
-               kmax    = self.bkg['kmax'],
-               kweight = self.bkg['kweight'],
-               _larch=LARCH)
-        xftf(self.group.k, chi=self.group.chi, group=self.group,
-             window = self.fft['window'],
-             kmin   = self.fft['kmin'],
-             kmax   = self.fft['kmax'],
-             dk     = self.fft['dk'],
-             _larch=LARCH)
+        '''Normalize, background subtract, and forward transform the data,
+        see BMM/larchprep.py.'''
+        prep_group(self.group, self.pre, self.bkg, self.fft, LARCH)
 
     def show(self, which=None):
+        with LARCH_LOCK:
+            self.__show(which)
+
+    def __show(self, which):
         if which is None:
             lus.show(self.group, _larch=LARCH)
         elif 'pre' in which:
@@ -371,13 +534,14 @@ class Pandrosus():
     plot_chik = plot_chi
         
     def do_xftf(self, kw=2):
-        xftf(self.group.k, chi=self.group.chi, group=self.group,
-             window  = self.fft['window'],
-             kmin    = self.fft['kmin'],
-             kmax    = self.fft['kmax'],
-             dk      = self.fft['dk'],
-             kweight = kw,
-             with_phase=True, _larch=LARCH)
+        with LARCH_LOCK:
+            xftf(self.group.k, chi=self.group.chi, group=self.group,
+                 window  = self.fft['window'],
+                 kmin    = self.fft['kmin'],
+                 kmax    = self.fft['kmax'],
+                 dk      = self.fft['dk'],
+                 kweight = kw,
+                 with_phase=True, _larch=LARCH)
     def plot_chir(self, kw=2, win=True, parts='m'):
         '''Make a plot in R-space of a single data set.
 
@@ -451,12 +615,13 @@ class Pandrosus():
         plt.legend(loc='best', shadow=True)
         
     def do_xftr(self):
-        xftr(self.group.r, chir=self.group.chir, group=self.group,
-             window = self.bft['window'],
-             rmin   = self.bft['rmin'],
-             rmax   = self.bft['rmax'],
-             dr     = self.bft['dr'],
-             with_phase=True, _larch=LARCH)
+        with LARCH_LOCK:
+            xftr(self.group.r, chir=self.group.chir, group=self.group,
+                 window = self.bft['window'],
+                 rmin   = self.bft['rmin'],
+                 rmax   = self.bft['rmax'],
+                 dr     = self.bft['dr'],
+                 with_phase=True, _larch=LARCH)
     def plot_chiq(self, kw=2, parts='r', win=True):
         '''Make a plot in back-transformed k-space of a single data set.
 
@@ -557,9 +722,14 @@ class Pandrosus():
         plt.legend(loc='best', shadow=True)
 
 
-    def triplot(self, kw=2):
-        fig = plt.figure(tight_layout=True)
-        gs = gridspec.GridSpec(2,2)
+    def triplot(self, kw=2, fig=None):
+        '''Plot mu(E), chi(k), and |chi(R)| in a grid.  If fig is given, for
+        instance a Figure with an Agg canvas for writing an image file,
+        draw on it rather than on a new pyplot figure.'''
+        show = fig is None
+        if fig is None:
+            fig = plt.figure(tight_layout=True)
+        gs = gridspec.GridSpec(2,2, figure=fig)
 
         self.prep()
         self.do_xftf(kw=kw)
@@ -584,7 +754,9 @@ class Pandrosus():
         chir.set_xlabel('radial distance ($\AA$)')
 
         fig.align_labels()
-        plt.show()
+        if show:
+            plt.show()
+        return fig
         
     pe  = plot_xmu
     ps  = plot_signals
@@ -596,6 +768,24 @@ class Pandrosus():
 
 from collections.abc import Iterable
 ## grouping of Pandrosus objects for making purple plots
+def interpolate_many(x, spectra):
+    '''Interpolate many (xp, fp) pairs onto the grid x with a single call
+    to numpy.interp, returning an (N, len(x)) array.  Like numpy.interp,
+    values beyond the ends of each xp are taken from its end points.'''
+    n       = len(spectra)
+    x       = numpy.asarray(x, dtype=numpy.float64)
+    lengths = numpy.array([len(xp) for xp, fp in spectra])
+    xp      = numpy.concatenate([numpy.asarray(xp, dtype=numpy.float64) for xp, fp in spectra])
+    fp      = numpy.concatenate([numpy.asarray(fp, dtype=numpy.float64) for xp, fp in spectra])
+    last    = numpy.cumsum(lengths) - 1
+    first   = last - lengths + 1
+    span    = max(xp.max(), x.max()) - min(xp.min(), x.min()) + 1.0
+    shift   = numpy.arange(n) * span
+    ## clip to each spectrum's range so that no point is interpolated from a neighboring spectrum
+    xx = numpy.clip(x[None,:], xp[first][:,None], xp[last][:,None]) + shift[:,None]
+    return numpy.interp(xx.ravel(), xp + numpy.repeat(shift, lengths), fp).reshape(n, len(x))
+
+
 class Kekropidai():
     '''Simple wrapper around a group of Pandrosus objects to facilitate
     multiple data set plots in the manner of Athena's purple plot
@@ -640,22 +830,62 @@ class Kekropidai():
         self.name   = name
         self.rmax   = 6
 
-    def put(self, uidlist):
-        for u in uidlist:
+    def put(self, uidlist, mode='transmission', workers=4):
+        '''Fetch and process a list of uids and add them to this collection.
+
+        Runs are read from the run cache, and looked for in LARCHCACHE,
+        concurrently by a pool of threads.  The data sets which are not
+        in LARCHCACHE are then processed in parallel by a pool of worker
+        processes, which are handed plain arrays and dicts and return
+        the same.  The workers are started with spawn rather than fork,
+        as forking the IPython session is not safe while the RunEngine,
+        ophyd, and the databroker have threads of their own.  Each
+        worker imports Larch and makes its own interpreter, which takes
+        a few seconds, so a single data set is processed in this
+        process instead.
+        '''
+        def read(u):
             this = Pandrosus()
-            this.fetch(u)
+            key = this.begin_fetch(u, None, mode)
+            arrays = None if key is None else this.xmu_arrays(u, mode)
+            return this, key, arrays
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            fetched = list(executor.map(read, uidlist))
+        todo = [(this, key, arrays) for this, key, arrays in fetched if key is not None]
+        args = ([a for this, key, a in todo],
+                [this.pre for this, key, a in todo],
+                [this.bkg for this, key, a in todo],
+                [this.fft for this, key, a in todo])
+        if len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(todo)),
+                                     mp_context=multiprocessing.get_context('spawn')) as pool:
+                results = list(pool.map(process_xmu, *args))
+        else:
+            results = list(map(process_xmu, *args))
+        for (this, key, arrays), (attributes, parameters) in zip(todo, results):
+            LARCHCACHE.put_attributes(key, attributes, parameters)
+            this.set_processed(attributes, parameters)
+        for this, key, arrays in fetched:
+            this.end_fetch()
             self.add(this)
 
     def merge(self):
+        '''Merge the groups on the energy grid of the first group.  All
+        the groups are interpolated at once, then averaged.  The
+        standard error of the mean at each energy point is stored in the
+        stderr attribute of the merged group.'''
         base = self.groups[0]
         ee = base.group.energy
-        mm = base.group.mu
-        for spectrum in self.groups[1:]:
-            mu = numpy.interp(ee, spectrum.group.energy, spectrum.group.mu)
-            mm = mm + mu
-        mm = mm / len(self.groups)
+        stack = numpy.vstack([base.group.mu, interpolate_many(ee, [(g.group.energy, g.group.mu) for g in self.groups[1:]])]) \
+            if len(self.groups) > 1 else numpy.atleast_2d(base.group.mu)
+        mm = stack.mean(axis=0)
+        if len(self.groups) > 1:
+            stderr = stack.std(axis=0, ddof=1) / numpy.sqrt(len(self.groups))
+        else:
+            stderr = numpy.zeros_like(mm)
         merge = Pandrosus()
         merge.put(ee, mm, 'merge')
+        merge.group.stderr = stderr
         return(merge)
         
             
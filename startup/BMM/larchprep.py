@@ -0,0 +1,103 @@
+## Normalization, background removal, and Fourier transform of mu(E)
+## with Larch.  Nothing here refers to the IPython session, so this
+## module can be imported by a worker process, see Kekropidai.put in
+## BMM/larch.py.
+
+import numpy, threading
+from larch import Group, Interpreter
+from larch.xafs import find_e0, pre_edge, autobk, xftf
+
+LARCH = None
+## the Larch interpreter is not thread safe, so everything which uses it,
+## here and in BMM/larch.py, holds this lock
+LARCH_LOCK = threading.RLock()
+
+def interpreter():
+    '''Return the Larch interpreter of this process, making it the first
+    time it is needed.'''
+    global LARCH
+    if LARCH is None:
+        LARCH = Interpreter()
+    return LARCH
+
+
+def prep_group(group, pre, bkg, fft, _larch):
+    '''Normalize, background subtract, and forward transform the energy
+    and mu arrays of a Larch group, see Pandrosus.prep.'''
+    with LARCH_LOCK:
+        ## the next several lines seem necessary because the version
+        ## of Larch currently at BMM is not correctly resolving
+        ## pre1=pre2=None or norm1=norm2=None.  The following
+        ## approximates Larch's defaults.  The defaults are worked out in
+        ## a copy, so the caller's pre keeps what the user asked for, which
+        ## is what LARCHCACHE keys on.  The values used are recorded in
+        ## the group's pre_edge_details.
+        pre = dict(pre)
+        if pre['e0'] is None:
+            find_e0(group.energy, mu=group.mu, group=group, _larch=_larch)
+            ezero = group.e0
+        else:
+            ezero = pre['e0']
+        if pre['norm2'] is None:
+            pre['norm2'] = group.energy.max() - ezero
+        if pre['norm1'] is None:
+            pre['norm1'] = pre['norm2'] / 5
+        if pre['pre1'] is None:
+            pre['pre1'] = group.energy.min() - ezero
+        if pre['pre2'] is None:
+            pre['pre2'] = pre['pre1'] / 3
+        pre_edge(group.energy, mu=group.mu, group=group,
+                 e0    = ezero,
+                 step  = None,
+                 pre1  = pre['pre1'],
+                 pre2  = pre['pre2'],
+                 norm1 = pre['norm1'],
+                 norm2 = pre['norm2'],
+                 nnorm = pre['nnorm'],
+                 nvict = pre['nvict'],
+                 _larch=_larch)
+        autobk(group.energy, mu=group.mu, group=group,
+               rbkg    = bkg['rbkg'],
+               e0      = bkg['e0'],
+               kmin    = bkg['kmin'],
+               kmax    = bkg['kmax'],
+               kweight = bkg['kweight'],
+               _larch=_larch)
+        xftf(group.k, chi=group.chi, group=group,
+             window = fft['window'],
+             kmin   = fft['kmin'],
+             kmax   = fft['kmax'],
+             dk     = fft['dk'],
+             _larch=_larch)
+
+
+def group_attributes(group):
+    '''Return a dict of the array and scalar attributes of a group and
+    of its *_details subgroups, with subgroup attributes named like
+    'autobk_details.kmax'.'''
+    attributes = dict()
+    def collect(prefix, g):
+        for name, value in vars(g).items():
+            if name.startswith('_') or name == 'args':
+                continue
+            if isinstance(value, numpy.ndarray) and value.dtype != object:
+                attributes[prefix+name] = value
+            elif isinstance(value, (int, float, str, bool, numpy.number)) or value is None:
+                attributes[prefix+name] = value.item() if isinstance(value, numpy.number) else value
+            elif isinstance(value, Group) and prefix == '' and name.endswith('_details'):
+                collect(name+'.', value)
+    collect('', group)
+    return attributes
+
+
+def process_xmu(arrays, pre, bkg, fft):
+    '''Normalize, background subtract, and transform mu(E) arrays as
+    returned by Pandrosus.xmu_arrays, returning the attributes of the
+    processed group and the parameters used.  The arguments and the
+    return value are plain dicts, numbers, and arrays, so this can be
+    run in another process.'''
+    group = Group(__name__='worker')
+    for k, v in arrays.items():
+        setattr(group, k, v)
+    prep_group(group, pre, bkg, fft, interpreter())
+    return group_attributes(group), {'pre': dict(pre), 'bkg': dict(bkg), 'fft': dict(fft)}
@@ -352,7 +352,11 @@ class BMMMacroBuilder():
         s = [float(x) if isfloat(x) else x for x in s]
         t = [float(x) if isfloat(x) else x for x in t]
 
-        (e, t, at, delta) = conventional_grid(bounds=b, steps=s, times=t, e0=edge_energy(el, ed), element=el, edge=ed, ththth=False)
+        mode     = m.get('mode')     or self.measurements[0].get('mode')
+        bothways = m.get('bothways') if type(m.get('bothways')) is bool else self.measurements[0].get('bothways', False)
+
+        (e, t, at, delta) = conventional_grid(bounds=b, steps=s, times=t, e0=edge_energy(el, ed), element=el, edge=ed, ththth=False,
+                                              mode=mode, bothways=bool(bothways))
 
         if type(m['nscans']) is int:
             nsc = m['nscans']
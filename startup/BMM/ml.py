@@ -5,7 +5,8 @@ import numpy
 import matplotlib.pyplot as plt
 #plt.ion()
 import h5py
-import os
+import os, time
+from concurrent.futures import ThreadPoolExecutor
 
 #from sklearn.neighbors import KNeighborsClassifier
 from sklearn.ensemble import RandomForestClassifier
@@ -14,6 +15,11 @@ from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split
 from joblib import dump, load
 
+from bluesky.callbacks import CallbackBase
+from bluesky.plan_stubs import null, one_nd_step
+
+from BMM.functions import bold_msg, error_msg, whisper
+
 from IPython import get_ipython
 user_ns = get_ipython().user_ns
 
@@ -124,12 +130,36 @@ class BMMDataEvaluation():
 
 
     def rationalize_mu(self, en, mu):
-        '''Return energy and mu on a "rationalized" grid of equally spaced points.  See slef.GRIDSIZE
+        '''Return energy and mu on a "rationalized" grid of GRIDSIZE equally spaced points.
         '''
-        ee=list(numpy.arange(float(en[0]), float(en[-1]), (float(en[-1])-float(en[0]))/self.GRIDSIZE))
-        mm=numpy.interp(ee, en, mu)
+        en = numpy.asarray(en, dtype=numpy.float64)
+        ee = en[0] + numpy.arange(self.GRIDSIZE) * ((en[-1]-en[0])/self.GRIDSIZE)
+        mm = numpy.interp(ee, en, mu)
         return(ee, mm)
 
+    def rationalize_batch(self, spectra):
+        '''Put many spectra on their rationalized grids at once.
+
+        spectra is a sequence of (energy, mu) pairs of any lengths.  They
+        are concatenated, with each spectrum's energies shifted past the
+        previous one's, so that a single call to numpy.interp
+        interpolates them all.  Returns an (N, GRIDSIZE) array of mu.
+        '''
+        n = len(spectra)
+        if n == 0:
+            return numpy.empty((0, self.GRIDSIZE))
+        lengths = numpy.array([len(en) for en, mu in spectra])
+        en = numpy.concatenate([numpy.asarray(en, dtype=numpy.float64) for en, mu in spectra])
+        mu = numpy.concatenate([numpy.asarray(mu, dtype=numpy.float64) for en, mu in spectra])
+        last  = numpy.cumsum(lengths) - 1
+        first = last - lengths + 1
+        e0, e1 = en[first], en[last]
+
+        span  = en.max() - en.min() + 1.0
+        shift = numpy.arange(n) * span
+        ee = e0[:,None] + numpy.arange(self.GRIDSIZE)[None,:] * ((e1-e0)/self.GRIDSIZE)[:,None]
+        return numpy.interp((ee + shift[:,None]).ravel(), en + numpy.repeat(shift, lengths), mu).reshape(n, self.GRIDSIZE)
+
 
     def get_uid_list(self, mode='fluorescence'):
         '''Gather a curated list of uids to be used in the training set
@@ -148,58 +178,120 @@ class BMMDataEvaluation():
             these=search_results.search(timequery)
         return these
 
-    def process_catalog(self, mode='fluorescence'):
+    def extract(self, clog, uid, mode):
+        '''Fetch a record and return its mu rationalized onto the
+        GRIDSIZE grid, or None if it is not usable.'''
+        ret = self.extract_mu(clog=clog, uid=uid, mode=mode, show_plot=False)
+        if ret is None:
+            return None
+        ee, mm = self.rationalize_mu(*ret)
+        if len(ee) < self.GRIDSIZE:
+            return None
+        return numpy.asarray(mm[:self.GRIDSIZE], dtype=numpy.float32)
+
+    def fetch_training_data(self, these, mode='fluorescence', workers=8):
+        '''Fetch and rationalize every record in a catalog search using a
+        pool of worker threads.  Returns the list of uids which were
+        usable and an (N, GRIDSIZE) float32 array of their mu data, in
+        catalog order.'''
+        uids = list(these)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            rows = list(executor.map(lambda u: self.extract(these, u, mode), uids))
+        keep = [i for i, r in enumerate(rows) if r is not None]
+        for i, r in enumerate(rows):
+            if r is None:
+                print(f'skipping {uids[i]}, not data or too short')
+        data = numpy.empty((len(keep), self.GRIDSIZE), dtype=numpy.float32)
+        for j, i in enumerate(keep):
+            data[j] = rows[i]
+        return [uids[i] for i in keep], data
+
+    def write_training_set(self, h5file, uids, data, scores):
+        '''Write a training set as a single contiguous (N, GRIDSIZE) float32
+        dataset called mu, a score vector, and the list of uids.  The
+        mu dataset is neither chunked nor compressed so that train()
+        can memory map it.'''
+        with h5py.File(h5file, 'w') as f:
+            f.create_dataset('mu',    data=numpy.ascontiguousarray(data, dtype=numpy.float32))
+            f.create_dataset('score', data=numpy.asarray(scores, dtype=numpy.int8))
+            f.create_dataset('uid',   data=numpy.array(uids, dtype=h5py.string_dtype()))
+            f.attrs['gridsize'] = self.GRIDSIZE
+
+    def process_catalog(self, mode='fluorescence', workers=8, checkpoint=25):
         '''Score each entry in the training set.  This will gather a list of
-        uids, plot them one-by-one, and solicit a 1/0 score for each
-        one.  The properly interpolated and scored data will be stored
-        in an HDF5 file for later use.
+        uids, fetch and interpolate them all in parallel, then solicit a
+        1/0 score for each one.  The properly interpolated and scored
+        data will be stored in an HDF5 file for later use.
 
+        The scores entered so far are saved to a .part file every
+        checkpoint scores.  Quitting writes the records scored so far
+        to the training set file.
         '''
-        shplot, fig, ax = False, False, False
-        if mode != 'verygood':
-            fig, ax = plt.subplots(1,1)
-            plt.show(False)
-            plt.draw()
-            fig.canvas.flush_events()
-            shplot = True
         these = self.get_uid_list(mode)
-        #list(catalog['bmm'])
         print(f'Scoring {len(these)} records')
+        uids, data = self.fetch_training_data(these, mode, workers)
+        print(whisper(f'{len(uids)} of {len(these)} records are usable'))
 
         h5file = os.path.join(self.folder, f'{mode}_training_set.hdf5')
-        try:
-            os.remove(h5file)
-        except:
-            pass
-        f = h5py.File(h5file, 'w')
-
-        count = 0
-        for uid in list(these):
-            count += 1
-            ret = self.extract_mu(clog=these, uid=uid, mode=mode, fig=fig, ax=ax, show_plot=False)
-            if ret is None:
-                print(f'skipping {uid}, not data or too short')
-            else:
-                ee, mm = self.rationalize_mu(*ret)
-                print(f'{count}  {len(ee)}   {uid}   {mode}')
-                if len(ee) < self.GRIDSIZE:
+        if mode == 'verygood':
+            scores = numpy.ones(len(uids), dtype=numpy.int8)
+            count  = len(uids)
+        else:
+            fig, ax = plt.subplots(1,1)
+            plt.show(False)
+            scores = numpy.zeros(len(uids), dtype=numpy.int8)
+            count  = 0
+            while count < len(uids):
+                print(f'{count+1}  {self.GRIDSIZE}   {uids[count]}   {mode}')
+                action = input('\n' + bold_msg('1= good  2=bad  q=quit > ')).strip().lower()
+                if action == 'q':
+                    break
+                if action not in ('1', '2'):
+                    print(error_msg(f'"{action}" is not 1, 2, or q'))
                     continue
-                elif len(ee) > self.GRIDSIZE:
-                    ee = ee[:-1]
-                    mm = mm[:-1]
-                grp = f.create_group(uid)
-                grp.create_dataset("energy", data=ee)
-                grp.create_dataset("mu", data=mm)
-                if mode == 'verygood':
-                    grp.attrs['score'] = 1
+                scores[count] = int(action)
+                count += 1
+                if count % checkpoint == 0:
+                    self.write_training_set(h5file + '.part', uids[:count], data[:count], scores[:count])
+            plt.close(fig)
+
+        if count == 0:
+            return
+        self.write_training_set(h5file, uids[:count], data[:count], scores[:count])
+        if os.path.isfile(h5file + '.part'):
+            os.remove(h5file + '.part')
+        print(f'wrote {count} scored records to {h5file}')
+
+    def read_training_set(self, h5file):
+        '''Return the mu data and scores from a training set file.  For
+        the contiguous layout written by write_training_set, mu is a
+        read-only memory map of the file.  Training sets in the older
+        layout, with one group per record, are read into an array.'''
+        with h5py.File(h5file, 'r') as f:
+            if 'mu' in f and isinstance(f['mu'], h5py.Dataset):
+                ds, scores = f['mu'], f['score'][()]
+                offset = ds.id.get_offset()
+                if offset is not None and ds.chunks is None:
+                    data = numpy.memmap(h5file, dtype=ds.dtype, mode='r', offset=offset, shape=ds.shape)
                 else:
-                    action = input('\n' + bold_msg('1= good  2=bad  q=quit > '))
-                    if action.lower() == 'q':
-                        plt.close(fig)
-                        return()
-                    else:
-                        grp.attrs['score'] = action
-        plt.close(fig)
+                    data = ds[()]
+                return data, scores
+            uids   = list(f.keys())
+            data   = numpy.empty((len(uids), self.GRIDSIZE), dtype=numpy.float32)
+            scores = numpy.empty(len(uids), dtype=numpy.int8)
+            for i, uid in enumerate(uids):
+                data[i]   = f[uid]['mu'][:self.GRIDSIZE]
+                scores[i] = int(f[uid].attrs['score'])
+            return data, scores
+
+    def convert_training_set(self, h5file):
+        '''Rewrite a training set from the older one-group-per-record layout
+        into the contiguous layout.'''
+        with h5py.File(h5file, 'r') as f:
+            uids = list(f.keys())
+        data, scores = self.read_training_set(h5file)
+        self.write_training_set(h5file + '.part', uids, data, scores)
+        os.replace(h5file + '.part', h5file)
 
     def train(self):
         '''Using all the hdf5 files of interpolated, scored data, create the
@@ -211,12 +303,13 @@ class BMMDataEvaluation():
         for h5file in self.hdf5:
             if os.path.isfile(h5file):
                 print(f'reading data from {h5file}')
-                f = h5py.File(h5file,'r')
-                for uid in f.keys():
-                    score = int(f[uid].attrs['score'])
-                    mu = list(f[uid]['mu'])
-                    scores.append(score)
-                    data.append(mu)
+                d, s = self.read_training_set(h5file)
+                data.append(d)
+                scores.append(s)
+        if len(data) == 1:
+            data, scores = data[0], scores[0]
+        else:
+            data, scores = numpy.concatenate(data), numpy.concatenate(scores)
 
         X_train, X_test, y_train, y_test = train_test_split(data, scores, random_state=0)
         print("training model...")
@@ -235,12 +328,9 @@ class BMMDataEvaluation():
         '''Thin wrapper around the classifier object's score method.'''
         return(self.clf.score(self.X, self.y))
 
-    def evaluate(self, uid, mode=None):
-        '''Perform an evaluation of a measurement.  The data will be
-        interpolated onto the same grid used for the training set,
-        then get subjected to the model.  This returns a tuple with
-        the score (1 or 0) and the Slack-appropriate value (green
-        check or red cross).
+    def measured_mu(self, uid, mode=None):
+        '''Return the energy and mu arrays for a measurement, or None if the
+        fluorescence signal cannot be identified.
 
         Parameters
         ----------
@@ -250,52 +340,274 @@ class BMMDataEvaluation():
             when not None, used to specify fluorescence or transmission (for a data set that has both)
 
         '''
+        ## the run is read once, shared with write_XDI, see BMM/runcache.py
+        this = user_ns['runcache'][uid]
         if mode == 'xs':
-            BMMuser, db = user_ns['BMMuser'], user_ns['db']
-            t = db[-1].table()
+            BMMuser = user_ns['BMMuser']
             el = BMMuser.element
-            i0 = numpy.array(t['I0'])
-            en = numpy.array(t['dcm_energy'])
-            dtc1 = numpy.array(t[el+'1'])
-            dtc2 = numpy.array(t[el+'2'])
-            dtc3 = numpy.array(t[el+'3'])
-            dtc4 = numpy.array(t[el+'4'])
+            i0 = this.column('I0')
+            en = this.column('dcm_energy')
+            dtc1 = this.column(el+'1')
+            dtc2 = this.column(el+'2')
+            dtc3 = this.column(el+'3')
+            dtc4 = this.column(el+'4')
             signal = dtc1+dtc2+dtc3+dtc4
             mu = signal/i0
         else:
-            db = user_ns['db']
-            this = db.v2[uid]
             if mode is None:
                 mode = this.metadata['start']['XDI']['_mode'][0]
             element = this.metadata['start']['XDI']['Element']['symbol']
-            i0 = this.primary.read()['I0']
-            en = this.primary.read()['dcm_energy']
+            i0 = this.column('I0')
+            en = this.column('dcm_energy')
             if mode == 'transmission':
-                it = this.primary.read()['It']
+                it = this.column('It')
                 mu = numpy.log(abs(i0/it))
             elif mode == 'reference':
-                it = this.primary.read()['It']
-                ir = this.primary.read()['Ir']
+                it = this.column('It')
+                ir = this.column('Ir')
                 mu = numpy.log(abs(it/ir))
             else:
-                if element in str(this.primary.read()['vor:vor_names_name3'][0].values):
-                    signal = this.primary.read()['DTC1'] + this.primary.read()['DTC2'] + this.primary.read()['DTC3'] + this.primary.read()['DTC4']
-                elif element in str(this.primary.read()['vor:vor_names_name15'][0].values):
-                    signal = this.primary.read()['DTC2_1'] + this.primary.read()['DTC2_2'] + this.primary.read()['DTC2_3'] + this.primary.read()['DTC2_4']
-                elif element in str(this.primary.read()['vor:vor_names_name19'][0].values):
-                    signal = this.primary.read()['DTC3_1'] + this.primary.read()['DTC3_2'] + this.primary.read()['DTC3_3'] + this.primary.read()['DTC3_4']
+                if element in str(this.configuration('vor', 'vor_names_name3')):
+                    signal = this.column('DTC1') + this.column('DTC2') + this.column('DTC3') + this.column('DTC4')
+                elif element in str(this.configuration('vor', 'vor_names_name15')):
+                    signal = this.column('DTC2_1') + this.column('DTC2_2') + this.column('DTC2_3') + this.column('DTC2_4')
+                elif element in str(this.configuration('vor', 'vor_names_name19')):
+                    signal = this.column('DTC3_1') + this.column('DTC3_2') + this.column('DTC3_3') + this.column('DTC3_4')
                 else:
                     print('cannot figure out fluorescence signal')
                     #print(f'vor:vor_names_name3 {}')
-                    return()
+                    return None
                 mu = signal/i0
-        e,m = self.rationalize_mu(en, mu)
-        if len(m) > self.GRIDSIZE:
-            m = m[:-1]
+        return(en, mu)
+
+    def evaluate(self, uid, mode=None):
+        '''Perform an evaluation of a measurement.  The data will be
+        interpolated onto the same grid used for the training set,
+        then get subjected to the model.  This returns a tuple with
+        the score (1 or 0) and the Slack-appropriate value (green
+        check or red cross).
+
+        Parameters
+        ----------
+        uid : str
+            uid of data to be evaluated
+        mode : bool
+            when not None, used to specify fluorescence or transmission (for a data set that has both)
+
+        '''
+        ret = self.measured_mu(uid, mode)
+        if ret is None:
+            return()
+        e,m = self.rationalize_mu(*ret)
         result = self.clf.predict([m])[0]
         if result == 1:
             return(result, self.good_emoji)
         else:
             return(result, self.bad_emoji)
-    
-    
+
+    def evaluate_many(self, uids=None, spectra=None, mode=None, workers=8):
+        '''Evaluate many measurements at once, for instance to back-score
+        all the data from a cycle.  The measurements are fetched on a
+        pool of worker threads, rationalized in one vectorized call,
+        and scored with a single call to the classifier.
+
+        Parameters
+        ----------
+        uids : list of str
+            uids of data to be evaluated
+        spectra : list of (energy, mu) tuples
+            in-memory data to be evaluated instead of uids
+        mode : str
+            as for evaluate
+        workers : int
+            number of worker threads for fetching data
+
+        Returns a list with a tuple of (score, emoji, probability of
+        good) for each measurement, or None for a measurement which
+        could not be evaluated.
+        '''
+        start = time.time()
+        if spectra is None:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                spectra = list(executor.map(lambda u: self.measured_mu(u, mode), uids))
+        ok = [i for i, sp in enumerate(spectra) if sp is not None and len(sp[0]) > 1]
+        results = [None] * len(spectra)
+        if len(ok) > 0:
+            X = self.rationalize_batch([spectra[i] for i in ok])
+            probabilities = self.clf.predict_proba(X)
+            predicted = self.clf.classes_[numpy.argmax(probabilities, axis=1)]
+            good = list(self.clf.classes_).index(1) if 1 in self.clf.classes_ else None
+            for j, i in enumerate(ok):
+                result = predicted[j]
+                p_good = float(probabilities[j, good]) if good is not None else 0.0
+                results[i] = (result, self.good_emoji if result == 1 else self.bad_emoji, p_good)
+        elapsed = time.time() - start
+        print(whisper(f'evaluated {len(ok)} of {len(spectra)} measurements in {elapsed:.1f} s, {len(ok)/max(elapsed, 1e-6):.1f} per second'))
+        return results
+
+
+class EarlyQualityCheck(CallbackBase):
+    '''A RunEngine subscriber which judges an XAFS scan while it is
+    running, as soon as the region around the edge has been measured.
+
+    The classifier in BMMDataEvaluation needs the whole spectrum, so
+    this uses two simple tests which can be made on part of a scan:
+
+      1. I0 must be positive and finite for (nearly) every point
+
+      2. the edge step, measured from a line fit to the pre-edge, must
+         be at least min_snr times the scatter of the pre-edge about
+         that line
+
+    The verdict is made once, when the scan has moved past both the
+    pre-edge and post-edge windows, and is held in the bad and reason
+    attributes.  Nothing is raised in the callback.  Instead, the
+    per_step method is given to scan_nd (and the stopping method to
+    adaptive_scan) and is consulted before each point.  Once a scan is
+    judged bad and the check is enabled, the remaining points are not
+    measured, so the run ends right away, and the xafs() plan skips the
+    rest of the sequence.  A bad verdict is always written to the log.
+
+    This ships disabled, so it only reports, until its thresholds have
+    been validated against past runs with replay_many.
+
+    >>> earlycheck = EarlyQualityCheck()
+    >>> earlycheck.replay_many(uids)    # test against historical runs
+    >>> earlycheck.enabled = True       # then let it stop bad sequences
+
+    Attributes
+    ----------
+    enabled : bool
+        when False (the default), xafs() only reports a bad verdict
+    pre : tuple of float
+        pre-edge window, relative to the edge energy
+    post : tuple of float
+        post-edge window, relative to the edge energy
+    min_snr : float
+        smallest acceptable ratio of edge step to pre-edge scatter
+    min_points : int
+        smallest number of points in each window for a verdict
+    bad : bool
+        True if the scan was judged to be bad
+    reason : str
+        explanation of a bad verdict
+    '''
+    def __init__(self, pre=(-150, -30), post=(30, 80), min_snr=5, min_points=5):
+        super().__init__()
+        self.enabled    = False
+        self.pre        = pre
+        self.post       = post
+        self.min_snr    = min_snr
+        self.min_points = min_points
+        self.reset()
+
+    def reset(self):
+        self.bad      = False
+        self.reason   = ''
+        self.decided  = False
+        self.e0       = None
+        self.mode     = None
+        self.signals  = ()
+        self.primary  = None
+        self.energy, self.i0, self.signal = [], [], []
+
+    def start(self, doc):
+        self.reset()
+        try:
+            xdi = doc['XDI']
+            if xdi['_kind'] not in ('xafs', '333'):
+                return
+            self.e0 = float(xdi['Scan']['edge_energy'])
+            if xdi['_kind'] == '333':
+                self.e0 = self.e0 / 3.0
+            self.mode = xdi['_mode'][0]
+            if self.mode == 'transmission':
+                self.signals = ('It',)
+            elif self.mode == 'reference':
+                self.signals = ('It', 'Ir')
+            else:
+                self.signals = tuple(xdi['_dtc'])
+        except (KeyError, TypeError, ValueError, IndexError):
+            self.e0 = None
+
+    def descriptor(self, doc):
+        if self.e0 is not None and doc.get('name') == 'primary':
+            self.primary = doc['uid']
+
+    def event(self, doc):
+        if self.decided or self.primary is None or doc['descriptor'] != self.primary:
+            return
+        data = doc['data']
+        try:
+            energy = float(data['dcm_energy'])
+            i0     = float(data['I0'])
+            values = [float(data[s]) for s in self.signals]
+        except (KeyError, TypeError, ValueError):
+            return
+        self.energy.append(energy)
+        self.i0.append(i0)
+        if self.mode == 'transmission':
+            self.signal.append(numpy.log(abs(i0/values[0])) if values[0] != 0 and i0 != 0 else numpy.nan)
+        elif self.mode == 'reference':
+            self.signal.append(numpy.log(abs(values[0]/values[1])) if values[0] != 0 and values[1] != 0 else numpy.nan)
+        else:
+            self.signal.append(sum(values)/i0 if i0 != 0 else numpy.nan)
+        relative = energy - self.e0
+        if self.pre[0] <= relative <= self.post[1]:
+            return
+        if relative > self.post[1] and min(self.energy) - self.e0 <= self.pre[1]:
+            self.judge()
+        elif relative < self.pre[0] and max(self.energy) - self.e0 >= self.post[0]:
+            self.judge()
+
+    def stopping(self):
+        '''True if the scan in progress should measure no more points.'''
+        return self.enabled and self.bad
+
+    def per_step(self, detectors, step, pos_cache):
+        '''A per_step plan for scan_nd which measures a point as usual
+        until the scan has been judged bad, then skips the rest.'''
+        if self.stopping():
+            return (yield from null())
+        return (yield from one_nd_step(detectors, step, pos_cache))
+
+    def judge(self):
+        '''Make the verdict from the data collected so far.'''
+        en  = numpy.array(self.energy) - self.e0
+        i0  = numpy.array(self.i0)
+        mu  = numpy.array(self.signal)
+        pre  = (en >= self.pre[0])  & (en <= self.pre[1])  & numpy.isfinite(mu)
+        post = (en >= self.post[0]) & (en <= self.post[1]) & numpy.isfinite(mu)
+        if pre.sum() < self.min_points or post.sum() < self.min_points:
+            return
+        self.decided = True
+        if numpy.mean(~numpy.isfinite(i0) | (i0 <= 0)) > 0.1:
+            self.bad, self.reason = True, 'no signal on I0'
+            return
+        slope, intercept = numpy.polyfit(en[pre], mu[pre], 1)
+        scatter = numpy.std(mu[pre] - (slope*en[pre] + intercept))
+        step = numpy.mean(mu[post] - (slope*en[post] + intercept))
+        if not numpy.isfinite(step) or abs(step) < self.min_snr * scatter:
+            self.bad, self.reason = True, f'edge step is only {abs(step)/scatter:.1f} times the pre-edge noise' if scatter > 0 else 'no edge step'
+
+    def replay(self, uid):
+        '''Run the documents of a historical run through the check and
+        return the verdict as (bad, reason).'''
+        for name, doc in user_ns['db'][uid].documents():
+            self(name, doc)
+        return (self.bad, self.reason)
+
+    def replay_many(self, uids):
+        '''Replay many historical runs and compare the live verdicts to the
+        classifier's verdicts on the complete scans.'''
+        verdicts = [self.replay(uid) for uid in uids]
+        scores   = user_ns['clf'].evaluate_many(uids)
+        agree, flagged = 0, 0
+        for uid, (bad, reason), score in zip(uids, verdicts, scores):
+            flagged += bad
+            if score is not None:
+                agree += (bad == (score[0] != 1))
+            if bad:
+                print(f'{uid}  {reason}')
+        print(f'{flagged} of {len(uids)} runs would have stopped their sequence, live verdict agrees with the classifier for {agree}')
+        return verdicts
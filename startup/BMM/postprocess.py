@@ -0,0 +1,146 @@
+import threading, traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from bluesky.plan_stubs import sleep
+
+from BMM.functions import whisper
+from BMM.logging   import report
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+class EndOfScanPipeline():
+    '''A bounded pool of worker threads for the processing that follows
+    each repetition of a scan sequence -- writing the XDI file,
+    evaluating the data, pushing to Google drive, reporting to Slack --
+    so that the RunEngine can begin the next repetition right away.
+
+    Each job has two parts.  The work part runs concurrently on the
+    worker pool.  The finish part is given the return value of the
+    work part and runs strictly in the order in which jobs were
+    submitted, so things like Slack messages and drive pushes happen in
+    scan order.
+
+    Exceptions from either part are caught and collected in the errors
+    attribute rather than interrupting the scan sequence.
+
+    In a plan:
+
+    >>> pipeline = EndOfScanPipeline()
+    >>> yield from pipeline.submit_plan(label, work, finish)
+    >>> ...
+    >>> yield from pipeline.wait_plan()
+    >>> pipeline.report_errors()
+
+    Attributes
+    ----------
+    max_workers : int
+        number of worker threads
+    max_pending : int
+        number of unfinished jobs allowed before submission waits (back-pressure)
+    errors : list of tuple
+        (label, exception, traceback text) for each failure
+    jobs : list of Future
+        jobs which have not yet finished, finished jobs are forgotten
+    '''
+    def __init__(self, max_workers=2, max_pending=4):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.errors      = []
+        self.jobs        = []
+        self.__executor  = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='BMM-postprocess')
+        self.__slots     = threading.BoundedSemaphore(max_pending)
+        self.__last      = None   # event set when the previous job's finish part is done
+        self.__lock      = threading.Lock()
+
+    def __run(self, label, work, finish, previous, done):
+        try:
+            ok, result = True, None
+            try:
+                result = work()
+            except Exception as E:
+                ok = False
+                self.__fail(label, E)
+            if previous is not None:
+                previous.wait()
+            if ok and finish is not None:
+                try:
+                    finish(result)
+                except Exception as E:
+                    self.__fail(label, E)
+        finally:
+            done.set()
+            self.__slots.release()
+
+    def __fail(self, label, E):
+        with self.__lock:
+            self.errors.append((label, E, traceback.format_exc()))
+
+    def full(self):
+        '''True if submitting a job now would block.'''
+        return self.pending() >= self.max_pending
+
+    def pending(self):
+        with self.__lock:
+            return sum(1 for f in self.jobs if not f.done())
+
+    def __forget(self, future):
+        with self.__lock:
+            if future in self.jobs:
+                self.jobs.remove(future)
+
+    def submit(self, label, work, finish=None):
+        '''Queue a job, blocking if max_pending jobs are already unfinished.
+
+        Parameters
+        ----------
+        label : str
+            name for the job, used when reporting errors
+        work : callable
+            called with no arguments on a worker thread
+        finish : callable
+            called with the return value of work, in submission order
+        '''
+        self.__slots.acquire()
+        done = threading.Event()
+        future = self.__executor.submit(self.__run, label, work, finish, self.__last, done)
+        self.__last = done
+        with self.__lock:
+            self.jobs.append(future)
+        future.add_done_callback(self.__forget)
+        return future
+
+    def submit_plan(self, label, work, finish=None):
+        '''Plan version of submit which sleeps, rather than blocks the
+        RunEngine, while the pipeline is full.'''
+        while self.full():
+            yield from sleep(0.1)
+        self.submit(label, work, finish)
+
+    def wait(self, timeout=None):
+        '''Block until all submitted jobs are complete, return the list of errors.'''
+        with self.__lock:
+            jobs = list(self.jobs)
+        for f in jobs:
+            f.result(timeout=timeout)
+        return self.errors
+
+    def wait_plan(self):
+        '''Plan version of wait which sleeps rather than blocks the RunEngine.'''
+        while self.pending() > 0:
+            yield from sleep(0.1)
+        return self.errors
+
+    def report_errors(self):
+        '''Print and log every collected error, then forget them.  Return
+        the number of errors.'''
+        with self.__lock:
+            errors, self.errors = self.errors, []
+        for (label, E, tb) in errors:
+            report(f'End of scan processing failed for {label}: {E}', level='error', slack=True)
+            print(whisper(tb))
+        return len(errors)
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=True)
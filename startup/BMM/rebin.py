@@ -0,0 +1,330 @@
+import os, copy
+import numpy, pandas
+
+from BMM.functions      import HBARC, error_msg, whisper, plotting_mode
+from BMM.logging        import report
+from BMM.runcache       import CachedRun
+from BMM.xafs_functions import conventional_grid
+from BMM.xdi            import prepare_XDI, write_XDI_block
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+def bragg_to_energy(angle, twod, offset=0):
+    '''Convert Bragg angle in degrees (scalar or array) to energy in eV.
+    offset is added to the angle, use it when the angles are dial or
+    encoder positions rather than user positions.'''
+    return 2*numpy.pi*HBARC / (twod*numpy.sin(numpy.radians(numpy.asarray(angle, dtype=numpy.float64) + offset)))
+
+
+def grid_edges(grid):
+    '''Return the bin boundaries for an energy grid, half way between
+    grid points, with the outer bins as wide as their neighbors.'''
+    grid = numpy.asarray(grid, dtype=numpy.float64)
+    middle = (grid[1:] + grid[:-1]) / 2
+    return numpy.concatenate([[grid[0] - (grid[1]-grid[0])/2], middle, [grid[-1] + (grid[-1]-grid[-2])/2]])
+
+
+class BinAccumulator():
+    '''Time-weighted accumulation of samples into energy bins.
+
+    For each bin, the sum of weights, the weighted sum and the weighted
+    sum of squares of the values, and the number of samples are kept, so
+    samples can be added a chunk at a time and memory use does not
+    depend on the number of samples.  Values are accumulated relative
+    to the first value seen, to keep the sum of squares accurate.
+
+    >>> acc = BinAccumulator(edges)
+    >>> acc.add(energy, values, weights)
+    >>> mean, stderr, count = acc.result()
+    '''
+    def __init__(self, edges):
+        self.edges  = numpy.asarray(edges, dtype=numpy.float64)
+        nbins       = len(self.edges) - 1
+        self.weight = numpy.zeros(nbins)
+        self.sum    = numpy.zeros(nbins)
+        self.sumsq  = numpy.zeros(nbins)
+        self.count  = numpy.zeros(nbins, dtype=numpy.int64)
+        self.shift  = None
+
+    def add(self, energy, values, weights):
+        index = numpy.searchsorted(self.edges, energy, side='right') - 1
+        ok    = (index >= 0) & (index < len(self.weight)) & numpy.isfinite(values)
+        if not ok.any():
+            return
+        index, values, weights = index[ok], values[ok], weights[ok]
+        if self.shift is None:
+            self.shift = float(values[0])
+        x = values - self.shift
+        n = len(self.weight)
+        self.weight += numpy.bincount(index, weights=weights,     minlength=n)
+        self.sum    += numpy.bincount(index, weights=weights*x,   minlength=n)
+        self.sumsq  += numpy.bincount(index, weights=weights*x*x, minlength=n)
+        self.count  += numpy.bincount(index, minlength=n)
+
+    def result(self):
+        '''Return the time-weighted mean, its standard error, and the
+        number of samples in each bin.  Empty bins are nan.'''
+        shift = self.shift or 0
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean     = self.sum / self.weight
+            variance = numpy.maximum(self.sumsq / self.weight - mean*mean, 0)
+            stderr   = numpy.where(self.count > 1, numpy.sqrt(variance / self.count), numpy.nan)
+        return mean + shift, stderr, self.count
+
+
+def rebin_arrays(times, values, bragg_times, bragg, edges, twod, offset=0, chunk=1000000):
+    '''Rebin one time-stamped detector stream onto energy bins.
+
+    Each sample is taken as the average over the interval since the
+    previous sample, so it is weighted by the length of that interval
+    and placed at the energy of the middle of the interval.  The energy
+    comes from interpolating the Bragg angle in time.
+
+    The inputs are only read chunk samples at a time, so they can be
+    numpy memmaps (e.g. numpy.load(fname, mmap_mode='r')) or h5py
+    datasets holding millions of samples.
+
+    Parameters
+    ----------
+    times, values : arrays
+        time stamps and values of the detector samples
+    bragg_times, bragg : arrays
+        time stamps and Bragg angles in degrees, times increasing
+    edges : array
+        energy bin boundaries, increasing
+    twod : float
+        2d spacing of the mono crystal
+    offset : float
+        added to the Bragg angles, see bragg_to_energy
+    chunk : int
+        number of samples processed at a time
+
+    Returns two BinAccumulators, for the detector values and for the energy.
+    '''
+    values_acc, energy_acc = BinAccumulator(edges), BinAccumulator(edges)
+    previous = None
+    for i in range(0, len(times), chunk):
+        t = numpy.asarray(times[i:i+chunk], dtype=numpy.float64)
+        v = numpy.asarray(values[i:i+chunk], dtype=numpy.float64)
+        if previous is None:
+            previous = t[0] - (numpy.median(numpy.diff(t)) if len(t) > 1 else 0)
+        dt = numpy.diff(t, prepend=previous)
+        previous = t[-1]
+        middle = t - dt/2
+        ## read only the part of the Bragg record which spans this chunk
+        lo = max(int(numpy.searchsorted(bragg_times, middle[0])) - 1, 0)
+        hi = int(numpy.searchsorted(bragg_times, middle[-1])) + 1
+        bt = numpy.asarray(bragg_times[lo:hi], dtype=numpy.float64)
+        ba = numpy.asarray(bragg[lo:hi],       dtype=numpy.float64)
+        inside = (middle >= bt[0]) & (middle <= bt[-1]) & (dt > 0)
+        energy = bragg_to_energy(numpy.interp(middle, bt, ba), twod, offset)
+        values_acc.add(energy[inside], v[inside], dt[inside])
+        energy_acc.add(energy[inside], energy[inside], dt[inside])
+    return values_acc, energy_acc
+
+
+def rebin_tables(tables, grid, twod, offset=0, angle='dcm_bragg', chunk=1000000):
+    '''Rebin every detector stream of a fly scan onto an energy grid.
+
+    Parameters
+    ----------
+    tables : dict
+        data key -> (times, values), including the Bragg angle
+    grid : array
+        energy grid, as from conventional_grid
+    angle : str
+        data key of the Bragg angle
+
+    Returns a DataFrame laid out like the primary table of a step scan
+    (dcm_energy, dcm_energy_setpoint, dwti_dwell_time, then a column for
+    each detector), with a <key>_stderr column for each detector and a
+    count column.  Bins with no samples are dropped.
+    '''
+    edges = grid_edges(grid)
+    bragg_times, bragg = tables[angle]
+    data, stderr, energy, count = dict(), dict(), None, None
+    for key, (times, values) in tables.items():
+        if key == angle:
+            continue
+        values_acc, energy_acc = rebin_arrays(times, values, bragg_times, bragg, edges, twod, offset, chunk)
+        data[key], stderr[f'{key}_stderr'], n = values_acc.result()
+        if energy is None:
+            energy, count, dwell = energy_acc.result()[0], n, values_acc.weight
+    keep  = count > 0
+    table = pandas.DataFrame({'dcm_energy':          energy[keep],
+                              'dcm_energy_setpoint': numpy.asarray(grid)[keep],
+                              'dwti_dwell_time':     dwell[keep],
+                              **{k: v[keep] for k, v in data.items()},
+                              **{k: v[keep] for k, v in stderr.items()},
+                              'count':               count[keep]})
+    table.index = pandas.RangeIndex(1, len(table)+1, name='seq_num')
+    return table
+
+
+def xmu_stderr(table, mode):
+    '''Propagate the standard errors of the rebinned detector columns to
+    the standard error of xmu, treating the detectors as uncorrelated.
+    Returns None for modes where this is not done.'''
+    BMMuser = user_ns['BMMuser']
+    rel = lambda k: table[f'{k}_stderr'] / table[k]
+    if plotting_mode(mode) == 'xs':
+        channels = [BMMuser.xs1, BMMuser.xs2, BMMuser.xs3, BMMuser.xs4]
+        fluo     = sum(table[c] for c in channels)
+        sigma    = numpy.sqrt(sum(table[f'{c}_stderr']**2 for c in channels))
+        return (fluo / table['I0']) * numpy.sqrt((sigma/fluo)**2 + rel('I0')**2)
+    if 'trans' in mode:
+        return numpy.sqrt(rel('I0')**2 + rel('It')**2)
+    if 'ref' in mode:
+        return numpy.sqrt(rel('It')**2 + rel('Ir')**2)
+    return None
+
+
+def fly_tables(run, angle='dcm_bragg'):
+    '''Return the monitor streams of a fly scan as a dict of (times,
+    values) keyed by data key.
+
+    The detector streams are returned as dask arrays, so nothing is
+    read until rebin_arrays asks for a chunk of samples.  The Bragg
+    angle stream, which is searched for every chunk, is read into
+    memory.
+    '''
+    tables = dict()
+    for stream in run:
+        if not stream.endswith('_monitor'):
+            continue
+        key = stream[:-len('_monitor')]
+        if key == angle:
+            ds = run[stream].read()
+            tables[key] = (ds['time'].values.astype(numpy.float64), ds[key].values.astype(numpy.float64))
+        else:
+            ds = run[stream].to_dask()
+            tables[key] = (ds['time'].data, ds[key].data)
+    return tables
+
+
+def rebin(uid, filename=None, folder=None, bounds=None, steps=None, times=None, offset=0, chunk=1000000):
+    '''Put a fly scan on a conventional step scan grid and write it as
+    an XDI file.
+
+    The grid is made by conventional_grid from bounds, steps, and times,
+    relative to the edge energy of the fly scan, and is trimmed to the
+    range actually measured.  By default, the steps are those of a
+    step scan, 10 eV before the edge, 0.5 eV through the edge, and 0.05
+    inverse Angstroms above, over the bounds of the fly scan.  Each
+    detector is the time-weighted average of its samples in each bin.
+    The dwell time column holds the time spent in each bin and the
+    standard error of xmu is written as an extra column.
+
+    Parameters
+    ----------
+    uid : str
+        uid of the fly scan
+    filename : str
+        name of the XDI file (default: element-edge-fly.<first 8 of uid>)
+    folder : str
+        output folder (default: BMMuser.DATA)
+    bounds, steps, times : list
+        grid parameters as for xafs() (steps and times as for conventional_grid)
+    offset : float
+        added to the recorded Bragg angles, see bragg_to_energy
+    chunk : int
+        number of samples processed at a time
+
+    Returns the fully resolved name of the file written and the rebinned table.
+
+    >>> rebin(uid, 'Fe-foil-fly.001')
+    '''
+    BMMuser, db = user_ns['BMMuser'], user_ns['db']
+    run   = db.v2[uid]
+    start = copy.deepcopy(dict(run.metadata['start']))
+    stop  = dict(run.metadata['stop'] or {})
+    xdi   = start['XDI']
+    e0    = float(start.get('e0', xdi['Scan']['edge_energy']))
+    twod  = 2*float(xdi['Mono']['d_spacing'])
+    mode  = xdi['_mode'][0] if isinstance(xdi['_mode'], (list, tuple)) else xdi['_mode']
+    if plotting_mode(mode) == 'fluo':
+        print(error_msg(f'{uid} was measured in fluorescence with the Struck/Vortex, which is not buffered in a fly scan.'))
+        return None, None
+
+    if bounds is None:
+        low, high = start['bounds']
+        bounds = [low, -30, 15, high] if low < -30 and high > 15 else [low, high]
+    if steps is None:
+        steps = [10, 0.5, '0.05k'] if len(bounds) == 4 else [0.5]
+    if times is None:
+        times = [1] * (len(bounds)-1)
+    grid = conventional_grid(bounds, steps, times, e0=e0, element=xdi['Element']['symbol'], edge=xdi['Element']['edge'])[0]
+    if grid is None:
+        print(error_msg('Cannot interpret the grid parameters for rebinning.'))
+        return None, None
+
+    tables = fly_tables(run)
+    table  = rebin_tables(tables, grid, twod, offset=offset, chunk=chunk)
+    nsamples = sum(len(t) for t, v in tables.values())
+
+    ## write through the XDI writer, as if the rebinned fly scan were a step scan
+    if folder is None:
+        folder = BMMuser.DATA
+    if filename is None:
+        filename = f'{xdi["Element"]["symbol"]}-{xdi["Element"]["edge"]}-fly.{uid[:8]}'
+    datafile = os.path.join(folder, filename)
+    xdi['_filename'] = filename
+    lines, template, data = prepare_XDI(CachedRun(start, stop, [], {'primary': table.copy(), 'baseline': pandas.DataFrame()}))
+    sigma = xmu_stderr(table, mode)
+    if sigma is not None:
+        ncol = data.shape[1] + 1
+        lines.insert(lines.index('# ///////////'), f'# Column.{ncol}: xmu_stderr')
+        lines[-1] += '  xmu_stderr'
+        data = numpy.column_stack([data, sigma.to_numpy()])
+        template = template.rstrip('\n') + '  %.6f\n'
+    write_XDI_block(datafile, lines, template, data)
+    report(f'rebinned {nsamples} fly scan samples onto {len(table)} points, wrote {datafile}', level='bold')
+    return datafile, table
+
+
+def check_rebin(nsamples=2000000, e0=7112, twod=6.2712, chunk=250000, seed=0):
+    '''Check rebin_tables against synthetic fly scan data: an arctangent
+    edge in It with Gaussian noise, sampled nsamples times.  The
+    rebinned xmu must match the noiseless edge to within a few standard
+    errors, and the standard errors must be consistent with the scatter.
+    The samples are written to and read back from temporary memmaps, as
+    with a real scan too large for memory.
+
+    Returns the rebinned table.
+    '''
+    import tempfile, time
+    rng      = numpy.random.default_rng(seed)
+    duration = 60.0
+    energy   = numpy.linspace(e0-40, e0+90, 2000)
+    bragg    = numpy.degrees(numpy.arcsin(2*numpy.pi*HBARC / (twod*energy)))
+    bt       = numpy.linspace(0, duration, len(bragg))
+    mu       = lambda e: 1.5 + numpy.arctan((e-e0)/2)/numpy.pi
+
+    with tempfile.TemporaryDirectory() as folder:
+        arrays = dict()
+        for name, values in (('t', lambda t: t),
+                             ('I0', lambda t: 100 + rng.normal(0, 1, len(t))),
+                             ('It', lambda t: 100*numpy.exp(-mu(numpy.interp(t, bt, energy))) + rng.normal(0, 0.2, len(t)))):
+            arrays[name] = numpy.lib.format.open_memmap(os.path.join(folder, f'{name}.npy'), mode='w+', dtype=numpy.float64, shape=(nsamples,))
+            for i in range(0, nsamples, chunk):
+                t = duration*numpy.arange(i, min(i+chunk, nsamples))/(nsamples-1) if name == 't' else arrays['t'][i:i+chunk]
+                arrays[name][i:i+chunk] = values(t)
+        t0 = time.time()
+        grid  = numpy.concatenate([numpy.arange(e0-30, e0-10, 5.), numpy.arange(e0-10, e0+30, 0.5), numpy.arange(e0+30, e0+80, 2.)])
+        table = rebin_tables({'dcm_bragg': (bt, bragg), 'I0': (arrays['t'], arrays['I0']), 'It': (arrays['t'], arrays['It'])},
+                             grid, twod, chunk=chunk)
+        elapsed = time.time() - t0
+
+    xmu   = numpy.log(table['I0'] / table['It'])
+    sigma = numpy.sqrt((table['I0_stderr']/table['I0'])**2 + (table['It_stderr']/table['It'])**2)
+    ## compare with the time-weighted average of the noiseless edge in each bin
+    expected = numpy.array([mu(numpy.linspace(a, b, 201)).mean() for a, b in zip(grid_edges(grid)[:-1], grid_edges(grid)[1:])])
+    z = (xmu - expected[numpy.searchsorted(grid, table['dcm_energy_setpoint'])]) / sigma
+    assert len(table) == len(grid), 'bins were lost'
+    assert numpy.abs(z).max() < 6, f'rebinned xmu is off by {numpy.abs(z).max():.1f} standard errors'
+    assert 0.5 < z.std() < 1.5, f'standard errors are inconsistent with the scatter ({z.std():.2f})'
+    print(whisper(f'rebinned {3*nsamples} samples onto {len(table)} points in {elapsed:.2f} s, '
+                  f'{3*nsamples/elapsed/1e6:.1f} M samples/sec, residuals {z.std():.2f} standard errors'))
+    return table
@@ -0,0 +1,227 @@
+import numpy
+
+from bluesky.plan_stubs import mv
+
+from BMM.dcm       import dcm_angles
+from BMM.functions import whisper
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+class BraggMotion():
+    '''Time cost model for a move of the Bragg axis.
+
+    The move is taken to follow a trapezoidal velocity profile.  The
+    acceleration is specified, as for the EPICS motor record, as the
+    time taken to reach full velocity.  A move that is long enough to
+    reach full velocity takes
+
+        t = distance / velocity + acceleration
+
+    and a shorter move, which never reaches full velocity, takes
+
+        t = 2 * sqrt(distance * acceleration / velocity)
+
+    A fixed settling time is added to every move.  All of this works on
+    scalars or arrays of distances.
+
+    >>> motion = BraggMotion.from_motor(dcm_bragg)
+    >>> motion.move_time(1.5, BMMuser.acc_slow)
+
+    Attributes
+    ----------
+    velocity : float
+        full speed of the Bragg axis in degrees per second
+    settle : float
+        time in seconds added to every move for settling and overhead
+    '''
+    def __init__(self, velocity=1.0, settle=0.2):
+        self.velocity = velocity
+        self.settle   = settle
+
+    @classmethod
+    def from_motor(cls, motor, settle=0.2):
+        '''Make a cost model using the velocity of an actual (or simulated) motor.'''
+        try:
+            velocity = float(motor.velocity.get())
+        except Exception:
+            velocity = 1.0
+        return cls(velocity=velocity if velocity > 0 else 1.0, settle=settle)
+
+    def move_time(self, distance, acceleration):
+        distance = numpy.abs(numpy.asarray(distance, dtype=float))
+        ramp     = self.velocity * acceleration   # distance covered while accelerating and decelerating
+        full     = distance / self.velocity + acceleration
+        short    = 2 * numpy.sqrt(distance * acceleration / self.velocity)
+        return numpy.where(distance == 0, 0, numpy.where(distance >= ramp, full, short) + self.settle)
+
+
+class BMMRewindPlanner():
+    '''Plan the moves of the mono between the repetitions of an XAFS
+    scan sequence.
+
+    Before each repetition, the mono is put just outside the end of the
+    energy grid from which the repetition starts.  Every one of these
+    moves is made at the slow Bragg acceleration, as for any rewind at
+    BMM (see BMMuser.acc_slow).  Setting fast_span to a positive number
+    of degrees makes moves no longer than that at the fast acceleration
+    instead.  Whether short moves at the fast acceleration are safe for
+    the Bragg axis has not been established, so this is off by default.
+
+    When measuring in both directions is allowed, the planner chooses
+    the direction of each repetition (by dynamic programming over the
+    end position of each repetition) to minimize the total time spent
+    moving between repetitions, starting from the current position of
+    the mono.  Otherwise, every repetition is measured forward.  The
+    step moves within a repetition take the same time in either
+    direction, so only the moves between repetitions are considered.
+
+    The plan is a list with one dict per repetition:
+
+        direction    : 'forward' or 'backward'
+        target       : energy to move to before the repetition
+        acceleration : Bragg acceleration time for that move
+        cost         : predicted time in seconds for that move
+
+    >>> sequence = rewinder.plan(energy_grid, nscans, start=dcm.energy.readback.get(), bothways=True)
+    >>> yield from rewinder.rewind_plan(sequence[0], dcm.energy, dcm_bragg)
+
+    The motors are arguments of rewind_plan so that simulated motors
+    can be substituted for testing.
+
+    Attributes
+    ----------
+    margin : float
+        distance in eV beyond the end of the grid to which the mono is moved
+    fast_span : float
+        longest move, in degrees of Bragg angle, made at the fast acceleration
+        (default: 0, every move is made at the slow acceleration)
+    motion : BraggMotion
+        cost model for the Bragg axis (default: made from dcm_bragg when planning)
+    '''
+    def __init__(self, margin=5, fast_span=0, motion=None):
+        self.margin    = margin
+        self.fast_span = fast_span
+        self.motion    = motion
+        self.last      = None
+
+    def _bragg(self, energy, twod):
+        return dcm_angles(energy, twod, 30)[0]
+
+    def _move(self, frm, to, twod, acc_fast, acc_slow, motion):
+        '''Return (acceleration, cost) for a move of the mono between two energies.'''
+        distance = abs(float(self._bragg(to, twod) - self._bragg(frm, twod)))
+        acceleration = acc_fast if self.fast_span > 0 and distance <= self.fast_span else acc_slow
+        return acceleration, float(motion.move_time(distance, acceleration))
+
+    def plan(self, energy_grid, nscans, start=None, bothways=False, twod=None, acc_fast=None, acc_slow=None):
+        '''Plan the moves between the repetitions of a scan sequence.
+
+        Parameters
+        ----------
+        energy_grid : list or array
+            energy grid of a repetition, in the order of a forward scan
+        nscans : int
+            number of repetitions
+        start : float
+            current energy of the mono (default: the beginning of the grid)
+        bothways : bool
+            True if repetitions may be measured in the backward direction
+        twod : float
+            2d spacing of the mono (default: that of dcm)
+        acc_fast, acc_slow : float
+            Bragg acceleration times (default: those of BMMuser)
+
+        Returns the plan, a list of dicts.  The predicted savings
+        compared to the fixed policy (rewind before every forward
+        repetition, or strict alternation for bothways) are in the
+        last attribute.
+        '''
+        BMMuser = user_ns['BMMuser']
+        twod     = twod     if twod     is not None else user_ns['dcm']._twod
+        acc_fast = acc_fast if acc_fast is not None else BMMuser.acc_fast
+        acc_slow = acc_slow if acc_slow is not None else BMMuser.acc_slow
+        motion   = self.motion if self.motion is not None else BraggMotion.from_motor(user_ns['dcm_bragg'])
+
+        low, high = float(energy_grid[0]) - self.margin, float(energy_grid[-1]) + self.margin
+        position  = low if start is None else float(start)
+        entry = {'forward': low,  'backward': high}   # where each direction begins
+        exit  = {'forward': high, 'backward': low}    # and where it leaves the mono
+        directions = ('forward', 'backward') if bothways else ('forward',)
+
+        ## dynamic programming over the direction of the previous repetition
+        best = dict()   # direction of the latest repetition -> (total cost, plan)
+        for d in directions:
+            acc, cost = self._move(position, entry[d], twod, acc_fast, acc_slow, motion)
+            best[d] = (cost, [{'direction': d, 'target': entry[d], 'acceleration': acc, 'cost': cost}])
+        for n in range(1, nscans):
+            step = dict()
+            for d in directions:
+                options = []
+                for previous, (total, sequence) in best.items():
+                    acc, cost = self._move(exit[previous], entry[d], twod, acc_fast, acc_slow, motion)
+                    options.append((total+cost, sequence + [{'direction': d, 'target': entry[d], 'acceleration': acc, 'cost': cost}]))
+                step[d] = min(options, key=lambda o: o[0])
+            best = step
+        total, sequence = min(best.values(), key=lambda o: o[0])
+
+        baseline = self.cost(self.fixed_policy(energy_grid, nscans, bothways), energy_grid, start, twod, acc_fast, acc_slow, motion)
+        self.last = {'planned': total, 'baseline': baseline, 'saved': baseline - total, 'nscans': nscans}
+        return sequence
+
+    def fixed_policy(self, energy_grid, nscans, bothways=False):
+        '''The sequence of directions used before this planner: always
+        forward, or forward and backward in strict alternation.'''
+        if bothways:
+            return ['forward' if n%2 == 0 else 'backward' for n in range(nscans)]
+        return ['forward'] * nscans
+
+    def cost(self, directions, energy_grid, start=None, twod=None, acc_fast=None, acc_slow=None, motion=None):
+        '''Predicted time spent moving between repetitions for a sequence
+        of directions, using the slow acceleration for every rewind to
+        the beginning of the grid and the fast acceleration otherwise, as
+        the fixed policy did.'''
+        BMMuser = user_ns['BMMuser']
+        twod     = twod     if twod     is not None else user_ns['dcm']._twod
+        acc_fast = acc_fast if acc_fast is not None else BMMuser.acc_fast
+        acc_slow = acc_slow if acc_slow is not None else BMMuser.acc_slow
+        motion   = motion   if motion   is not None else BraggMotion.from_motor(user_ns['dcm_bragg'])
+        low, high = float(energy_grid[0]) - self.margin, float(energy_grid[-1]) + self.margin
+        position, total = (low if start is None else float(start)), 0
+        for d in directions:
+            target, acc = (low, acc_slow) if d == 'forward' else (high, acc_fast)
+            total += float(motion.move_time(self._bragg(target, twod) - self._bragg(position, twod), acc))
+            position = high if d == 'forward' else low
+        return total
+
+    def report(self):
+        '''Print the predicted time saved by the most recent plan.'''
+        if self.last is None:
+            return
+        print(whisper(f'  mono moves between repetitions: {self.last["planned"]:.1f} s planned, '
+                      f'{self.last["baseline"]:.1f} s with fixed rewinds, '
+                      f'{self.last["saved"]:.1f} s saved over {self.last["nscans"]} repetitions'))
+
+    def rewind_plan(self, step, energy, bragg):
+        '''Make the move planned before a repetition, setting the Bragg
+        acceleration for the move, then returning it to the fast
+        acceleration for the measurement.
+
+        Parameters
+        ----------
+        step : dict
+            one element of the list returned by plan
+        energy : positioner
+            the energy axis of the mono (dcm.energy)
+        bragg : motor
+            the Bragg motor (dcm_bragg), whose acceleration is set
+        '''
+        BMMuser = user_ns['BMMuser']
+        if step['acceleration'] != BMMuser.acc_fast:
+            yield from mv(bragg.acceleration, step['acceleration'])
+        print(whisper('  Moving DCM to %.1f eV for a %s scan with acceleration time = %.2f sec' %
+                      (step['target'], step['direction'], step['acceleration'])))
+        yield from mv(energy, step['target'])
+        if step['acceleration'] != BMMuser.acc_fast:
+            yield from mv(bragg.acceleration, BMMuser.acc_fast)
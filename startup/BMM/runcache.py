@@ -0,0 +1,279 @@
+import threading
+from collections import OrderedDict
+from dateutil.tz import tzlocal
+import numpy, pandas
+
+from bluesky.callbacks import CallbackBase
+
+from BMM.functions import whisper
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+class CachedRun():
+    '''The documents and data tables of a single run, held in memory.
+
+    This quacks enough like a databroker v1 header to be handed to
+    write_XDI and like a v2 run to supply metadata to the data
+    evaluation and Larch tools.
+
+    Attributes
+    ----------
+    uid : str
+        uid of the run
+    start : dict
+        start document
+    stop : dict
+        stop document
+    descriptors : list of dict
+        event descriptors of the primary stream
+    tables : dict of DataFrame
+        data tables keyed by stream name, 'primary' and 'baseline'
+    nbytes : int
+        approximate memory footprint of the data tables
+    '''
+    def __init__(self, start, stop, descriptors=None, tables=None):
+        self.start       = start
+        self.stop        = stop
+        self.uid         = start['uid']
+        self.descriptors = descriptors or []
+        self.tables      = tables or dict()
+        self.nbytes      = sum(int(t.memory_usage(deep=True).sum()) for t in self.tables.values())
+
+    @classmethod
+    def from_header(cls, header):
+        '''Read the primary and baseline streams of a databroker v1 header, once.'''
+        tables = {'primary': header.table()}
+        try:
+            tables['baseline'] = header.table('baseline')
+        except Exception:
+            tables['baseline'] = pandas.DataFrame()
+        descriptors = [d for d in header.descriptors if d.get('name', 'primary') == 'primary']
+        return cls(dict(header.start), dict(header.stop or {}), descriptors, tables)
+
+    @property
+    def metadata(self):
+        return {'start': self.start, 'stop': self.stop}
+
+    def table(self, stream_name='primary'):
+        '''Return a copy of a data table, as with header.table().  A copy
+        is returned so that consumers can add columns freely.'''
+        if stream_name not in self.tables:
+            return pandas.DataFrame()
+        return self.tables[stream_name].copy()
+
+    def column(self, name, stream_name='primary'):
+        '''Return a single column of a data table as a numpy array.'''
+        return self.tables[stream_name][name].to_numpy()
+
+    def configuration(self, device, key):
+        '''Return a configuration value for a device from the primary descriptor.'''
+        for d in self.descriptors:
+            try:
+                return d['configuration'][device]['data'][key]
+            except KeyError:
+                continue
+        return None
+
+
+class BMMRunCache():
+    '''A per-uid, least-recently-used cache of runs for end-of-scan
+    processing.
+
+    After an XAFS repetition, the same run is used to write the XDI
+    file, to evaluate data quality, and to make the Larch plots for the
+    dossier.  Fetching it through this cache means that the catalog is
+    read only once per run.
+
+    >>> run = runcache[uid]
+    >>> table = run.table()
+
+    Any key accepted by db[...] (e.g. a scan_id) may be used, in which
+    case the header is read once and the run is cached by its uid.
+    Runs without a stop document, i.e. still in progress, are returned
+    but not cached, so a later lookup reads the completed run.
+
+    Attributes
+    ----------
+    max_bytes : int
+        eviction threshold for the total size of the cached data tables
+    hits : int
+        number of lookups satisfied from the cache
+    misses : int
+        number of lookups that required a catalog read
+    '''
+    def __init__(self, max_bytes=256*1024*1024):
+        self.max_bytes = max_bytes
+        self.hits      = 0
+        self.misses    = 0
+        self.nbytes    = 0
+        self.__runs    = OrderedDict()
+        self.__lock    = threading.RLock()
+
+    def __getitem__(self, key):
+        with self.__lock:
+            if key in self.__runs:
+                self.hits += 1
+                self.__runs.move_to_end(key)
+                return self.__runs[key]
+        header = user_ns['db'][key]
+        uid = header.start['uid']
+        with self.__lock:
+            if uid in self.__runs:
+                self.hits += 1
+                self.__runs.move_to_end(uid)
+                return self.__runs[uid]
+            self.misses += 1
+        run = CachedRun.from_header(header)
+        if run.stop:
+            self.put(run)
+        return run
+
+    def __contains__(self, uid):
+        return uid in self.__runs
+
+    def __len__(self):
+        return len(self.__runs)
+
+    def put(self, run):
+        '''Insert a CachedRun, then evict the oldest runs until the cache is
+        under its size limit.  The run just inserted is never evicted.'''
+        with self.__lock:
+            if run.uid in self.__runs:
+                self.nbytes -= self.__runs.pop(run.uid).nbytes
+            self.__runs[run.uid] = run
+            self.nbytes += run.nbytes
+            while self.nbytes > self.max_bytes and len(self.__runs) > 1:
+                uid, old = self.__runs.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    def clear(self):
+        with self.__lock:
+            self.__runs.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        '''Return a dict of cache statistics.'''
+        total = self.hits + self.misses
+        return {'hits'     : self.hits,
+                'misses'   : self.misses,
+                'hit_rate' : self.hits/total if total > 0 else 0.0,
+                'runs'     : len(self.__runs),
+                'nbytes'   : self.nbytes,
+                'max_bytes': self.max_bytes,}
+
+    def __repr__(self):
+        s = self.stats()
+        return (f'BMMRunCache: {s["runs"]} runs, {s["nbytes"]/1024/1024:.1f} of {s["max_bytes"]/1024/1024:.0f} MB, '
+                f'{s["hits"]} hits, {s["misses"]} misses')
+
+    def report(self):
+        print(whisper(repr(self)))
+
+
+class RunBuffer(CallbackBase):
+    '''A RunEngine subscriber which accumulates a run in memory as its
+    documents arrive.
+
+    Event data are collected into preallocated column arrays, sized
+    from num_points in the start document.  At the stop document the
+    columns are assembled into tables laid out like header.table() and
+    the resulting CachedRun is put into the run cache.  The XDI writer,
+    the data evaluation, and the dossier then consume the run without
+    reading from the database.
+
+    >>> buffer = RunBuffer()
+    >>> uid = yield from subs_wrapper(scan_nd(...), buffer)
+    >>> run = runcache[uid]    # a cache hit
+
+    Attributes
+    ----------
+    cache : BMMRunCache
+        cache into which completed runs are put (default: user_ns['runcache'])
+    run : CachedRun
+        the most recently completed run
+    '''
+    def __init__(self, cache=None, streams=('primary', 'baseline')):
+        super().__init__()
+        self.cache       = cache
+        self.streams     = streams
+        self.run         = None
+        self.__start     = None
+        self.__streams   = dict()   # descriptor uid -> stream name
+        self.__columns   = dict()   # stream name -> {key: array}
+        self.__times     = dict()   # stream name -> array of event times
+        self.__count     = dict()   # stream name -> number of events
+        self.__descriptors = []
+
+    def start(self, doc):
+        self.__start = doc
+        self.__streams.clear()
+        self.__columns.clear()
+        self.__times.clear()
+        self.__count.clear()
+        self.__descriptors = []
+        self.run = None
+
+    def descriptor(self, doc):
+        name = doc.get('name', 'primary')
+        if name not in self.streams:
+            return
+        self.__streams[doc['uid']] = name
+        if name == 'primary':
+            self.__descriptors.append(doc)
+        if name in self.__columns:
+            return
+        size = 2
+        if name == 'primary':
+            size = max(int(self.__start.get('num_points', 0) or 0), 16)
+        columns = dict()
+        for key, dk in doc['data_keys'].items():
+            if dk.get('shape', []) == [] and 'external' not in dk and dk['dtype'] in ('number', 'integer'):
+                columns[key] = numpy.full(size, numpy.nan, dtype=numpy.float64)
+            else:
+                columns[key] = numpy.empty(size, dtype=object)
+        self.__columns[name] = columns
+        self.__times[name]   = numpy.zeros(size, dtype=numpy.float64)
+        self.__count[name]   = 0
+
+    def event(self, doc):
+        name = self.__streams.get(doc['descriptor'])
+        if name is None:
+            return
+        i       = self.__count[name]
+        columns = self.__columns[name]
+        if i == len(self.__times[name]):
+            ## more events than num_points promised, double the storage
+            self.__times[name] = numpy.resize(self.__times[name], 2*i)
+            for key in columns:
+                grown = numpy.full(2*i, numpy.nan) if columns[key].dtype == numpy.float64 else numpy.empty(2*i, dtype=object)
+                grown[:i] = columns[key][:i]
+                columns[key] = grown
+        self.__times[name][i] = doc['time']
+        for key, value in doc['data'].items():
+            if key in columns:
+                columns[key][i] = value
+        self.__count[name] = i + 1
+
+    def table(self, stream_name='primary'):
+        '''Return the data collected so far for a stream as a DataFrame
+        with the same layout as header.table().'''
+        if stream_name not in self.__columns:
+            return pandas.DataFrame()
+        n = self.__count[stream_name]
+        data = {'time': pandas.to_datetime(self.__times[stream_name][:n], unit='s', utc=True).tz_convert(tzlocal()).tz_localize(None)}
+        for key, column in self.__columns[stream_name].items():
+            data[key] = column[:n]
+        return pandas.DataFrame(data, index=pandas.RangeIndex(1, n+1, name='seq_num'))
+
+    def stop(self, doc):
+        if self.__start is None:
+            return
+        tables = {name: self.table(name) for name in self.__columns}
+        if 'baseline' not in tables:
+            tables['baseline'] = pandas.DataFrame()
+        self.run = CachedRun(self.__start, doc, self.__descriptors, tables)
+        cache = self.cache if self.cache is not None else user_ns['runcache']
+        cache.put(self.run)
+        self.__start = None
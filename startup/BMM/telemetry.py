@@ -1,15 +1,62 @@
 from databroker import catalog
 from databroker.queries import TimeRange
-import numpy, json, os, time
+import numpy, json, os, time, math, random
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm           # progress bar
 
+from bluesky.callbacks import CallbackBase
+
+from BMM.functions     import whisper, HBARC
+from BMM.dcm_parameters import dcm_parameters
 from BMM.periodictable import element_symbol, edge_energy, Z_number
 
 from IPython import get_ipython
 user_ns = get_ipython().user_ns
 
 
-        
+class RunningStatistics():
+    '''Welford's streaming accumulator for the mean and (population)
+    standard deviation of a sequence of values, so that statistics can
+    be gathered without holding on to the values.
+
+    >>> rs = RunningStatistics()
+    >>> for x in values: rs.update(x)
+    >>> rs.mean, rs.std
+    '''
+    def __init__(self):
+        self.count = 0
+        self.mean  = math.nan
+        self.m2    = 0.0
+
+    def update(self, value):
+        self.count += 1
+        if self.count == 1:
+            self.mean = value
+            self.m2   = 0.0
+            return
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2   += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        if self.count == 0:
+            return math.nan
+        return math.sqrt(self.m2 / self.count)
+
+    def result(self):
+        return [self.mean, self.std]
+
+    @classmethod
+    def from_result(cls, count, result):
+        '''Resume accumulating from a count and a [mean, std] pair.'''
+        rs = cls()
+        if count > 0 and result is not None:
+            rs.count = count
+            rs.mean  = result[0]
+            rs.m2    = result[1]**2 * count
+        return rs
+
 
 
 class BMMTelementry():
@@ -29,8 +76,14 @@ class BMMTelementry():
         self.start_date  = '2019-09-01'
         self.reliability = 10
         self.beamdump    = 3
+        self.workers     = 8
         ###                         k-edges               l-edges
         self.all_elements = list(range(22, 46)) + list(range(55, 93))
+        self.__mtime      = None
+        self.__contents   = None
+        self.__energies   = None
+        self.__overheads  = None
+        self.duration     = BMMDurationModel(self)
 
         
     def records(self, element=None):
@@ -41,82 +94,150 @@ class BMMTelementry():
         print(f'Number of records for {element} since {self.start_date}: {len(element_search)}')
         return(element_search)
         
+    def measure(self, uid):
+        '''Return (elapsed time, measurement time, number of points) for
+        a run, or None if the run should not be counted.'''
+        db = user_ns['db']
+        this=db.v2[uid]
+
+        ## records that did not complete normally
+        if 'primary' in this.metadata['stop']['num_events']:
+            if this.metadata['start']['num_points'] != this.metadata['stop']['num_events']['primary']:
+                return None
+        try:
+            t = this.primary.read()['dwti_dwell_time']
+            measurement_time = float(t.sum())
+            elapsed_time = this.metadata['stop']['time'] - this.metadata['start']['time']
+
+            ## records that scan beam dumps or other pauses would skew the statistics
+            if elapsed_time/measurement_time > self.beamdump:
+                return None
+            return (elapsed_time, measurement_time, len(t))
+        except:
+            return None
+
     def overhead(self, element=None):
+        '''Compute the overhead statistics for an element.  Runs are
+        fetched from the catalog by a pool of worker threads and the
+        statistics are accumulated as the measurements arrive.'''
         if element is None: return(0)
-        db = user_ns['db']
         element_search = self.records(element)
-        ratio, difference, dpp = numpy.array([]), numpy.array([]), numpy.array([])
-        l = len(list(element_search))
-        if l == 0: return(0)
-        count = 0
-        for u in tqdm(list(element_search)):
-            
-            this=db.v2[u]
-
-            ## records that did not complete normally
-            if 'primary' in this.metadata['stop']['num_events']:
-                if this.metadata['start']['num_points'] != this.metadata['stop']['num_events']['primary']:
+        uids = list(element_search)
+        if len(uids) == 0: return({'count': 0})
+        ratio, difference, dpp = RunningStatistics(), RunningStatistics(), RunningStatistics()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for m in tqdm(executor.map(self.measure, uids), total=len(uids)):
+                if m is None:
                     continue
-            try:
-                t = this.primary.read()['dwti_dwell_time']
-                measurement_time = float(t.sum())
-                elapsed_time = this.metadata['stop']['time'] - this.metadata['start']['time']
+                elapsed_time, measurement_time, npoints = m
+                difference.update(elapsed_time - measurement_time)
+                ratio.update(elapsed_time/measurement_time)
+                dpp.update((elapsed_time - measurement_time) / npoints)
+        return({'count'     : ratio.count,
+                'ratio'     : ratio.result(),
+                'difference': difference.result(),
+                'dpp'       : dpp.result(),
+                'updated'   : time.time(),
+            })
 
-                ## records that scan beam dumps or other pauses would skew the statistics
-                if elapsed_time/measurement_time > self.beamdump:
-                    continue
+    def write(self, results):
+        '''Write results to the telemetry JSON file, atomically, so that an
+        interruption never leaves a partial file.'''
+        with open(self.json + '.part', 'w') as f:
+            f.write(json.dumps(results))
+        os.replace(self.json + '.part', self.json)
 
-                difference = numpy.append(difference, (elapsed_time - measurement_time))
-                ratio = numpy.append(ratio, elapsed_time/measurement_time)
-                diff_per_point = (elapsed_time - measurement_time) / len(t)
-                dpp = numpy.append(dpp, diff_per_point)
-                count = count + 1
-            except:
-                pass
-        return({'count'     : count,
-                'ratio'     : [ratio.mean(), ratio.std()],
-                'difference': [difference.mean(), difference.std()],
-                'dpp'       : [dpp.mean(), dpp.std()],
-            })
-    
+    def update(self, element, elapsed_time, measurement_time, npoints):
+        '''Fold the timing of one completed scan into the statistics for
+        an element and rewrite the telemetry file.'''
+        element = element_symbol(element)
+        results = {}
+        if os.path.isfile(self.json):
+            results = json.load(open(self.json))
+        this = results.get(element)
+        if not isinstance(this, dict) or 'count' not in this:
+            this = {'count': 0}
+        ratio, difference, dpp = [RunningStatistics.from_result(this['count'], this.get(key)) for key in ('ratio', 'difference', 'dpp')]
+        difference.update(elapsed_time - measurement_time)
+        ratio.update(elapsed_time/measurement_time)
+        dpp.update((elapsed_time - measurement_time) / npoints)
+        results[element] = {'count'     : ratio.count,
+                            'ratio'     : ratio.result(),
+                            'difference': difference.result(),
+                            'dpp'       : dpp.result(),
+                            'updated'   : this.get('updated', 0),}
+        self.write(results)
+        return results[element]
+
+    def periodic_table(self, elements=None, restart=False):
+        '''Rebuild the overhead statistics for every element, or for a list
+        of elements given as symbols or Z numbers.
 
-    ## TODO: take a list of integers/element symbols as an input
-    ## parameter, extract just those, modify json file for those
-    ## elements
-    def periodic_table(self, el=None):
+        The telemetry file is rewritten after each element.  If a
+        rebuild is interrupted, running this again picks up with the
+        first element not yet done in the interrupted rebuild.  Set
+        restart to True to begin again from the beginning.
+
+        This is slow -- it reads every XAFS scan since start_date.
+        '''
         start = time.time()
+        if elements is None:
+            elements = self.all_elements
+        elements = [element_symbol(el) for el in elements]
         results = {}
-        for z in self.all_elements:
-            el = element_symbol(z)
+        if os.path.isfile(self.json):
+            results = json.load(open(self.json))
+        rebuild = results.get('_rebuild')
+        if restart or rebuild is None or rebuild['elements'] != elements:
+            rebuild = {'started': start, 'elements': elements}
+        results['_rebuild'] = rebuild
+        for el in elements:
+            previous = results.get(el)
+            if isinstance(previous, dict) and previous.get('updated', 0) >= rebuild['started']:
+                print(f'{el} was done in the interrupted rebuild, skipping')
+                continue
             results[el] = self.overhead(el)
-            
-        j = json.dumps(results)
-        f = open(self.json,"w")
-        f.write(j)
-        f.close()
+            self.write(results)
+
+        del results['_rebuild']
+        self.write(results)
         end = time.time()
         print('\n\nThat took %.1f min' % ((end-start)/60))
         
 
+    def load(self):
+        '''Return the contents of the telemetry file, reading it only if it
+        has changed since the last time it was read.  The energies and
+        overheads used by interpolate are rebuilt at the same time.'''
+        mtime = os.stat(self.json).st_mtime_ns
+        if mtime != self.__mtime:
+            a = json.load(open(self.json))
+            e, t = [], []
+            for z in self.all_elements:
+                this = a.get(element_symbol(z))
+                if not isinstance(this, dict) or 'count' not in this:
+                    continue
+                if this['count'] < self.reliability:
+                    continue
+                t.append(this['dpp'][0])
+                if z < 46:
+                    e.append(edge_energy(z, 'k'))
+                else:
+                    e.append(edge_energy(z, 'l3'))
+            e, t = numpy.array(e), numpy.array(t)
+            s = numpy.argsort(e)
+            self.__energies, self.__overheads = e[s], t[s]
+            self.__contents, self.__mtime = a, mtime
+        return self.__contents
+
     def interpolate(self, energy):
-        a = json.load(open(self.json))
-        e, t = numpy.array([]), numpy.array([])
-        for z in self.all_elements:
-            if 'count' not in a[element_symbol(z)]:
-                continue
-            if a[element_symbol(z)]['count'] < self.reliability:
-                continue
-            t = numpy.append(t, a[element_symbol(z)]['dpp'][0])
-            if z < 46:
-                e=numpy.append(e, edge_energy(z, 'k'))
-            else:
-                e=numpy.append(e, edge_energy(z, 'l3'))
-                             
-        s=numpy.argsort(e)
-        return(numpy.interp(energy, e[s], t[s]))
+        '''Interpolate the overhead per point at an energy, or at each of
+        an array of energies.'''
+        self.load()
+        return(numpy.interp(energy, self.__energies, self.__overheads))
 
     def overhead_per_point(self, element, edge=None):
-        a = json.load(open(self.json))
+        a = self.load()
         element = element_symbol(element)
         if edge is not None and edge.lower() in ('l2', 'l1'):
             return([self.interpolate(edge_energy(element, edge)), 0])
@@ -128,4 +249,341 @@ class BMMTelementry():
                 if Z_number(element) > 45:
                     edge = 'l3'
             return([self.interpolate(edge_energy(element, edge)), 0])
-        
+
+
+def detector_class(start):
+    '''Return 'xs', 'fluo', or 'trans' for the detectors used in a run,
+    from the XDI metadata in its start document.'''
+    try:
+        detector = start['XDI']['Detector']
+    except (KeyError, TypeError):
+        return 'trans'
+    if 'Xspress3' in str(detector.get('deadtime_correction', '')):
+        return 'xs'
+    if 'fluorescence' in detector:
+        return 'fluo'
+    return 'trans'
+
+
+class BMMDurationModel():
+    '''A model of the time taken by each point of a step scan, fitted
+    to the event time stamps of past XAFS scans.
+
+    For each detector configuration (transmission, Struck, Xspress3),
+    the interval between successive events is fitted as
+
+        interval = a + b * |change in Bragg angle| + c * dwell time
+
+    The time from the start document to the first event and from the
+    last event to the stop document is fitted as a constant.  The gap
+    between consecutive scans of a sequence is fitted as
+
+        gap = g0 + g1 * (Bragg angle rewound)
+
+    where the rewind is the angular span of the scan if the mono
+    returned to the beginning of the scan (i.e. not bothways).  The
+    gap is fitted from the consecutive scans found among the runs
+    sampled, no other runs are read for it.
+
+    >>> tele.duration.fit()        # slow, reads nruns scans from the catalog
+    >>> tele.duration.predict(grid, timegrid, detector='trans', rewind=True)
+
+    Attributes
+    ----------
+    json : str
+        file in which the fitted model is saved
+    nruns : int
+        number of historical scans sampled by fit
+    holdout : float
+        fraction of the sampled scans held out for the accuracy report
+    maxgap : float
+        intervals more than this many seconds beyond the dwell time are
+        taken to be pauses and excluded from the fit
+    '''
+    def __init__(self, tele):
+        self.tele    = tele
+        self.json    = os.path.join(tele.folder, 'duration.json')
+        self.nruns   = 2000
+        self.holdout = 0.2
+        self.maxgap  = 30
+        self.model   = None
+        if os.path.isfile(self.json):
+            self.model = json.load(open(self.json))
+
+    def bragg(self, energy, twod=None):
+        '''Bragg angle in degrees for an energy or array of energies.'''
+        if twod is None:
+            twod = user_ns['dcm']._twod if 'dcm' in user_ns else 2*dcm_parameters().dspacing_111
+        return numpy.degrees(numpy.arcsin(2*numpy.pi*HBARC / (numpy.asarray(energy, dtype=numpy.float64)*twod)))
+
+    def measure(self, uid):
+        '''Return the timing of a run as a dict, or None if the run
+        should not be used.'''
+        db = user_ns['db']
+        try:
+            this  = db.v2[uid]
+            start, stop = this.metadata['start'], this.metadata['stop']
+            if stop is None or stop.get('exit_status') != 'success':
+                return None
+            data = this.primary.read()
+            if len(data['time']) < 3:
+                return None
+            twod = None
+            if start['XDI']['Mono'].get('d_spacing') not in (None, ''):
+                twod = 2*float(start['XDI']['Mono']['d_spacing'])
+            theta = self.bragg(data['dcm_energy'].values, twod)
+            measured = {'uid'      : uid,
+                        'element'  : start['XDI']['Element']['symbol'],
+                        'detector' : detector_class(start),
+                        'times'    : numpy.asarray(data['time'].values, dtype=numpy.float64),
+                        'dwell'    : numpy.asarray(data['dwti_dwell_time'].values, dtype=numpy.float64),
+                        'theta'    : theta,
+                        'elapsed'  : stop['time'] - start['time'],
+                        'gap'      : None,}
+            measured['ends'] = (measured['times'][0] - start['time'] - measured['dwell'][0]) + (stop['time'] - measured['times'][-1])
+            measured.update({'scan_id'   : start['scan_id'],
+                             'filename'  : start['XDI'].get('_filename', ''),
+                             'direction' : start['XDI']['Mono'].get('direction', 'forward'),
+                             'started'   : start['time'],
+                             'stopped'   : stop['time'],})
+            return measured
+        except Exception:
+            return None
+
+    def gaps(self, runs):
+        '''Set the time since the previous scan for each run whose previous
+        scan in the same sequence is also among runs.  Only the runs in
+        hand are used, nothing more is read from the catalog.  The gap
+        of a run is left as None if its previous scan is not in hand or
+        cannot be matched.'''
+        by_id = {r['scan_id']: r for r in runs}
+        for r in runs:
+            previous = by_id.get(r['scan_id']-1)
+            if previous is None:
+                continue
+            try:
+                here, there = os.path.splitext(r['filename']), os.path.splitext(previous['filename'])
+                if here[0] == there[0] and int(here[1][1:]) == int(there[1][1:])+1 and r['started'] >= previous['stopped']:
+                    rewound = r['direction'] == 'forward' and previous['direction'] == 'forward'
+                    r['gap']     = r['started'] - previous['stopped']
+                    r['rewound'] = abs(r['theta'][0] - r['theta'][-1]) if rewound else 0.0
+            except Exception:
+                r['gap'] = None
+        return runs
+
+    def fit(self, uids=None, seed=0):
+        '''Fit the model to a random sample of past XAFS scans (or to a
+        list of uids), save it, and report its accuracy on the scans
+        held out of the fit.'''
+        if uids is None:
+            query = TimeRange(since=self.tele.start_date, until='2040')
+            uids  = list(self.tele.bc.search(query).search({'XDI._kind':'xafs'}))
+        uids = list(uids)
+        random.Random(seed).shuffle(uids)
+        uids = uids[:self.nruns]
+        with ThreadPoolExecutor(max_workers=self.tele.workers) as executor:
+            runs = [m for m in tqdm(executor.map(self.measure, uids), total=len(uids)) if m is not None]
+        self.gaps(runs)
+        ntest = int(len(runs)*self.holdout)
+        test, train = runs[:ntest], runs[ntest:]
+
+        model = {'fitted': time.time(), 'detectors': dict()}
+        for det in sorted(set(r['detector'] for r in train)):
+            these = [r for r in train if r['detector'] == det]
+            interval = numpy.concatenate([numpy.diff(r['times']) for r in these])
+            dtheta   = numpy.concatenate([numpy.abs(numpy.diff(r['theta'])) for r in these])
+            dwell    = numpy.concatenate([r['dwell'][1:] for r in these])
+            keep     = (interval - dwell) < self.maxgap
+            A = numpy.column_stack([numpy.ones(keep.sum()), dtheta[keep], dwell[keep]])
+            coefficients = numpy.linalg.lstsq(A, interval[keep], rcond=None)[0]
+            residual = interval[keep] - A @ coefficients
+            ends = numpy.array([r['ends'] for r in these])
+            ends = ends[ends < self.maxgap]
+            this = {'coefficients': coefficients.tolist(),
+                    'sigma'       : float(residual.std()),
+                    'ends'        : [float(ends.mean()), float(ends.std())] if len(ends) > 0 else [0.0, 0.0],
+                    'gap'         : [0.0, 0.0],
+                    'gap_sigma'   : 0.0,
+                    'npoints'     : int(keep.sum()),
+                    'nruns'       : len(these),}
+            gaps = [r for r in these if r['gap'] is not None and r['gap'] < 10*self.maxgap]
+            if len(gaps) > 2:
+                G = numpy.column_stack([numpy.ones(len(gaps)), [r['rewound'] for r in gaps]])
+                g = numpy.array([r['gap'] for r in gaps])
+                this['gap']       = numpy.linalg.lstsq(G, g, rcond=None)[0].tolist()
+                this['gap_sigma'] = float((g - G @ numpy.array(this['gap'])).std())
+            model['detectors'][det] = this
+        self.model = model
+        with open(self.json, 'w') as f:
+            f.write(json.dumps(model, indent=2))
+        print(whisper(f'fitted duration model to {len(train)} scans, wrote {self.json}'))
+        return self.report(test)
+
+    def available(self, detector='trans'):
+        return self.model is not None and detector in self.model['detectors']
+
+    def predict(self, grid, timegrid, detector='trans', rewind=True, twod=None):
+        '''Return the predicted time in seconds and its uncertainty for
+        one scan over an energy grid with the given dwell times,
+        including the time to get ready for the scan.  rewind is False
+        for scans measured bothways.  Returns None if the model has not
+        been fitted for the detector.'''
+        if not self.available(detector):
+            return None
+        this     = self.model['detectors'][detector]
+        a, b, c  = this['coefficients']
+        theta    = self.bragg(grid, twod)
+        timegrid = numpy.asarray(timegrid, dtype=numpy.float64)
+        rewound  = abs(theta[0] - theta[-1]) if rewind else 0.0
+        total    = timegrid[0] + this['ends'][0] + this['gap'][0] + this['gap'][1]*rewound
+        total   += numpy.sum(a + b*numpy.abs(numpy.diff(theta)) + c*timegrid[1:])
+        sigma    = numpy.sqrt((len(timegrid)-1)*this['sigma']**2 + this['ends'][1]**2 + this['gap_sigma']**2)
+        return (float(total), float(sigma))
+
+    def report(self, runs):
+        '''Compare the predicted and actual times of scans, for this model
+        and for the per-element overhead_per_point model.'''
+        result = dict()
+        for det in sorted(set(r['detector'] for r in runs)):
+            these = [r for r in runs if r['detector'] == det and self.available(det)]
+            if len(these) == 0:
+                continue
+            model, dpp, gap = [], [], []
+            this = self.model['detectors'][det]
+            for r in these:
+                actual = r['elapsed']
+                ## predict the start-to-stop time, the gap between scans is checked separately
+                a, b, c   = this['coefficients']
+                predicted = r['dwell'][0] + this['ends'][0] + numpy.sum(a + b*numpy.abs(numpy.diff(r['theta'])) + c*r['dwell'][1:])
+                model.append(abs(predicted - actual)/actual)
+                try:
+                    overhead = self.tele.overhead_per_point(r['element'])[0]
+                    dpp.append(abs(r['dwell'].sum() + len(r['dwell'])*overhead - actual)/actual)
+                except Exception:
+                    pass
+                if r['gap'] is not None:
+                    gap.append(abs(this['gap'][0] + this['gap'][1]*r['rewound'] - r['gap']))
+            result[det] = {'nruns'     : len(these),
+                           'model_mape': float(numpy.mean(model))*100,
+                           'dpp_mape'  : float(numpy.mean(dpp))*100 if len(dpp) > 0 else None,
+                           'gap_mae'   : float(numpy.mean(gap)) if len(gap) > 0 else None,}
+            text = f'{det:5}: {len(these)} held-out scans, mean error {result[det]["model_mape"]:.1f}% (per-element overhead: '
+            text += f'{result[det]["dpp_mape"]:.1f}%)' if result[det]['dpp_mape'] is not None else 'n/a)'
+            if result[det]['gap_mae'] is not None:
+                text += f', time between scans off by {result[det]["gap_mae"]:.1f} sec'
+            print(text)
+        return result
+
+
+class TelemetryUpdater(CallbackBase):
+    '''A RunEngine subscriber which folds each completed XAFS scan into
+    the telemetry statistics as its stop document arrives, so that
+    overhead_per_point is always current without a rebuild.
+
+    The same runs are excluded as in a rebuild: scans that did not
+    complete all their points and scans which took more than beamdump
+    times their measurement time.
+
+    >>> RE.subscribe(TelemetryUpdater(tele))
+    '''
+    def __init__(self, tele):
+        super().__init__()
+        self.tele      = tele
+        self.__start   = None
+        self.__primary = None
+        self.__dwell   = 0.0
+        self.__npoints = 0
+
+    def start(self, doc):
+        self.__start, self.__primary = None, None
+        self.__dwell, self.__npoints = 0.0, 0
+        try:
+            if doc['XDI']['_kind'] == 'xafs' and doc['XDI']['Element']['symbol'] is not None:
+                self.__start = doc
+        except (KeyError, TypeError):
+            pass
+
+    def descriptor(self, doc):
+        if self.__start is not None and doc.get('name') == 'primary':
+            self.__primary = doc['uid']
+
+    def event(self, doc):
+        if self.__primary is None or doc['descriptor'] != self.__primary:
+            return
+        if 'dwti_dwell_time' in doc['data']:
+            self.__dwell += float(doc['data']['dwti_dwell_time'])
+            self.__npoints += 1
+
+    def stop(self, doc):
+        start, self.__start = self.__start, None
+        if start is None or doc.get('exit_status') != 'success':
+            return
+        if self.__dwell <= 0 or self.__npoints != start.get('num_points', self.__npoints):
+            return
+        elapsed_time = doc['time'] - start['time']
+        if elapsed_time/self.__dwell > self.tele.beamdump:
+            return
+        try:
+            self.tele.update(start['XDI']['Element']['symbol'], elapsed_time, self.__dwell, self.__npoints)
+        except Exception as E:
+            print(whisper(f'telemetry update failed: {E}'))
+
+
+class PointTimer(CallbackBase):
+    '''A RunEngine subscriber which measures the overhead of each point
+    of a step scan, that is the time between successive events beyond
+    the dwell time of the later point.  At the stop document, the
+    overhead per point is reported along with the number of dwell time
+    writes skipped by _locked_dwell_time because the value did not
+    change, so the saving per point can be seen.
+
+    >>> RE.subscribe(pointtimer)
+    >>> pointtimer.overhead.mean
+
+    Attributes
+    ----------
+    overhead : RunningStatistics
+        overhead per point, in seconds, for the most recent run
+    verbose : bool
+        True to report at the end of each run
+    '''
+    def __init__(self, verbose=True):
+        super().__init__()
+        self.verbose   = verbose
+        self.overhead  = RunningStatistics()
+        self.__primary = None
+        self.__last    = None
+
+    def start(self, doc):
+        self.overhead  = RunningStatistics()
+        self.__primary = None
+        self.__last    = None
+        self.__plan    = doc.get('plan_name')
+        if '_locked_dwell_time' in user_ns and hasattr(user_ns['_locked_dwell_time'], 'reset_stats'):
+            user_ns['_locked_dwell_time'].reset_stats()
+
+    def descriptor(self, doc):
+        if doc.get('name') == 'primary':
+            self.__primary = doc['uid']
+
+    def event(self, doc):
+        if self.__primary is None or doc['descriptor'] != self.__primary:
+            return
+        if self.__last is not None and 'dwti_dwell_time' in doc['data']:
+            self.overhead.update(doc['time'] - self.__last - float(doc['data']['dwti_dwell_time']))
+        self.__last = doc['time']
+
+    def stop(self, doc):
+        if not self.verbose or self.overhead.count == 0:
+            return
+        text = f'{self.__plan}: {self.overhead.count+1} points, overhead {self.overhead.mean:.3f} +/- {self.overhead.std:.3f} sec/point'
+        if '_locked_dwell_time' in user_ns and hasattr(user_ns['_locked_dwell_time'], 'stats'):
+            stats = user_ns['_locked_dwell_time'].stats()
+            made    = sum(s['moves']   for s in stats.values())
+            skipped = sum(s['skipped'] for s in stats.values())
+            text += f', dwell time writes: {made} made, {skipped} skipped'
+            ## the real dwell times move concurrently, so a skipped point saves the slowest of them
+            saved = max((s['skipped']*s['elapsed']/s['moves'] for s in stats.values() if s['moves'] > 0), default=None)
+            if saved is not None:
+                text += f' (about {saved/(self.overhead.count+1):.3f} sec/point saved)'
+        print(whisper(text))
@@ -119,13 +119,14 @@ def timescan(detector, readings, dwell, delay, force=False, md={}):
 
     ## and this is the appropriate way to plot this linescan
     if detector == 'Dtc':
-        plot = [DerivedPlot(func,  xlabel='elapsed time (seconds)', ylabel='dtc2', title='time scan'),
-                DerivedPlot(func3, xlabel='elapsed time (seconds)', ylabel='dtc3', title='time scan')]
+        plot = [DerivedPlot(func,  xlabel='elapsed time (seconds)', ylabel='dtc2', title='time scan', fps=10),
+                DerivedPlot(func3, xlabel='elapsed time (seconds)', ylabel='dtc3', title='time scan', fps=10)]
     else:
         plot = DerivedPlot(func,
                            xlabel='elapsed time (seconds)',
                            ylabel=detector+denominator,
-                           title='time scan')
+                           title='time scan',
+                           fps=10)
 
     line1 = '%s, N=%s, dwell=%.3f, delay=%.3f\n' % (detector, readings, dwell, delay)
     
@@ -122,6 +122,8 @@ class BMM_User(Borg):
         measuring in pseudo-channel-cut mode
     ththth : bool
         measuring with the Si(333) reflection
+    adaptive : bool
+        refining the energy grid from live data
     mode : str
         in-scan plotting mode
 
@@ -235,6 +237,7 @@ class BMM_User(Borg):
         self.bothways      = False
         self.channelcut    = True
         self.ththth        = False
+        self.adaptive      = False
         self.lims          = True
         self.mode          = 'transmission'
         self.url           = False
@@ -344,7 +347,7 @@ class BMM_User(Borg):
             print('\nScan control attributes:')
             for att in ('pds_mode', 'bounds', 'steps', 'times', 'folder', 'filename',
                         'experimenters', 'e0', 'element', 'edge', 'sample', 'prep', 'comment', 'nscans', 'start', 'inttime',
-                        'snapshots', 'usbstick', 'rockingcurve', 'htmlpage', 'bothways', 'channelcut', 'ththth', 'mode', 'npoints',
+                        'snapshots', 'usbstick', 'rockingcurve', 'htmlpage', 'bothways', 'channelcut', 'ththth', 'adaptive', 'mode', 'npoints',
                         'dwell', 'delay'):
                 print('\t%-15s = %s' % (att, str(getattr(self, att))))
 
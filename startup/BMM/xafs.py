@@ -1,16 +1,19 @@
 from bluesky.plans import rel_scan, scan_nd, count
 from bluesky.plan_stubs import abs_set, sleep, mv, null
 from bluesky.preprocessors import subs_decorator, finalize_wrapper
-from databroker.core import SingleRunCache
 
 import numpy, os, re, shutil
 import textwrap, configparser, datetime
+from types import SimpleNamespace
 from cycler import cycler
 import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from larch.io import create_athena
 
 #from BMM.camera_device import snap
+from BMM.adaptive      import adaptive_scan, coarse_grid, sorted_run
 from BMM.db            import file_resource
 from BMM.demeter       import toprj
 from BMM.derivedplot   import DerivedPlot, interpret_click, close_all_plots, close_last_plot
@@ -24,9 +27,11 @@ from BMM.metadata      import bmm_metadata, display_XDI_metadata, metadata_at_th
 from BMM.modes         import get_mode, describe_mode
 from BMM.motor_status  import motor_sidebar, motor_status
 from BMM.periodictable import edge_energy, Z_number, element_name
+from BMM.postprocess   import EndOfScanPipeline
 from BMM.resting_state import resting_state_plan
+from BMM.runcache      import RunBuffer
 from BMM.suspenders    import BMM_suspenders, BMM_clear_to_start, BMM_clear_suspenders
-from BMM.xdi           import write_XDI
+from BMM.xdi           import write_XDI, prepare_XDI, write_XDI_block, XDIFileWriter
 from BMM.xafs_functions import conventional_grid, sanitize_step_scan_parameters
 
 from IPython import get_ipython
@@ -113,6 +118,8 @@ def scan_metadata(inifile=None, **kwargs):
         True = measure in pseudo-channel-cut mode
     ththth : bool
         True = measure using the Si(333) reflection
+    adaptive : bool
+        True = start from a coarse grid and add points where mu(E) changes fastest
     mode : str
         transmission, fluorescence, or reference -- how to display the data
     bounds : list
@@ -242,7 +249,7 @@ def scan_metadata(inifile=None, **kwargs):
             found[a] = True
 
     ## ----- booleans
-    for a in ('snapshots', 'htmlpage', 'lims', 'bothways', 'channelcut', 'usbstick', 'rockingcurve', 'ththth'):
+    for a in ('snapshots', 'htmlpage', 'lims', 'bothways', 'channelcut', 'usbstick', 'rockingcurve', 'ththth', 'adaptive'):
         found[a] = False
         if a not in kwargs:
             try:
@@ -336,7 +343,7 @@ def db2xdi(datafile, key):
     >>> db2xdi('/path/to/myfile.xdi', '0783ac3a-658b-44b0-bba5-ed4e0c4e7216')
 
     '''
-    BMMuser, db = user_ns['BMMuser'], user_ns['db']
+    BMMuser = user_ns['BMMuser']
     dfile = datafile
     if BMMuser.DATA not in dfile:
         if 'bucket' not in BMMuser.DATA:
@@ -344,7 +351,7 @@ def db2xdi(datafile, key):
     if os.path.isfile(dfile):
         print(error_msg('%s already exists!  Bailing out....' % dfile))
         return
-    header = db[key]
+    header = user_ns['runcache'][key]
     ## sanity check, make sure that db returned a header AND that the header was an xafs scan
     write_XDI(dfile, header)
     print(bold_msg('wrote %s' % dfile))
@@ -355,41 +362,45 @@ from pygments.formatters import HtmlFormatter
 
 from urllib.parse import quote
 
-def make_merged_triplot(uidlist, filename, mode):
-    #k=Kekropidai()
-    #k.put(uidlist)
-    #merge=k.merge()
-    BMMuser = user_ns['BMMuser']
-    base = Pandrosus()
-    projname = os.path.join(BMMuser.folder, 'prj', os.path.basename(filename)).replace('.png', '.prj')
+def make_merged_triplot(uidlist, filename, mode, folder=None):
+    if folder is None:
+        folder = user_ns['BMMuser'].folder
+    projname = os.path.join(folder, 'prj', os.path.basename(filename)).replace('.png', '.prj')
     proj = create_athena(projname)
-    base.fetch(uidlist[0], mode=mode)
-    ee = base.group.energy
-    mm = base.group.mu
-    save = base.group.args['label']
-    proj.add_group(base.group)
-    base.group.args['label'] = save
-    for uid in uidlist[1:]:
-        this = Pandrosus()
-        this.fetch(uid, mode=mode)
-        mu = numpy.interp(ee, this.group.energy, this.group.mu)
-        mm = mm + mu
+    ## fetch and process all the repetitions concurrently, then merge them in one step
+    bunch = Kekropidai()
+    bunch.put(uidlist, mode=mode)
+    for this in bunch.groups:
         save = this.group.args['label']
         proj.add_group(this.group)
         this.group.args['label'] = save
-    mm = mm / len(uidlist)
-    merge = Pandrosus()
-    merge.put(ee, mm, 'merge')
-    thisagg = matplotlib.get_backend()
-    matplotlib.use('Agg') # produce a plot without screen display
-    merge.triplot()
-    plt.savefig(filename)
+    merge = bunch.merge()
+    ## draw on a Figure with its own Agg canvas, not through pyplot, so this
+    ## is safe to do on a worker thread while the live plots carry on
+    fig = Figure(tight_layout=True)
+    FigureCanvasAgg(fig)
+    merge.triplot(fig=fig)
+    fig.savefig(filename)
     print(whisper(f'Wrote triplot to {filename}'))
-    matplotlib.use(thisagg) # return to screen display
     proj.save()
     print(whisper(f'Wrote Athena project to {projname}'))
     
 
+## dossiers are written by a single worker thread which outlives any one
+## call to xafs(), so the next step of a macro need not wait for them
+dossier_queue = EndOfScanPipeline(max_workers=1, max_pending=16)
+
+_templates = dict()
+def read_template(fname):
+    '''Return the text of a template file, reading it from disk only
+    when it has changed since it was last read.'''
+    mtime = os.stat(fname).st_mtime_ns
+    if fname not in _templates or _templates[fname][0] != mtime:
+        with open(fname) as f:
+            _templates[fname] = (mtime, f.read())
+    return _templates[fname][1]
+
+
 def scan_sequence_static_html(inifile       = None,
                               filename      = None,
                               start         = None,
@@ -427,20 +438,33 @@ def scan_sequence_static_html(inifile       = None,
                               url           = None,
                               doi           = None,
                               cif           = None,
+                              pdsmode       = None,
+                              mono          = None,
+                              ga_align      = None,
+                              ga_yuid       = None,
+                              ga_puid       = None,
+                              ga_fuid       = None,
+                              user          = None,
+                              plotmode      = None,
                               ):
     '''
     Gather information from various places, including html_dict, a temporary dictionary 
     filled up during an XAFS scan, then write a static html file as a dossier for a scan
     sequence using a bespoke html template file
+
+    pdsmode, mono, and the ga_* arguments describe the state of the
+    beamline, user holds the parts of BMMuser used here, and plotmode is
+    plotting_mode(mode), as captured by dossier_state() at the end of
+    the scan sequence.  Any not given are read now.
     '''
-    BMMuser, dcm, ga = user_ns['BMMuser'], user_ns['dcm'], user_ns['ga']
+    BMMuser = user_ns['BMMuser'] if user is None else user
     if filename is None or start is None:
         return None
     firstfile = "%s.%3.3d" % (filename, start)
     if not os.path.isfile(os.path.join(BMMuser.DATA, firstfile)):
         return None
 
-    thismode = plotting_mode(mode)
+    thismode = plotting_mode(mode) if plotmode is None else plotmode
     
     tmpl = 'sample.tmpl'
     if thismode == 'xs':
@@ -448,8 +472,7 @@ def scan_sequence_static_html(inifile       = None,
             tmpl = 'sample_ga.tmpl'
         else:
             tmpl = 'sample_xs.tmpl'
-    with open(os.path.join(os.getenv('HOME'), '.ipython', 'profile_collection', 'startup', tmpl)) as f:
-        content = f.readlines()
+    content = read_template(os.path.join(os.getenv('HOME'), '.ipython', 'profile_collection', 'startup', tmpl))
     basename     = filename
     htmlfilename = os.path.join(BMMuser.DATA, 'dossier/',   filename+'-01.html')
     seqnumber = 1
@@ -475,7 +498,7 @@ def scan_sequence_static_html(inifile       = None,
         if uidlist is not None:
             pngfilename = os.path.join(BMMuser.DATA, 'snapshots', f"{basename}.png")
             #print(warning_msg(f'   {pngfilename}'))
-            make_merged_triplot(uidlist, pngfilename, mode)
+            make_merged_triplot(uidlist, pngfilename, mode, folder=BMMuser.folder)
             prjfilename = os.path.join(BMMuser.DATA, 'prj', f"{basename}.prj")
     except Exception as e:
         print(error_msg('failure to make triplot'))
@@ -486,60 +509,62 @@ def scan_sequence_static_html(inifile       = None,
         with open(os.path.join(BMMuser.DATA, inifile)) as f:
             initext = ''.join(f.readlines())
         
+    if pdsmode is None or mono is None:
+        state = dossier_state()
+        pdsmode, mono, ga_align, ga_yuid, ga_puid, ga_fuid = [state[k] for k in ('pdsmode', 'mono', 'ga_align', 'ga_yuid', 'ga_puid', 'ga_fuid')]
     o = open(htmlfilename, 'w')
-    pdstext = '%s (%s)' % (get_mode(), describe_mode())
-    o.write(''.join(content).format(filename      = filename,
-                                    basename      = basename,
-                                    encoded_basename = quote(basename),
-                                    experimenters = experimenters,
-                                    gup           = BMMuser.gup,
-                                    saf           = BMMuser.saf,
-                                    seqnumber     = seqnumber,
-                                    seqstart      = seqstart,
-                                    seqend        = seqend,
-                                    mono          = 'Si(%s)' % dcm._crystal,
-                                    pdsmode       = pdstext,
-                                    symbol        = element,
-                                    e0            = '%.1f' % e0,
-                                    edge          = edge,
-                                    element       = '%s (<a href="https://en.wikipedia.org/wiki/%s">%s</a>, %d)' % (element, element_name(element), element_name(element), Z_number(element)),
-                                    date          = BMMuser.date,
-                                    scanlist      = scanlist,
-                                    motors        = motors,
-                                    sample        = sample,
-                                    prep          = prep,
-                                    comment       = comment,
-                                    mode          = mode,
-                                    pccenergy     = '%.1f' % pccenergy,
-                                    bounds        = bounds,
-                                    steps         = steps,
-                                    times         = times,
-                                    clargs        = highlight(clargs, PythonLexer(), HtmlFormatter()),
-                                    websnap       = quote('../snapshots/'+websnap),
-                                    webuid        = webuid,
-                                    anasnap       = quote('../snapshots/'+anasnap),
-                                    anauid        = anauid,
-                                    xrffile       = quote('../XRF/'+str(xrffile)),
-                                    xrfuid        = xrfuid,
-                                    xrfsnap       = quote('../XRF/'+str(xrfsnap)),
-                                    ga_align      = ga.alignment_filename,
-                                    ga_yuid       = ga.y_uid,
-                                    ga_puid       = ga.pitch_uid,
-                                    ga_fuid       = ga.f_uid,
-                                    ocrs          = ocrs,
-                                    rois          = rois,
-                                    initext       = highlight(initext, IniLexer(), HtmlFormatter()),
-                                    url           = url,
-                                    doi           = doi,
-                                    cif           = cif,
-                                ))
+    o.write(content.format(filename      = filename,
+                           basename      = basename,
+                           encoded_basename = quote(basename),
+                           experimenters = experimenters,
+                           gup           = BMMuser.gup,
+                           saf           = BMMuser.saf,
+                           seqnumber     = seqnumber,
+                           seqstart      = seqstart,
+                           seqend        = seqend,
+                           mono          = mono,
+                           pdsmode       = pdsmode,
+                           symbol        = element,
+                           e0            = '%.1f' % e0,
+                           edge          = edge,
+                           element       = '%s (<a href="https://en.wikipedia.org/wiki/%s">%s</a>, %d)' % (element, element_name(element), element_name(element), Z_number(element)),
+                           date          = BMMuser.date,
+                           scanlist      = scanlist,
+                           motors        = motors,
+                           sample        = sample,
+                           prep          = prep,
+                           comment       = comment,
+                           mode          = mode,
+                           pccenergy     = '%.1f' % pccenergy,
+                           bounds        = bounds,
+                           steps         = steps,
+                           times         = times,
+                           clargs        = highlight(clargs, PythonLexer(), HtmlFormatter()),
+                           websnap       = quote('../snapshots/'+websnap),
+                           webuid        = webuid,
+                           anasnap       = quote('../snapshots/'+anasnap),
+                           anauid        = anauid,
+                           xrffile       = quote('../XRF/'+str(xrffile)),
+                           xrfuid        = xrfuid,
+                           xrfsnap       = quote('../XRF/'+str(xrfsnap)),
+                           ga_align      = ga_align,
+                           ga_yuid       = ga_yuid,
+                           ga_puid       = ga_puid,
+                           ga_fuid       = ga_fuid,
+                           ocrs          = ocrs,
+                           rois          = rois,
+                           initext       = highlight(initext, IniLexer(), HtmlFormatter()),
+                           url           = url,
+                           doi           = doi,
+                           cif           = cif,
+                       ))
     o.close()
 
     manifest = open(os.path.join(BMMuser.DATA, 'dossier', 'MANIFEST'), 'a')
     manifest.write(htmlfilename + '\n')
     manifest.close()
 
-    write_manifest()
+    write_manifest(BMMuser)
 
     pngfile = os.path.join(BMMuser.DATA, 'snapshots', f"{basename}.png")
     if os.path.isfile(pngfile):
@@ -554,9 +579,60 @@ def scan_sequence_static_html(inifile       = None,
 
 
 
-def write_manifest():
-    '''Update the scan manifest and the corresponding static html file.'''
-    BMMuser = user_ns['BMMuser']
+def write_dossier(inifile, html_dict, gdrive_dict):
+    '''Write the dossier for a scan sequence, then copy it and its
+    Athena project and triplot image to Google drive.  This is run on
+    the dossier_queue worker thread, so everything it needs from BMMuser
+    and the beamline is in html_dict, see dossier_state.  Returns the
+    name of the html file.'''
+    BMMuser = html_dict.get('user') or user_ns['BMMuser']
+    (htmlout, prjout, pngout) = scan_sequence_static_html(inifile=inifile, **html_dict)
+    if htmlout is not None:
+        gdrive_dict['dossier']   = {'source': htmlout,
+                                    'target': os.path.join(BMMuser.gdrive, 'dossier', os.path.basename(htmlout))}
+        gdrive_dict['manifest']  = {'source': os.path.join(os.path.dirname(htmlout), '00INDEX.html'),
+                                    'target': os.path.join(BMMuser.gdrive, 'dossier', '00INDEX.html')}
+    if prjout is not None:
+        gdrive_dict['prj']       = {'source': prjout,
+                                    'target': os.path.join(BMMuser.gdrive, 'prj', os.path.basename(htmlout).replace('html', 'prj'))}
+    if pngout is not None:
+        gdrive_dict['processed'] = {'source': pngout,
+                                    'target': os.path.join(BMMuser.gdrive, 'snapshots', os.path.basename(htmlout).replace('html', 'png'))}
+    for k,v in gdrive_dict.items():
+        if v['source'] is not None:
+            try:
+                shutil.copyfile(v['source'], v['target'])
+            except Exception as e:
+                print(e)
+    return htmlout
+
+
+def dossier_state(inifile=None, mode=None):
+    '''Capture the parts of the beamline state and of BMMuser which go
+    into a dossier, the text of the INI file, and the plotting mode, so
+    that a dossier written in the background describes the scan
+    sequence rather than whatever has happened since.'''
+    dcm, ga, BMMuser = user_ns['dcm'], user_ns['ga'], user_ns['BMMuser']
+    user = SimpleNamespace(**{k: getattr(BMMuser, k) for k in ('DATA', 'folder', 'gdrive', 'gup', 'saf', 'date', 'instrument')})
+    state = {'user'     : user,
+             'pdsmode'  : '%s (%s)' % (get_mode(), describe_mode()),
+             'mono'     : 'Si(%s)' % dcm._crystal,
+             'ga_align' : ga.alignment_filename,
+             'ga_yuid'  : ga.y_uid,
+             'ga_puid'  : ga.pitch_uid,
+             'ga_fuid'  : ga.f_uid,}
+    if inifile is not None:
+        with open(os.path.join(BMMuser.DATA, inifile)) as f:
+            state['initext'] = ''.join(f.readlines())
+    if mode is not None:
+        state['plotmode'] = plotting_mode(mode)
+    return state
+
+
+def write_manifest(user=None):
+    '''Update the scan manifest and the corresponding static html file.
+    user holds the parts of BMMuser used here, see dossier_state.'''
+    BMMuser = user_ns['BMMuser'] if user is None else user
     with open(os.path.join(BMMuser.DATA, 'dossier', 'MANIFEST')) as f:
         lines = [line.rstrip('\n') for line in f]
 
@@ -567,12 +643,11 @@ def write_manifest():
         this = os.path.basename(l)
         experimentlist += '<li><a href="./%s">%s</a></li>\n' % (this, this)
         
-    with open(os.path.join(BMMuser.DATA, 'dossier', 'manifest.tmpl')) as f:
-        content = f.readlines()
+    content = read_template(os.path.join(BMMuser.DATA, 'dossier', 'manifest.tmpl'))
     indexfile = os.path.join(BMMuser.DATA, 'dossier', '00INDEX.html')
     o = open(indexfile, 'w')
-    o.write(''.join(content).format(date           = BMMuser.date,
-                                    experimentlist = experimentlist,))
+    o.write(content.format(date           = BMMuser.date,
+                           experimentlist = experimentlist,))
     o.close()
     
 
@@ -935,8 +1010,21 @@ def xafs(inifile=None, **kwargs):
 
 
         ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
-        ## SingleRunCache -- manage data as it comes out
-        #src = SingleRunCache()
+        ## RunBuffer -- collect data in memory as it comes out, each
+        ## completed run is put into the run cache at its stop document
+        runbuffer = RunBuffer()
+
+        ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+        ## XDIFileWriter -- write each data file line by line as the scan proceeds
+        xdiwriter = XDIFileWriter(p['folder'])
+
+        ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+        ## EarlyQualityCheck -- judge each repetition as soon as the edge has been measured
+        earlycheck = user_ns['earlycheck']
+
+        ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+        ## BMMRewindPlanner -- choose direction and mono moves between repetitions
+        rewinder = user_ns['rewinder']
 
         ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
         ## engage suspenders right before starting scan sequence
@@ -948,12 +1036,14 @@ def xafs(inifile=None, **kwargs):
         ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
         ## begin the scan sequence with the plotting subscription
         @subs_decorator(plot)
-        #@subs_decorator(src.callback)
+        @subs_decorator(runbuffer)
+        @subs_decorator(xdiwriter)
+        @subs_decorator(earlycheck)
         def scan_sequence(clargs): #, noreturn=False):
             ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
             ## compute energy and dwell grids
             print(bold_msg('computing energy and dwell time grids'))
-            (energy_grid, time_grid, approx_time, delta) = conventional_grid(p['bounds'], p['steps'], p['times'], e0=p['e0'], element=p['element'], edge=p['edge'], ththth=p['ththth'])
+            (energy_grid, time_grid, approx_time, delta) = conventional_grid(p['bounds'], p['steps'], p['times'], e0=p['e0'], element=p['element'], edge=p['edge'], ththth=p['ththth'], mode=p['mode'], bothways=p['bothways'])
             if plotting_mode(p['mode']) == 'xs':
                 yield from mv(xs.total_points, len(energy_grid))
             if energy_grid is None or time_grid is None or approx_time is None:
@@ -981,7 +1071,18 @@ def xafs(inifile=None, **kwargs):
                 BMMuser.final_log_entry = False
                 yield from null()
                 return
-
+            ## validate the entire trajectory, including the rewind positions, before moving anything
+            problems = dcm.check_trajectory([energy_grid[0]-5, *energy_grid, energy_grid[-1]+5])
+            if len(problems) > 0:
+                for problem in problems:
+                    print(error_msg(f'The DCM trajectory for this scan is not possible: {problem}'))
+                print(error_msg('Bailing out....'))
+                BMMuser.final_log_entry = False
+                yield from null()
+                return
+            ## plan the direction of each repetition and the mono moves between them
+            sequence = rewinder.plan(energy_grid, p['nscans'], start=dcm.energy.readback.get(), bothways=p['bothways'] and not p['adaptive'])
+            rewinder.report()
 
 
             ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
@@ -1070,22 +1171,14 @@ def xafs(inifile=None, **kwargs):
                 ## need to set certain metadata items on a per-scan basis... temperatures, ring stats
                 ## mono direction, ... things that can change during or between scan sequences
                 
-                md['Mono']['direction'] = 'forward'
-                if p['bothways'] and cnt%2 == 0:
+                ## the direction and the move to the start of this repetition come from the rewind planner,
+                ## rewinds are made at the slow acceleration, then the acceleration is reset for measurement
+                md['Mono']['direction'] = sequence[cnt-1]['direction']
+                if sequence[cnt-1]['direction'] == 'backward':
                     energy_trajectory    = cycler(dcm.energy, energy_grid[::-1])
                     dwelltime_trajectory = cycler(dwell_time, time_grid[::-1])
-                    md['Mono']['direction'] = 'backward'
-                    #dcm_bragg.clear_encoder_loss()
-                    yield from mv(dcm.energy, energy_grid[-1]+5)
-                else:
-                    ## if not measuring in both direction, lower acceleration of the mono
-                    ## for the rewind, explicitly rewind, then reset for measurement
-                    yield from mv(dcm_bragg.acceleration, BMMuser.acc_slow)
-                    print(whisper('  Rewinding DCM to %.1f eV with acceleration time = %.2f sec' % (energy_grid[0]-5, dcm_bragg.acceleration.get())))
-                    #dcm_bragg.clear_encoder_loss()
-                    yield from mv(dcm.energy, energy_grid[0]-5)
-                    yield from mv(dcm_bragg.acceleration, BMMuser.acc_fast)
-                    print(whisper('  Resetting DCM acceleration time to %.2f sec' % dcm_bragg.acceleration.get()))
+                #dcm_bragg.clear_encoder_loss()
+                yield from rewinder.rewind_plan(sequence[cnt-1], dcm.energy, dcm_bragg)
                     
                 rightnow = metadata_at_this_moment() # see 62-metadata.py
                 for family in rightnow.keys():       # transfer rightnow to md
@@ -1107,38 +1200,74 @@ def xafs(inifile=None, **kwargs):
                 
                 ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
                 ## call the stock scan_nd plan with the correct detectors
-                uid = None
+                uid, xspress3 = None, None
                 if any(md in p['mode'] for md in ('trans', 'ref', 'yield', 'test')):
-                    uid = yield from scan_nd([quadem1], energy_trajectory + dwelltime_trajectory,
-                                             md={**xdi, **supplied_metadata})
+                    detectors = [quadem1]
                 elif user_ns['with_xspress3'] is True:
-                    uid= yield from scan_nd([quadem1, xs], energy_trajectory + dwelltime_trajectory,
-                                            md={**xdi, **supplied_metadata})
+                    detectors = [quadem1, xs]
+                    xspress3 = xs
                 else:
-                    uid = yield from scan_nd([quadem1, vor], energy_trajectory + dwelltime_trajectory,
-                                             md={**xdi, **supplied_metadata})
-                ## here is where we would use the new SingleRunCache solution in databroker v1.0.3
-                ## see #64 at https://github.com/bluesky/tutorials
+                    detectors = [quadem1, vor]
+                if p['adaptive']:
+                    ## start from every other point of the grid, then spend the same
+                    ## number of points where mu(E) changes fastest, but never more finely
+                    ## than the finest energy step in the INI file (k steps are coarser)
+                    (coarse_energy, coarse_time) = coarse_grid(energy_grid, time_grid)
+                    ev_steps = [float(s) for s in p['steps'] if type(s) is not str]
+                    min_step = min(ev_steps)/(3 if p['ththth'] else 1) if ev_steps else numpy.diff(energy_grid).min()
+                    uid = yield from adaptive_scan(detectors, coarse_energy, coarse_time, p['mode'], len(energy_grid),
+                                                   min_step=min_step,
+                                                   xspress3=xspress3, stopping=earlycheck.stopping,
+                                                   md={**xdi, **supplied_metadata})
+                else:
+                    ## the early check's per_step ends the run as soon as it is judged bad
+                    uid = yield from scan_nd(detectors, energy_trajectory + dwelltime_trajectory,
+                                             per_step=earlycheck.per_step, md={**xdi, **supplied_metadata})
+                ## runbuffer has already put this run in the cache, no database read is needed
 
                 if plotting_mode(p['mode']) == 'xs':
                     hdf5_uid = xs.hdf5.file_name.value
                 
                 uidlist.append(uid)
-                header = db[uid]
-                write_XDI(datafile, header)
-                print(bold_msg('wrote %s' % datafile))
-                BMM_log_info(f'energy scan finished, uid = {uid}, scan_id = {header.start["scan_id"]}\ndata file written to {datafile}')
+                header = user_ns['runcache'][uid]
+                if p['adaptive']:
+                    ## put the sorted run back in the cache, so the data evaluation and
+                    ## the dossier see the same, energy-ordered run as the XDI file
+                    header = sorted_run(header)
+                    user_ns['runcache'].put(header)
 
                 ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
-                ## data evaluation
-                if any(md in p['mode'] for md in ('trans', 'fluo', 'flou', 'both', 'ref', 'xs')):
-                    try:
-                        score, emoji = user_ns['clf'].evaluate(uid, mode=plotting_mode(p['mode']))
+                ## if the XDI file was not written as the scan ran, format it here, while
+                ## BMMuser, the wheel, etc. still describe this repetition, and leave only
+                ## the writing to the worker thread
+                xdi_block = None
+                if not (xdiwriter.complete and xdiwriter.datafile == datafile and not p['adaptive']):
+                    xdi_block = prepare_XDI(header)
+
+                ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+                ## end of repetition processing is handed to the pipeline's worker threads
+                ## so the next repetition can start right away.  work() runs concurrently,
+                ## finish() runs in scan order.  (loop variables are bound as default arguments)
+                def work(uid=uid, header=header, datafile=datafile, xdi_block=xdi_block):
+                    if xdi_block is not None:
+                        write_XDI_block(datafile, *xdi_block)
+                    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+                    ## data evaluation
+                    emoji = None
+                    if any(md in p['mode'] for md in ('trans', 'fluo', 'flou', 'both', 'ref', 'xs')):
+                        try:
+                            score, emoji = user_ns['clf'].evaluate(uid, mode=plotting_mode(p['mode']))
+                            ## FYI: db.v2[-1].metadata['start']['scan_id']
+                        except:
+                            pass
+                    return emoji
+
+                def finish(emoji, uid=uid, header=header, datafile=datafile, fname=fname):
+                    print(bold_msg('wrote %s' % datafile))
+                    BMM_log_info(f'energy scan finished, uid = {uid}, scan_id = {header.start["scan_id"]}\ndata file written to {datafile}')
+                    if emoji is not None:
                         report(f"Data evaluation: {emoji}", level='bold', slack=True)
-                        ## FYI: db.v2[-1].metadata['start']['scan_id']
-                    except:
-                        pass
-                    if p['lims'] is True:
+                    if any(md in p['mode'] for md in ('trans', 'fluo', 'flou', 'both', 'ref', 'xs')) and p['lims'] is True:
                         try:
                             copy_to_gdrive(fname)
                             synch_gdrive_folder()
@@ -1153,6 +1282,8 @@ def xafs(inifile=None, **kwargs):
                         except Exception as e:
                             print(error_msg(e))
                             report(f"Failed to push {fname} to Google drive...", level='bold', slack=True)
+
+                yield from pipeline.submit_plan(fname, work, finish)
                         
                 ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
                 ## generate left sidebar text for the static html page for this scan sequence
@@ -1165,6 +1296,16 @@ def xafs(inifile=None, **kwargs):
                 #                  % (quote(fname), fname, printedname, js_text)
                 html_dict['scanlist'] = html_scan_list
 
+                ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+                ## the live check has already cut short a bad repetition, now stop the
+                ## sequence, or only report the verdict while the check is not enabled
+                if earlycheck.bad:
+                    if earlycheck.enabled and cnt < p['nscans']:
+                        report(f'{fname} looks bad ({earlycheck.reason}), skipping the remaining {inflect("repetition", p["nscans"]-cnt)}',
+                               level='error', slack=True)
+                        break
+                    report(f'early quality check: {fname} looks bad ({earlycheck.reason})', level='whisper')
+
 
             ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
             ## finish up, close out
@@ -1178,6 +1319,9 @@ def xafs(inifile=None, **kwargs):
             yield from mv(dcm.energy, eave)
             yield from mv(dcm_bragg.acceleration, BMMuser.acc_fast)
 
+            ## the dossier needs every data file, so let end of repetition processing finish
+            yield from pipeline.wait_plan()
+
         ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
         ## execute this scan sequence plan
         #noreturn = False
@@ -1188,13 +1332,22 @@ def xafs(inifile=None, **kwargs):
     def cleanup_plan(inifile):
         print('Cleaning up after an XAFS scan sequence')
         BMM_clear_suspenders()
+        yield from pipeline.wait_plan()
+        pipeline.report_errors()
+        pipeline.shutdown()
+        dossier_queue.report_errors()
 
         db = user_ns['db']
-        ## db[-1].stop['num_events']['primary'] should equal db[-1].start['num_points'] for a complete scan
+        ## db[-1].stop['num_events']['primary'] should equal db[-1].start['num_points'] for a complete scan,
+        ## except for an adaptive scan, for which num_points is only the budget, and which may end
+        ## early because refinement found nowhere more to put points
         how = 'finished'
         try:
             if 'primary' not in db[-1].stop['num_events']:
                 how = 'stopped'
+            elif db[-1].start.get('plan_name') == 'adaptive_scan':
+                if db[-1].stop['exit_status'] != 'success':
+                    how = 'stopped'
             elif db[-1].stop['num_events']['primary'] != db[-1].start['num_points']:
                 how = 'stopped'
         except:
@@ -1204,31 +1357,17 @@ def xafs(inifile=None, **kwargs):
             BMM_log_info(f'most recent uid = {db[-1].start["uid"]}, scan_id = {db[-1].start["scan_id"]}')
             ## FYI: db.v2[-1].metadata['start']['scan_id']
             if 'htmlpage' in html_dict and html_dict['htmlpage']:
-                (htmlout, prjout, pngout) = scan_sequence_static_html(inifile=inifile, **html_dict)
-                if htmlout is not None:
-                    report('wrote dossier %s' % htmlout, 'bold')
-                    gdrive_dict['dossier']   = {'source': htmlout,
-                                                'target': os.path.join(BMMuser.gdrive, 'dossier', os.path.basename(htmlout))}
-                    gdrive_dict['manifest']  = {'source': os.path.join(os.path.dirname(htmlout), '00INDEX.html'),
-                                                'target': os.path.join(BMMuser.gdrive, 'dossier', '00INDEX.html')}
-                if prjout is not None:
-                    gdrive_dict['prj']       = {'source': prjout,
-                                                'target': os.path.join(BMMuser.gdrive, 'prj', os.path.basename(htmlout).replace('html', 'prj'))}
-                if pngout is not None:
-                    gdrive_dict['processed'] = {'source': pngout,
-                                                'target': os.path.join(BMMuser.gdrive, 'snapshots', os.path.basename(htmlout).replace('html', 'png'))}
-                    
-            if 'htmlpage' in html_dict and html_dict['htmlpage']:
-                for k,v in gdrive_dict.items():
-                    #print(f'\n{k}')
-                    #print(f'   source: {v["source"]}')
-                    #print(f'   target: {v["target"]}')
-                    if v['source'] is not None:
-                        try:
-                            shutil.copyfile(v['source'], v['target'])
-                        except Exception as e:
-                            print(e)
-                    
+                ## the dossier is written in the background, see dossier_queue
+                ## the beamline state, BMMuser, and the INI file are captured now, while they
+                ## still describe this scan sequence, the INI text read at the start of the
+                ## sequence taking precedence
+                args, copies = {**dossier_state(inifile, html_dict['mode']), **html_dict}, dict(gdrive_dict)
+                def finish(htmlout):
+                    if htmlout is not None:
+                        report('wrote dossier %s' % htmlout, 'bold')
+                yield from dossier_queue.submit_plan(f'dossier for {html_dict["filename"]}',
+                                                     lambda: write_dossier(inifile, args, copies), finish)
+
         dcm.mode = 'fixed'
         yield from resting_state_plan()
         yield from sleep(2.0)
@@ -1268,6 +1407,7 @@ def xafs(inifile=None, **kwargs):
     html_scan_list = ''
     html_dict = {}
     gdrive_dict = {}
+    pipeline = EndOfScanPipeline()
     BMMuser.final_log_entry = True
     RE.msg_hook = None
     if BMMuser.lims is False:
@@ -1327,7 +1467,7 @@ def howlong(inifile=None, interactive=True, **kwargs):
     if not ok:
         print(error_msg('\nThe following keywords are missing from your INI file: '), '%s\n' % str.join(', ', missing))
         return(orig, -1)
-    (energy_grid, time_grid, approx_time, delta) = conventional_grid(p['bounds'], p['steps'], p['times'], e0=p['e0'], element=p['element'], edge=p['edge'], ththth=p['ththth'])
+    (energy_grid, time_grid, approx_time, delta) = conventional_grid(p['bounds'], p['steps'], p['times'], e0=p['e0'], element=p['element'], edge=p['edge'], ththth=p['ththth'], mode=p['mode'], bothways=p['bothways'])
     if delta == 0:
         text = f'One scan of {len(energy_grid)} points will take about {approx_time} minutes\n'
         text +=f'The sequence of {inflect("scan", p["nscans"])} will take about {approx_time * int(p["nscans"])/60:.1f} hours'
@@ -1390,7 +1530,7 @@ def xafs_grid(inifile=None, **kwargs):
     if not ok:
         print(error_msg('\nThe following keywords are missing from your INI file: '), '%s\n' % str.join(', ', missing))
         return(orig, -1)
-    (energy_grid, time_grid, approx_time, delta) = conventional_grid(p['bounds'], p['steps'], p['times'], e0=p['e0'], element=p['element'], edge=p['edge'], ththth=p['ththth'])
+    (energy_grid, time_grid, approx_time, delta) = conventional_grid(p['bounds'], p['steps'], p['times'], e0=p['e0'], element=p['element'], edge=p['edge'], ththth=p['ththth'], mode=p['mode'], bothways=p['bothways'])
     print(f'{p["element"]} {p["edge"]}')
     return(energy_grid, time_grid)
 
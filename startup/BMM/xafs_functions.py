@@ -1,7 +1,8 @@
 
 from BMM.functions     import error_msg, warning_msg, go_msg, url_msg, bold_msg, verbosebold_msg, list_msg, disconnected_msg, info_msg, whisper
-from BMM.functions     import countdown, boxedtext, now, isfloat, inflect, e2l, etok, ktoe
+from BMM.functions     import countdown, boxedtext, now, isfloat, inflect, e2l, etok, ktoe, plotting_mode
 import numpy
+from functools import lru_cache
 
 from IPython import get_ipython
 user_ns = get_ipython().user_ns
@@ -102,7 +103,7 @@ def sanitize_step_scan_parameters(bounds, steps, times):
     
 
 
-def conventional_grid(bounds=CS_BOUNDS, steps=CS_STEPS, times=CS_TIMES, e0=7112, element=None, edge=None, ththth=False):
+def conventional_grid(bounds=CS_BOUNDS, steps=CS_STEPS, times=CS_TIMES, e0=7112, element=None, edge=None, ththth=False, mode=None, bothways=False):
     '''
     Parameters
     ----------
@@ -116,12 +117,16 @@ def conventional_grid(bounds=CS_BOUNDS, steps=CS_STEPS, times=CS_TIMES, e0=7112,
         edge energy, reference for boundary values
     ththth : Boolean
         using the Si(333) reflection
+    mode : str
+        measurement mode, used to choose the detector in the duration model
+    bothways : Boolean
+        measuring in both directions, i.e. no rewind between scans
 
     Output
     ------
-    grid : list
+    grid : numpy.ndarray
         absolute energy values
-    timegrid : list
+    timegrid : numpy.ndarray
         integration times
     approximate_time : float
         a very crude estimate of how long in minutes the scan will take
@@ -176,48 +181,105 @@ def conventional_grid(bounds=CS_BOUNDS, steps=CS_STEPS, times=CS_TIMES, e0=7112,
     tele = user_ns['tele']
     
     if (len(bounds) - len(steps)) != 1:
-        return (None, None, None)
+        return (None, None, None, None)
     if (len(bounds) - len(times)) != 1:
-        return (None, None, None)
-    for i,s in enumerate(bounds):
-        if type(s) is str:
-            this = float(s[:-1])
-            bounds[i] = ktoe(this)
-    bounds.sort()
+        return (None, None, None, None)
 
-    enot = e0
-    if ththth:
-        enot = e0/3.0
-        bounds = list(numpy.array(bounds)/3)
-    grid = list()
-    timegrid = list()
-    for i,s in enumerate(steps):
-        if type(s) is str:
-            step = float(s[:-1])
-            if ththth: step = step/3.
-            ar = enot + ktoe(numpy.arange(etok(bounds[i]), etok(bounds[i+1]), step))
-        else:
-            step = steps[i]
-            if ththth: step = step/3.
-            ar = numpy.arange(enot+bounds[i], enot+bounds[i+1], step)
-        grid = grid + list(ar)
-        grid = list(numpy.round(grid, decimals=2))
-        if type(times[i]) is str:
-            tar = etok(ar-enot)*float(times[i][:-1])
-        else:
-            tar = times[i]*numpy.ones(len(ar))
-        timegrid = timegrid + list(tar)
-        timegrid = list(numpy.round(timegrid, decimals=2))
+    ## the grid itself depends only on the scan parameters, so it is
+    ## computed once and memoized.  tuples are used as the cache key
+    ## so the caller's lists are never touched.
+    (grid, timegrid) = energy_time_grid(tuple(bounds), tuple(steps), tuple(times), float(e0), bool(ththth))
 
-    if element is not None:
-        overhead, uncertainty = tele.overhead_per_point(element, edge)
+    ## use the per-point duration model if it has been fitted for this
+    ## detector, otherwise the per-element overhead
+    detector = 'trans'
+    if mode is not None and plotting_mode(mode) in ('xs', 'fluo'):
+        detector = plotting_mode(mode)
+    prediction = None
+    if len(grid) > 1:
+        prediction = tele.duration.predict(grid, timegrid, detector=detector, rewind=not bothways)
+    if prediction is not None:
+        approximate_time, delta = prediction[0] / 60.0, prediction[1] / 60.0
     else:
-        overhead = tele.interpolate(e0)
-        
-    approximate_time = (sum(timegrid) + float(len(timegrid))*overhead) / 60.0
-    delta = float(len(timegrid))*uncertainty / 60.0
+        if element is not None:
+            overhead, uncertainty = tele.overhead_per_point(element, edge)
+        else:
+            overhead, uncertainty = tele.interpolate(e0), 0
+        approximate_time = (timegrid.sum() + float(len(timegrid))*overhead) / 60.0
+        delta = float(len(timegrid))*uncertainty / 60.0
     return (grid, timegrid, round(approximate_time, 1), round(delta, 1))
 
+
+@lru_cache(maxsize=256)
+def energy_time_grid(bounds, steps, times, e0, ththth):
+    '''Compute the energy and integration time grids for a step scan.
+
+    This is the engine behind conventional_grid.  All arguments must
+    be hashable (tuples in place of lists) so that the result can be
+    memoized.  All regions are computed in a single vectorized pass.
+
+    Parameters
+    ----------
+    bounds : tuple of float or str
+        N relative energy values denoting the region boundaries of the step scan
+    steps : tuple of float or str
+        N-1 energy step sizes
+    times : tuple of float or str
+        N-1 integration time values
+    e0 : float
+        edge energy, reference for boundary values
+    ththth : Boolean
+        using the Si(333) reflection
+
+    Output
+    ------
+    grid : numpy.ndarray
+        absolute energy values (float64, read only)
+    timegrid : numpy.ndarray
+        integration times (float64, read only)
+
+    The returned arrays are shared by every caller asking for the same
+    grid, so they are flagged as read only.  Make a copy if you need
+    to modify one.
+    '''
+    ## convert k-valued boundaries to energy, without altering the input
+    edges = numpy.sort(numpy.array([ktoe(float(b[:-1])) if type(b) is str else float(b) for b in bounds]))
+
+    enot = e0
+    if ththth:
+        enot  = e0/3.0
+        edges = edges/3.0
+
+    ## describe each region by its start, stop, and step size in its
+    ## natural units (absolute eV or invAng) and by its integration time rule
+    nregions = len(steps)
+    isk      = numpy.array([type(s) is str for s in steps])
+    step     = numpy.array([float(s[:-1]) if type(s) is str else float(s) for s in steps])
+    if ththth:
+        step = step/3.
+    first    = numpy.where(isk, etok(numpy.maximum(edges[:-1], 0)), enot+edges[:-1])
+    last     = numpy.where(isk, etok(numpy.maximum(edges[1:], 0)),  enot+edges[1:])
+    kweight  = numpy.array([type(t) is str for t in times])
+    tvalue   = numpy.array([float(t[:-1]) if type(t) is str else float(t) for t in times])
+
+    ## number of points in each region, following the numpy.arange convention
+    npts   = numpy.maximum(numpy.ceil((last - first) / step), 0).astype(int)
+    region = numpy.repeat(numpy.arange(nregions), npts)
+    offset = numpy.arange(npts.sum()) - numpy.repeat(numpy.cumsum(npts) - npts, npts)
+
+    ## build the entire grid at once
+    x  = first[region] + offset * step[region]
+    ar = numpy.where(isk[region], enot + ktoe(x), x)
+    with numpy.errstate(invalid='ignore'):
+        tar = numpy.where(kweight[region], etok(ar-enot)*tvalue[region], tvalue[region])
+
+    grid     = numpy.ascontiguousarray(numpy.round(ar,  decimals=2), dtype=numpy.float64)
+    timegrid = numpy.ascontiguousarray(numpy.round(tar, decimals=2), dtype=numpy.float64)
+    grid.flags.writeable     = False
+    timegrid.flags.writeable = False
+    return (grid, timegrid)
+
+
 ## -----------------------
 ##  energy step scan plan concept
 ##  1. collect metadata from an INI file